@@ -0,0 +1,131 @@
+"""
+Assistant runs for the chat on the OpenAI page.
+
+Runs are streamed so text shows up as it is generated. If streaming is not
+available, e.g. on a local stand-in for the API, the run is polled instead,
+starting fast and backing off while it is still queued or in progress. A run
+the stream already created is polled rather than started again. Both paths
+give up at an overall deadline and cancel the run.
+"""
+import threading
+import time
+
+import openai
+
+TERMINAL_RUN_STATUSES = ("completed", "failed", "cancelled", "expired", "incomplete", "requires_action")
+
+
+def _cancel(client, thread_id, run_id):
+    try:
+        client.beta.threads.runs.cancel(thread_id=thread_id, run_id=run_id)
+    except openai.APIError:
+        pass
+
+
+def _check_run(run):
+    if run.status != "completed":
+        error = getattr(run, "last_error", None)
+        raise RuntimeError(f"Assistant run {run.status}" + (f": {error.message}" if error else ""))
+
+
+def poll_run(client, thread_id, assistant_id, deadline, run_id=None, initial_interval=0.25, max_interval=5.0):
+    """
+    Poll a run with increasing intervals until it finishes and return its reply.
+
+    Args:
+        client: The OpenAI client
+        thread_id: The thread to run
+        assistant_id: The assistant to run it with
+        deadline: time.monotonic() value after which the run is cancelled
+        run_id: A run that was already created, e.g. by a stream that failed; created if not given
+        initial_interval: Seconds before the first poll
+        max_interval: Longest wait between polls
+
+    Returns:
+        The text of the messages the run added to the thread
+    """
+    if run_id:
+        run = client.beta.threads.runs.retrieve(thread_id=thread_id, run_id=run_id)
+    else:
+        run = client.beta.threads.runs.create(thread_id=thread_id, assistant_id=assistant_id)
+    interval = initial_interval
+    while run.status not in TERMINAL_RUN_STATUSES:
+        if time.monotonic() + interval > deadline:
+            _cancel(client, thread_id, run.id)
+            raise TimeoutError("The assistant did not answer in time.")
+        time.sleep(interval)
+        interval = min(interval * 1.5, max_interval)
+        run = client.beta.threads.runs.retrieve(thread_id=thread_id, run_id=run.id)
+    _check_run(run)
+
+    # All of the run's messages in one request, rather than one per run step
+    messages = client.beta.threads.messages.list(thread_id=thread_id, run_id=run.id, order="asc")
+    return "\n\n".join(
+        part.text.value for message in messages for part in message.content if part.type == "text"
+    )
+
+
+def stream_run(client, thread_id, assistant_id, timeout=120):
+    """
+    Run an assistant on a thread and yield its reply as it is generated.
+
+    Suitable for st.write_stream. If streaming fails before any text arrives,
+    the run is polled instead, or created by poll_run if the stream never got
+    that far, and the whole reply is yielded at once. A timer enforces the
+    deadline even while no events arrive.
+
+    Args:
+        client: The OpenAI client
+        thread_id: The thread to run
+        assistant_id: The assistant to run it with
+        timeout: Seconds the whole run may take before it is cancelled
+
+    Raises:
+        TimeoutError: If the run is not finished within timeout
+        RuntimeError: If the run fails, expires or needs tool outputs
+    """
+    deadline = time.monotonic() + timeout
+    started = False
+    run_id = None
+    expired = threading.Event()
+    try:
+        with client.with_options(timeout=timeout).beta.threads.runs.stream(
+            thread_id=thread_id, assistant_id=assistant_id
+        ) as stream:
+            def expire():
+                expired.set()
+                if run_id:
+                    _cancel(client, thread_id, run_id)
+                # Unblocks the read below if the stream has gone quiet
+                stream.close()
+
+            timer = threading.Timer(timeout, expire)
+            timer.daemon = True
+            timer.start()
+            try:
+                # Every event, not just text, so run steps and status changes are seen too
+                for event in stream:
+                    if stream.current_run:
+                        run_id = stream.current_run.id
+                    if expired.is_set():
+                        break
+                    if event.event == "thread.message.delta":
+                        for part in event.data.delta.content or []:
+                            if part.type == "text" and part.text and part.text.value:
+                                started = True
+                                yield part.text.value
+                if not expired.is_set():
+                    _check_run(stream.get_final_run())
+            except Exception:
+                if not expired.is_set():
+                    raise
+            finally:
+                timer.cancel()
+        if expired.is_set():
+            raise TimeoutError("The assistant did not answer in time.")
+    except (openai.APIStatusError, openai.APIConnectionError):
+        if started:
+            if run_id:
+                _cancel(client, thread_id, run_id)
+            raise
+        yield poll_run(client, thread_id, assistant_id, deadline, run_id=run_id)
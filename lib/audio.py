@@ -0,0 +1,262 @@
+"""
+Chunked decoding, range downloads and an on-disk LRU cache for dialog recordings.
+
+Recordings are stored either as base64 text in dialog.body or behind dialog.url.
+Either way they are written to the cache in chunks, never decoded into memory
+as a whole, and played back one segment at a time. Streamlit serves each
+segment from its media endpoint, which answers HTTP range requests, so the
+browser can seek within a segment without downloading it again.
+"""
+import base64
+import hashlib
+import io
+import os
+import struct
+import tempfile
+import threading
+import wave
+
+import requests
+
+DECODE_CHUNK_CHARS = 4 * 256 * 1024
+DOWNLOAD_CHUNK_BYTES = 1024 * 1024
+WAV_SEGMENT_SECONDS = 300
+BYTE_SEGMENT_SIZE = 5 * 1024 * 1024
+
+
+class AudioCache:
+    """A directory of decoded recordings, evicted least recently used first once over max_bytes."""
+
+    def __init__(self, directory=None, max_bytes=512 * 1024 * 1024):
+        self.directory = directory or os.path.join(tempfile.gettempdir(), "vcon-admin-audio")
+        self.max_bytes = max_bytes
+        self._lock = threading.Lock()
+        os.makedirs(self.directory, exist_ok=True)
+
+    def path(self, key):
+        return os.path.join(self.directory, hashlib.sha256(key.encode("utf-8")).hexdigest())
+
+    def get(self, key):
+        """Return the cached file for key, marking it as recently used, or None."""
+        path = self.path(key)
+        if not os.path.exists(path):
+            return None
+        os.utime(path)
+        return path
+
+    def put(self, key, chunks):
+        """Write an iterable of byte chunks to the cache and return the file path."""
+        path = self.path(key)
+        partial = f"{path}.{threading.get_ident()}.part"
+        try:
+            with open(partial, "wb") as f:
+                for chunk in chunks:
+                    f.write(chunk)
+            os.replace(partial, path)
+        finally:
+            if os.path.exists(partial):
+                os.remove(partial)
+        # A recording larger than the whole cache stays until the next put
+        self.evict(keep=path)
+        return path
+
+    def evict(self, keep=None):
+        """Delete the least recently used files, except keep, until the cache fits in max_bytes."""
+        with self._lock:
+            entries = []
+            for name in os.listdir(self.directory):
+                if name.endswith(".part") or (keep and name == os.path.basename(keep)):
+                    continue
+                stat = os.stat(os.path.join(self.directory, name))
+                entries.append((stat.st_mtime, stat.st_size, name))
+            total = sum(size for _, size, _ in entries)
+            for _, size, name in sorted(entries):
+                if total <= self.max_bytes:
+                    break
+                os.remove(os.path.join(self.directory, name))
+                total -= size
+
+
+def iter_base64_decode(text, encoding="base64url", chunk_chars=DECODE_CHUNK_CHARS):
+    """Decode base64 or base64url text in chunks of whole 4-character groups."""
+    if any(c in text[:1024] for c in "\r\n "):
+        text = "".join(text.split())
+    decode = base64.urlsafe_b64decode if encoding == "base64url" else base64.b64decode
+    chunk_chars -= chunk_chars % 4
+    for offset in range(0, len(text), chunk_chars):
+        chunk = text[offset:offset + chunk_chars]
+        if len(chunk) % 4:
+            # base64url often omits the trailing padding
+            chunk += "=" * (-len(chunk) % 4)
+        yield decode(chunk)
+
+
+def iter_url_ranges(url, session=None, chunk_bytes=DOWNLOAD_CHUNK_BYTES, timeout=30):
+    """
+    Download a URL with successive HTTP range requests.
+
+    Falls back to a single streamed download if the server ignores Range.
+    """
+    session = session or requests.Session()
+    start = 0
+    while True:
+        headers = {"Range": f"bytes={start}-{start + chunk_bytes - 1}"}
+        with session.get(url, headers=headers, stream=True, timeout=timeout) as response:
+            if response.status_code == 416:
+                return
+            response.raise_for_status()
+            if response.status_code != 206:
+                yield from response.iter_content(chunk_size=64 * 1024)
+                return
+            data = response.content
+            total = response.headers.get("Content-Range", "").rpartition("/")[2]
+        yield data
+        start += len(data)
+        if not data or (total.isdigit() and start >= int(total)):
+            return
+
+
+def cache_dialog_audio(cache, key, entry, fetch_body):
+    """
+    Make sure a dialog recording is in the cache and return its path.
+
+    Args:
+        cache: The AudioCache
+        key: Cache key identifying the recording, e.g. "<uuid>:<dialog index>"
+        entry: The dialog entry, with or without its body
+        fetch_body: Called to load the dialog entry with its body on a cache miss
+
+    Returns:
+        Path of the decoded recording, or None if the entry has no audio
+    """
+    path = cache.get(key)
+    if path:
+        return path
+    if entry.get("url"):
+        return cache.put(key, iter_url_ranges(entry["url"]))
+    full_entry = fetch_body() or {}
+    body = full_entry.get("body")
+    if not body:
+        return None
+    encoding = full_entry.get("encoding", "base64url")
+    if encoding not in ("base64", "base64url"):
+        return None
+    return cache.put(key, iter_base64_decode(body, encoding))
+
+
+def is_wav(path):
+    with open(path, "rb") as f:
+        header = f.read(12)
+    return header[:4] == b"RIFF" and header[8:12] == b"WAVE"
+
+
+def open_pcm_wav(path):
+    """
+    Open a recording with the wave module, or return None if it is not a PCM WAV.
+
+    μ-law, A-law and other compressed WAVs, common in telephony, are not
+    readable by wave and are treated like any other format.
+    """
+    if not is_wav(path):
+        return None
+    try:
+        return wave.open(path, "rb")
+    except (wave.Error, EOFError):
+        return None
+
+
+def read_wav_layout(path):
+    """
+    Find the format and data chunks of a WAV file of any encoding.
+
+    Returns:
+        Tuple of (fmt chunk contents, data offset, data size, block align, byte rate),
+        or None if the file is not a WAV or has no fmt or data chunk
+    """
+    if not is_wav(path):
+        return None
+    file_size = os.path.getsize(path)
+    fmt = None
+    with open(path, "rb") as f:
+        f.seek(12)
+        while True:
+            header = f.read(8)
+            if len(header) < 8:
+                return None
+            chunk_id, size = struct.unpack("<4sI", header)
+            if chunk_id == b"fmt ":
+                fmt = f.read(size)
+                if len(fmt) < 16:
+                    return None
+            elif chunk_id == b"data":
+                if fmt is None:
+                    return None
+                offset = f.tell()
+                # Streamed recordings may leave the size unset; trust the file instead
+                size = min(size, file_size - offset) if size else file_size - offset
+                _, _, _, byte_rate, block_align = struct.unpack("<HHIIH", fmt[:14])
+                return fmt, offset, size, max(block_align, 1), byte_rate
+            else:
+                f.seek(size, os.SEEK_CUR)
+            # Chunks are padded to an even size
+            if size % 2:
+                f.seek(1, os.SEEK_CUR)
+
+
+def _wav_segment_bytes(layout, segment_seconds, segment_bytes):
+    _, _, _, block_align, byte_rate = layout
+    size = segment_seconds * byte_rate if byte_rate else segment_bytes
+    return max(size // block_align, 1) * block_align
+
+
+def segment_count(path, segment_seconds=WAV_SEGMENT_SECONDS, segment_bytes=BYTE_SEGMENT_SIZE):
+    """Number of playback segments in a cached recording."""
+    source = open_pcm_wav(path)
+    if source:
+        with source:
+            seconds = source.getnframes() / source.getframerate()
+        return max(1, -(-int(seconds) // segment_seconds))
+    layout = read_wav_layout(path)
+    if layout:
+        return max(1, -(-layout[2] // _wav_segment_bytes(layout, segment_seconds, segment_bytes)))
+    return max(1, -(-os.path.getsize(path) // segment_bytes))
+
+
+def read_segment(path, index, segment_seconds=WAV_SEGMENT_SECONDS, segment_bytes=BYTE_SEGMENT_SIZE):
+    """
+    Read one playback segment of a cached recording.
+
+    PCM WAV files are cut on frame boundaries into standalone WAV files of
+    segment_seconds each. Other WAVs, e.g. μ-law or A-law, are cut on block
+    boundaries and each segment gets a copy of the fmt chunk and a header of
+    its own. Other formats are cut into byte ranges, which frame-based formats
+    such as MP3 resynchronize on.
+    """
+    source = open_pcm_wav(path)
+    if source:
+        with source:
+            params = source.getparams()
+            frames_per_segment = segment_seconds * source.getframerate()
+            source.setpos(min(index * frames_per_segment, source.getnframes()))
+            frames = source.readframes(frames_per_segment)
+        output = io.BytesIO()
+        with wave.open(output, "wb") as segment:
+            segment.setparams(params)
+            segment.writeframes(frames)
+        return output.getvalue()
+    layout = read_wav_layout(path)
+    if layout:
+        fmt, offset, size, _, _ = layout
+        length = _wav_segment_bytes(layout, segment_seconds, segment_bytes)
+        start = min(index * length, size)
+        with open(path, "rb") as f:
+            f.seek(offset + start)
+            data = f.read(min(length, size - start))
+        padding = b"\x00" if len(data) % 2 else b""
+        fmt_chunk = b"fmt " + struct.pack("<I", len(fmt)) + fmt + (b"\x00" if len(fmt) % 2 else b"")
+        riff_size = 4 + len(fmt_chunk) + 8 + len(data) + len(padding)
+        return (b"RIFF" + struct.pack("<I", riff_size) + b"WAVE" + fmt_chunk
+                + b"data" + struct.pack("<I", len(data)) + data + padding)
+    with open(path, "rb") as f:
+        f.seek(index * segment_bytes)
+        return f.read(segment_bytes)
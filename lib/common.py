@@ -7,8 +7,23 @@ from yaml.loader import SafeLoader
 from elasticsearch import Elasticsearch
 import requests
 import logging
-from pymongo import MongoClient
+import json
+import re
+import hashlib
+import threading
+import struct
+from collections import deque
+from bson import json_util
+from bson.codec_options import CodecOptions
+from bson.raw_bson import RawBSONDocument
+from pymongo import MongoClient, ReplaceOne, UpdateOne
 from functools import wraps
+from uuid import UUID
+from datetime import datetime, timedelta, timezone
+from concurrent.futures import ThreadPoolExecutor, as_completed
+from urllib.parse import urljoin
+from requests.adapters import HTTPAdapter
+from urllib3.util.retry import Retry
 
 # Setup logging
 logging.basicConfig(level=logging.INFO)
@@ -102,7 +117,7 @@ def mongo_error_handler(func):
 
 # Enhanced vCon retrieval functions
 @mongo_error_handler
-def get_vcons(since=None, limit=None, sort_by="created_at", sort_order="descending", include_full_dialog=False):
+def get_vcons(since=None, limit=None, sort_by="created_at", sort_order="descending", include_full_dialog=False, query=None):
     """
     Get vCons with better pagination, sorting support, and optimized projection.
     
@@ -113,12 +128,13 @@ def get_vcons(since=None, limit=None, sort_by="created_at", sort_order="descendi
         sort_order: "ascending" or "descending"
         include_full_dialog: Whether to include the full dialog data (which may contain large wav files)
                            Set to False to only include metadata, improving performance
+        query: Optional MongoDB filter, e.g. from build_vcon_filter
     
     Returns:
         List of vCon documents with selective fields based on the include_full_dialog parameter
     """
     collection = get_vcon_collection()
-    query = {}
+    query = dict(query or {})
     if since:
         query['created_at'] = {'$gte': since}
     
@@ -182,6 +198,460 @@ def get_vcon(uuid, include_full_dialog=True):
         # Get the full document including dialog body (potentially large)
         return collection.find_one({'uuid': uuid}, {"_id": 0})
 
+def _without_binary_bodies(section):
+    """
+    Aggregation expression for a dialog or attachments array with base64 and
+    audio or video bodies replaced by their length in body_length, so the
+    bytes never leave the server.
+    """
+    mimetype = {"$ifNull": ["$$entry.mimetype", {"$ifNull": ["$$entry.mime_type", ""]}]}
+    is_binary = {"$and": [
+        {"$eq": [{"$type": "$$entry.body"}, "string"]},
+        {"$or": [
+            {"$in": ["$$entry.encoding", ["base64", "base64url"]]},
+            {"$regexMatch": {"input": mimetype, "regex": "^(audio|video)/"}},
+        ]},
+    ]}
+    stripped = {"$unsetField": {
+        "field": "body",
+        "input": {"$mergeObjects": ["$$entry", {"body_length": {"$strLenCP": "$$entry.body"}}]},
+    }}
+    return {"$cond": [
+        {"$isArray": f"${section}"},
+        {"$map": {"input": f"${section}", "as": "entry", "in": {"$cond": [is_binary, stripped, "$$entry"]}}},
+        f"${section}",
+    ]}
+
+@mongo_error_handler
+def get_vcons_by_uuid(uuids, analysis_types=None, strip_binary=False):
+    """
+    Get many vCons in a single round trip.
+
+    Args:
+        uuids: The UUIDs to fetch
+        analysis_types: If given, return only uuid, created_at, updated_at and the
+                        analysis entries of these types. If None, return full documents.
+        strip_binary: For full documents, leave base64 and audio or video dialog and
+                      attachment bodies on the server and return their length in
+                      body_length instead, for llm.strip_binary_bodies
+
+    Returns:
+        Dictionary of {uuid: vCon document} for the vCons that were found
+    """
+    collection = get_vcon_collection()
+    uuids = list(dict.fromkeys(uuids))
+    if analysis_types is None and strip_binary:
+        cursor = collection.aggregate([
+            {"$match": {"uuid": {"$in": uuids}}},
+            {"$project": {"_id": 0}},
+            {"$set": {section: _without_binary_bodies(section) for section in ("dialog", "attachments")}},
+        ])
+    elif analysis_types is None:
+        cursor = collection.find({"uuid": {"$in": uuids}}, {"_id": 0})
+    else:
+        cursor = collection.aggregate([
+            {"$match": {"uuid": {"$in": uuids}}},
+            {"$project": {
+                "_id": 0,
+                "uuid": 1,
+                "created_at": 1,
+                "updated_at": 1,
+                "analysis": {"$filter": {
+                    "input": {"$ifNull": ["$analysis", []]},
+                    "cond": {"$in": ["$$this.type", list(analysis_types)]},
+                }},
+            }},
+        ])
+    return {doc["uuid"]: doc for doc in cursor}
+
+def sample_vcons(query=None, size=50):
+    """
+    Sample random vCons, projected down to uuid, timestamps and summary.
+
+    Not wrapped in mongo_error_handler: it runs from background threads, where
+    the caller logs failures instead of showing them on the page.
+    """
+    collection = get_vcon_collection()
+    pipeline = [{"$match": query}] if query else []
+    pipeline += [
+        {"$sample": {"size": size}},
+        {"$project": {
+            "_id": 0,
+            "uuid": 1,
+            "created_at": 1,
+            "updated_at": 1,
+            "summary": {"$first": {"$filter": {
+                "input": {"$ifNull": ["$analysis", []]},
+                "cond": {"$eq": ["$$this.type", "summary"]},
+            }}},
+        }},
+        {"$addFields": {"summary": "$summary.body"}},
+    ]
+    return list(collection.aggregate(pipeline))
+
+class RandomVconPool:
+    """
+    Pre-sampled random vCons, kept per filter so picking one costs no database work.
+
+    Taking a sample that leaves fewer than low_water in the pool starts a
+    background refill. Only an empty pool, the first pick for a filter,
+    waits for the database.
+    """
+
+    def __init__(self, batch_size=50, low_water=10):
+        self.batch_size = batch_size
+        self.low_water = low_water
+        self._pools = {}
+        self._refilling = set()
+        self._lock = threading.Lock()
+
+    def _refill(self, key, query):
+        try:
+            samples = sample_vcons(query, self.batch_size)
+        except Exception as e:
+            logger.error(f"Refilling random vCon pool failed: {str(e)}")
+            samples = []
+        with self._lock:
+            self._pools.setdefault(key, deque()).extend(samples)
+            self._refilling.discard(key)
+
+    def take(self, query=None):
+        """Return a random vCon (uuid, created_at, updated_at, summary) matching query, or None."""
+        key = json_util.dumps(query or {}, sort_keys=True)
+        with self._lock:
+            pool = self._pools.setdefault(key, deque())
+            vcon = pool.popleft() if pool else None
+            refill = len(pool) < self.low_water and key not in self._refilling
+            if refill:
+                self._refilling.add(key)
+        if vcon is not None:
+            if refill:
+                threading.Thread(target=self._refill, args=(key, query), daemon=True).start()
+            return vcon
+        self._refill(key, query)
+        with self._lock:
+            pool = self._pools[key]
+            return pool.popleft() if pool else None
+
+VCON_SECTIONS = ["analysis", "dialog", "parties", "attachments"]
+
+@mongo_error_handler
+def get_vcon_header(uuid):
+    """
+    Get a vCon's top-level fields plus its summary, without any of the large arrays.
+
+    Returns:
+        The vCon document with dialog, analysis, attachments and parties removed
+        and a "summary" key holding the body of the first summary analysis, or
+        None if not found
+    """
+    collection = get_vcon_collection()
+    pipeline = [
+        {"$match": {"uuid": uuid}},
+        {"$limit": 1},
+        {"$addFields": {"summary": {"$first": {"$filter": {
+            "input": {"$ifNull": ["$analysis", []]},
+            "cond": {"$eq": ["$$this.type", "summary"]},
+        }}}}},
+        {"$addFields": {"summary": "$summary.body"}},
+        {"$project": {"_id": 0, "dialog": 0, "analysis": 0, "attachments": 0, "parties": 0}},
+    ]
+    return next(collection.aggregate(pipeline), None)
+
+@mongo_error_handler
+def get_vcon_section(uuid, section, include_dialog_bodies=False):
+    """
+    Get a single top-level array of a vCon.
+
+    Args:
+        uuid: The UUID of the vCon
+        section: One of VCON_SECTIONS
+        include_dialog_bodies: For the dialog section, whether to keep each entry's body
+
+    Returns:
+        The section as a list (empty if missing) or None if the vCon is not found
+    """
+    if section not in VCON_SECTIONS:
+        raise ValueError(f"Unknown vCon section: {section}")
+    collection = get_vcon_collection()
+    pipeline = [
+        {"$match": {"uuid": uuid}},
+        {"$limit": 1},
+        {"$project": {"_id": 0, section: {"$ifNull": [f"${section}", []]}}},
+    ]
+    if section == "dialog" and not include_dialog_bodies:
+        pipeline.append({"$unset": "dialog.body"})
+    doc = next(collection.aggregate(pipeline), None)
+    return doc[section] if doc else None
+
+@mongo_error_handler
+def get_dialog_body(uuid, index):
+    """
+    Get one dialog entry of a vCon, including its (potentially large) body.
+
+    Returns:
+        The dialog entry or None if either the vCon or the entry does not exist
+    """
+    collection = get_vcon_collection()
+    pipeline = [
+        {"$match": {"uuid": uuid}},
+        {"$limit": 1},
+        {"$project": {"_id": 0, "entry": {"$arrayElemAt": [{"$ifNull": ["$dialog", []]}, index]}}},
+    ]
+    doc = next(collection.aggregate(pipeline), None)
+    return doc.get("entry") if doc else None
+
+@mongo_error_handler
+def get_vcon_key_sizes(uuid):
+    """
+    Get the BSON size in bytes of each top-level key of a vCon, computed by
+    MongoDB so none of the data has to be transferred.
+
+    Returns:
+        Dictionary of {key: bytes} or None if the vCon is not found
+    """
+    collection = get_vcon_collection()
+    pipeline = [
+        {"$match": {"uuid": uuid}},
+        {"$limit": 1},
+        {"$project": {"_id": 0, "sizes": {"$map": {
+            "input": {"$objectToArray": "$$ROOT"},
+            "as": "field",
+            "in": {
+                "k": "$$field.k",
+                # $bsonSize only accepts documents, so wrap each value in one
+                "v": {"$bsonSize": {"$arrayToObject": [[{"k": "v", "v": "$$field.v"}]]}},
+            },
+        }}}},
+    ]
+    doc = next(collection.aggregate(pipeline), None)
+    if not doc:
+        return None
+    return {row["k"]: row["v"] for row in doc["sizes"] if row["k"] != "_id"}
+
+
+def _created_at_range(start=None, end=None):
+    """
+    Match created_at in [start, end).
+
+    Imported vCons store created_at as an ISO 8601 string while others hold a
+    BSON date. Range operators only compare values of the same type, so both
+    forms are matched, and each branch can use the created_at index.
+    """
+    date_range = {}
+    string_range = {}
+    if start:
+        date_range['$gte'] = start
+        string_range['$gte'] = start.isoformat()
+    if end:
+        date_range['$lt'] = end
+        string_range['$lt'] = end.isoformat()
+    return {'$or': [{'created_at': date_range}, {'created_at': string_range}]}
+
+def build_vcon_filter(start=None, end=None, party_tel=None, party_mailto=None, party_name=None,
+                      mime_type=None, analysis_type=None, tags=None):
+    """
+    Compile vCon Manager filter controls into a MongoDB query.
+
+    Every condition targets a field covered by ensure_vcon_indexes, so the
+    filtering happens in the database rather than on loaded rows.
+
+    Args:
+        start: Optional datetime, only vCons created at or after it
+        end: Optional datetime, only vCons created before it
+        party_tel: Exact telephone number of any party
+        party_mailto: Exact email address of any party
+        party_name: Prefix of any party's name (case sensitive, so it can use the index)
+        mime_type: Mime type of any dialog entry
+        analysis_type: Only vCons with an analysis entry of this type
+        tags: List of "key:value" tags that must all be present in the tags attachment
+
+    Returns:
+        A MongoDB query document
+    """
+    conditions = []
+    if start or end:
+        conditions.append(_created_at_range(start, end))
+    if party_tel:
+        conditions.append({'parties.tel': party_tel})
+    if party_mailto:
+        conditions.append({'parties.mailto': party_mailto})
+    if party_name:
+        conditions.append({'parties.name': {'$regex': f"^{re.escape(party_name)}"}})
+    if mime_type:
+        # Older vCons spell the field mime_type, the spec spells it mimetype
+        conditions.append({'$or': [{'dialog.mimetype': mime_type}, {'dialog.mime_type': mime_type}]})
+    if analysis_type:
+        conditions.append({'analysis.type': analysis_type})
+    if tags:
+        conditions.append({'attachments': {'$elemMatch': {'type': 'tags', 'body': {'$all': list(tags)}}}})
+
+    if not conditions:
+        return {}
+    if len(conditions) == 1:
+        return conditions[0]
+    return {'$and': conditions}
+
+@mongo_error_handler
+def ensure_vcon_indexes():
+    """Create the indexes used by the vCon Manager filters and sorts."""
+    collection = get_vcon_collection()
+    for field in ["uuid", "created_at", "updated_at", "parties.tel", "parties.mailto", "parties.name",
+                  "dialog.mimetype", "dialog.mime_type", "analysis.type", "attachments.type"]:
+        collection.create_index([(field, pymongo.ASCENDING)])
+
+# Time-series analytics, cached per closed time bucket
+ANALYTICS_UNITS = ["hour", "day", "week", "month"]
+
+def truncate_to_bucket(moment, unit):
+    """Truncate a naive UTC datetime the same way $dateTrunc does (weeks start on Monday)."""
+    if unit == "hour":
+        return moment.replace(minute=0, second=0, microsecond=0)
+    day = moment.replace(hour=0, minute=0, second=0, microsecond=0)
+    if unit == "day":
+        return day
+    if unit == "week":
+        return day - timedelta(days=day.weekday())
+    if unit == "month":
+        return day.replace(day=1)
+    raise ValueError(f"Unsupported bucket unit: {unit}")
+
+def next_bucket(bucket, unit):
+    """Start of the bucket following an already truncated bucket."""
+    if unit == "hour":
+        return bucket + timedelta(hours=1)
+    if unit == "day":
+        return bucket + timedelta(days=1)
+    if unit == "week":
+        return bucket + timedelta(weeks=1)
+    if unit == "month":
+        return bucket.replace(year=bucket.year + bucket.month // 12, month=bucket.month % 12 + 1)
+    raise ValueError(f"Unsupported bucket unit: {unit}")
+
+def get_analytics_cache_collection():
+    """Get the collection holding pre-aggregated analytics buckets."""
+    db = get_vcon_db()
+    collection_name = st.secrets["mongo_db"].get("analytics_collection", "analytics_buckets")
+    return db[collection_name]
+
+def _aggregate_activity(start, unit):
+    """
+    Aggregate vCon volume, dialog mime types and analysis types per bucket
+    for every vCon created at or after start, in one pass over the collection.
+    """
+    date_trunc = {"date": "$ts", "unit": unit}
+    if unit == "week":
+        date_trunc["startOfWeek"] = "monday"
+    pipeline = [
+        {"$match": _created_at_range(start)},
+        {"$project": {
+            "_id": 0,
+            # created_at may be a BSON date or an ISO 8601 string
+            "ts": {"$cond": [
+                {"$eq": [{"$type": "$created_at"}, "date"]},
+                "$created_at",
+                {"$dateFromString": {"dateString": "$created_at", "onError": None, "onNull": None}},
+            ]},
+            "mimes": {"$map": {
+                "input": {"$ifNull": ["$dialog", []]},
+                "in": {"$ifNull": ["$$this.mimetype", {"$ifNull": ["$$this.mime_type", "unknown"]}]},
+            }},
+            "analysis_types": {"$map": {
+                "input": {"$ifNull": ["$analysis", []]},
+                "in": {"$ifNull": ["$$this.type", "unknown"]},
+            }},
+        }},
+        {"$match": {"ts": {"$ne": None}}},
+        {"$addFields": {"bucket": {"$dateTrunc": date_trunc}}},
+        {"$facet": {
+            "volume": [{"$group": {"_id": "$bucket", "count": {"$sum": 1}}}],
+            "dialog_types": [
+                {"$unwind": "$mimes"},
+                {"$group": {"_id": {"bucket": "$bucket", "key": "$mimes"}, "count": {"$sum": 1}}},
+            ],
+            "analysis_types": [
+                {"$unwind": "$analysis_types"},
+                {"$group": {"_id": {"bucket": "$bucket", "key": "$analysis_types"}, "count": {"$sum": 1}}},
+            ],
+        }},
+    ]
+    result = next(get_vcon_collection().aggregate(pipeline, allowDiskUse=True))
+
+    buckets = {}
+    def bucket_row(bucket):
+        return buckets.setdefault(bucket, {"bucket": bucket, "count": 0, "dialog_types": {}, "analysis_types": {}})
+    for row in result["volume"]:
+        bucket_row(row["_id"])["count"] = row["count"]
+    for facet in ("dialog_types", "analysis_types"):
+        for row in result[facet]:
+            bucket_row(row["_id"]["bucket"])[facet][row["_id"]["key"]] = row["count"]
+    return buckets
+
+@mongo_error_handler
+def get_vcon_activity(unit, start):
+    """
+    Get per-bucket vCon volume and composition from start until now.
+
+    Closed buckets are read from the analytics cache. Only buckets missing from
+    the cache, plus the newest still-open bucket, are aggregated from the vCon
+    collection, and newly closed buckets are written back to the cache.
+
+    Args:
+        unit: One of ANALYTICS_UNITS
+        start: Naive UTC datetime to start from
+
+    Returns:
+        List of {bucket, count, dialog_types, analysis_types} dictionaries in time order,
+        one for every bucket up to and including the open one
+    """
+    cache = get_analytics_cache_collection()
+    start = truncate_to_bucket(start, unit)
+    open_bucket = truncate_to_bucket(datetime.now(timezone.utc).replace(tzinfo=None), unit)
+
+    cached = {}
+    for doc in cache.find({"unit": unit, "bucket": {"$gte": start, "$lt": open_bucket}}):
+        cached[doc["bucket"]] = {
+            "bucket": doc["bucket"],
+            "count": doc["count"],
+            "dialog_types": {row["key"]: row["count"] for row in doc["dialog_types"]},
+            "analysis_types": {row["key"]: row["count"] for row in doc["analysis_types"]},
+        }
+
+    # Recompute from the first closed bucket we have no cache entry for
+    compute_from = start
+    while compute_from < open_bucket and compute_from in cached:
+        compute_from = next_bucket(compute_from, unit)
+    fresh = _aggregate_activity(compute_from, unit)
+
+    # Cache every newly closed bucket, including empty ones, so they are never aggregated again
+    operations = []
+    bucket = compute_from
+    while bucket < open_bucket:
+        row = fresh.get(bucket, {"bucket": bucket, "count": 0, "dialog_types": {}, "analysis_types": {}})
+        fresh[bucket] = row
+        operations.append(ReplaceOne({"_id": f"{unit}:{bucket.isoformat()}"}, {
+            "unit": unit,
+            "bucket": bucket,
+            "count": row["count"],
+            "dialog_types": [{"key": k, "count": v} for k, v in row["dialog_types"].items()],
+            "analysis_types": [{"key": k, "count": v} for k, v in row["analysis_types"].items()],
+            "computed_at": datetime.now(timezone.utc),
+        }, upsert=True))
+        bucket = next_bucket(bucket, unit)
+    if operations:
+        cache.bulk_write(operations, ordered=False)
+
+    # The open bucket is always reported, even before its first vCon arrives
+    fresh.setdefault(open_bucket, {"bucket": open_bucket, "count": 0, "dialog_types": {}, "analysis_types": {}})
+    rows = dict(cached)
+    rows.update({bucket: row for bucket, row in fresh.items() if bucket >= start})
+    return [rows[bucket] for bucket in sorted(rows)]
+
+@mongo_error_handler
+def clear_activity_cache(unit=None):
+    """Drop cached analytics buckets, e.g. after back-filling old vCons."""
+    get_analytics_cache_collection().delete_many({"unit": unit} if unit else {})
+
 @mongo_error_handler
 def count_vcons(query=None):
     """Count vCons with optional filter query."""
@@ -195,6 +665,48 @@ def update_vcon(uuid, update_data):
     result = collection.update_one({'uuid': uuid}, {'$set': update_data})
     return result.modified_count
 
+@mongo_error_handler
+def bulk_append_analysis(entries):
+    """
+    Append analysis entries to many vCons in a single round trip.
+
+    Args:
+        entries: Iterable of (uuid, analysis entry) tuples
+
+    Returns:
+        The number of vCons modified
+    """
+    now = datetime.now(timezone.utc)
+    operations = [
+        UpdateOne({'uuid': uuid}, {'$push': {'analysis': analysis}, '$set': {'updated_at': now}})
+        for uuid, analysis in entries
+    ]
+    if not operations:
+        return 0
+    collection = get_vcon_collection()
+    result = collection.bulk_write(operations, ordered=False)
+    return result.modified_count
+
+@mongo_error_handler
+def get_vcons_with_analysis_keys(cache_keys):
+    """
+    Find the vCons that already have an analysis entry saved from a completion.
+
+    Args:
+        cache_keys: Dictionary of {uuid: completion cache key}
+
+    Returns:
+        Set of the uuids whose vCon has an analysis entry with that cache key
+    """
+    if not cache_keys:
+        return set()
+    collection = get_vcon_collection()
+    cursor = collection.find(
+        {"$or": [{"uuid": uuid, "analysis.prompt.cache_key": key} for uuid, key in cache_keys.items()]},
+        {"_id": 0, "uuid": 1},
+    )
+    return {doc["uuid"] for doc in cursor}
+
 @mongo_error_handler
 def insert_vcon(vcon_data):
     """Insert a new vCon document."""
@@ -202,6 +714,727 @@ def insert_vcon(vcon_data):
     result = collection.replace_one({'_id': vcon_data['uuid']}, vcon_data, upsert=True)
     return result
 
+@mongo_error_handler
+def bulk_upsert_vcons(vcons):
+    """
+    Insert or replace many vCons in a single round trip.
+
+    Args:
+        vcons: Iterable of vCon documents, each with a uuid
+
+    Returns:
+        The number of vCons written
+    """
+    operations = [ReplaceOne({'_id': vcon['uuid']}, vcon, upsert=True) for vcon in vcons]
+    if not operations:
+        return 0
+    collection = get_vcon_collection()
+    result = collection.bulk_write(operations, ordered=False)
+    return result.upserted_count + result.matched_count
+
+# URL import helpers
+def get_http_session(pool_size=8, retries=3):
+    """Create a requests session whose connection pool fits pool_size concurrent fetches."""
+    session = requests.Session()
+    adapter = HTTPAdapter(
+        pool_connections=pool_size,
+        pool_maxsize=pool_size,
+        max_retries=Retry(total=retries, backoff_factor=0.5, status_forcelist=[429, 500, 502, 503, 504]),
+    )
+    session.mount("http://", adapter)
+    session.mount("https://", adapter)
+    return session
+
+def resolve_manifest(session, manifest_url, timeout=30):
+    """
+    Expand a manifest into the list of URLs it names.
+
+    A manifest is either a JSON array of URLs (or of objects with a "url" key),
+    or plain text with one URL per line. Relative URLs are resolved against the
+    manifest's own URL.
+    """
+    response = session.get(manifest_url, timeout=timeout)
+    response.raise_for_status()
+    try:
+        entries = response.json()
+    except ValueError:
+        entries = [line.strip() for line in response.text.splitlines()]
+    urls = []
+    for entry in entries:
+        if isinstance(entry, dict):
+            entry = entry.get("url")
+        if entry and not str(entry).startswith("#"):
+            urls.append(urljoin(manifest_url, entry))
+    return urls
+
+def fetch_vcon_url(session, url, etag_cache=None, timeout=30):
+    """
+    Fetch the vCons at a URL, streaming the response body.
+
+    The body may hold a single vCon, a JSON array of vCons, or JSONL. When
+    etag_cache has validators for the URL they are sent along, and a 304 reply
+    returns no documents.
+
+    Returns:
+        Dictionary with url, status, vcons and, on failure, error
+    """
+    headers = {"accept": "application/json"}
+    cached = (etag_cache or {}).get(url, {})
+    if cached.get("etag"):
+        headers["If-None-Match"] = cached["etag"]
+    if cached.get("last_modified"):
+        headers["If-Modified-Since"] = cached["last_modified"]
+    try:
+        with session.get(url, headers=headers, stream=True, timeout=timeout) as response:
+            if response.status_code == 304:
+                return {"url": url, "status": "not modified", "vcons": []}
+            response.raise_for_status()
+            content_type = response.headers.get("content-type", "")
+            if "ndjson" in content_type or "jsonl" in content_type or url.endswith((".jsonl", ".vconl")):
+                vcons = [json.loads(line) for line in response.iter_lines() if line.strip()]
+            else:
+                body = json.loads(b"".join(response.iter_content(chunk_size=64 * 1024)))
+                vcons = body if isinstance(body, list) else [body]
+            validators = {
+                "etag": response.headers.get("ETag"),
+                "last_modified": response.headers.get("Last-Modified"),
+            }
+        if etag_cache is not None and (validators["etag"] or validators["last_modified"]):
+            etag_cache[url] = validators
+        return {"url": url, "status": "fetched", "vcons": vcons}
+    except (requests.RequestException, ValueError) as e:
+        return {"url": url, "status": "failed", "vcons": [], "error": str(e)}
+
+def fetch_vcon_urls(urls, max_workers=8, etag_cache=None, timeout=30):
+    """
+    Fetch many URLs concurrently through one pooled session.
+
+    Yields each fetch_vcon_url result as soon as it completes.
+    """
+    session = get_http_session(pool_size=max_workers)
+    with ThreadPoolExecutor(max_workers=max_workers) as executor:
+        futures = [executor.submit(fetch_vcon_url, session, url, etag_cache, timeout) for url in urls]
+        for future in as_completed(futures):
+            yield future.result()
+
+# Per-file JSON export, sharded into uuid-prefix subdirectories
+EXPORT_WRITE_BUFFER = 1024 * 1024
+
+def shard_path(uuid, depth=2, width=2):
+    """Relative path of a vCon file, e.g. ab/cd/abcd1234-....vcon.json for depth=2."""
+    prefix = uuid.replace("-", "")
+    parts = [prefix[i * width:(i + 1) * width] for i in range(depth)]
+    return os.path.join(*parts, f"{uuid}.vcon.json")
+
+def _write_export_file(root, vcon, depth):
+    data = json.dumps(vcon, default=str).encode("utf-8")
+    relative_path = shard_path(vcon['uuid'], depth)
+    full_path = os.path.join(root, relative_path)
+    os.makedirs(os.path.dirname(full_path), exist_ok=True)
+    with open(full_path, "wb", buffering=EXPORT_WRITE_BUFFER) as f:
+        f.write(data)
+    return {
+        "uuid": vcon['uuid'],
+        "path": relative_path,
+        "size": len(data),
+        "sha256": hashlib.sha256(data).hexdigest(),
+    }
+
+def export_vcons_to_directory(root, query=None, depth=2, max_workers=8, manifest_name="manifest.jsonl", progress=None):
+    """
+    Export vCons as individual JSON files through a thread pool.
+
+    Files are spread across uuid-prefix subdirectories so no single directory
+    grows to millions of entries, and a JSONL manifest of uuid, path, size and
+    sha256 is written alongside them for verification and re-import.
+
+    Args:
+        root: Directory to export into
+        query: Optional MongoDB filter
+        depth: Number of two-character uuid-prefix directory levels
+        max_workers: Number of concurrent file writers
+        manifest_name: Name of the manifest file written in root
+        progress: Optional callback receiving the number of files written so far
+
+    Returns:
+        The number of vCons exported
+    """
+    os.makedirs(root or ".", exist_ok=True)
+    collection = get_vcon_collection()
+    # Bound the number of documents held in memory waiting for a writer
+    in_flight = threading.BoundedSemaphore(max_workers * 4)
+    exported = 0
+
+    def write(vcon):
+        try:
+            return _write_export_file(root, vcon, depth)
+        finally:
+            in_flight.release()
+
+    with open(os.path.join(root, manifest_name), "w", buffering=EXPORT_WRITE_BUFFER) as manifest, \
+            ThreadPoolExecutor(max_workers=max_workers) as executor:
+        futures = set()
+        for vcon in collection.find(query or {}):
+            in_flight.acquire()
+            futures.add(executor.submit(write, vcon))
+            done = {future for future in futures if future.done()}
+            for future in done:
+                manifest.write(json.dumps(future.result()) + "\n")
+                exported += 1
+            futures -= done
+            if progress and done:
+                progress(exported)
+        for future in as_completed(futures):
+            manifest.write(json.dumps(future.result()) + "\n")
+            exported += 1
+        if progress:
+            progress(exported)
+    return exported
+
+def read_export_manifests(root):
+    """Yield every entry of every manifest*.jsonl file in an export directory."""
+    for name in sorted(os.listdir(root)):
+        if name.startswith("manifest") and name.endswith(".jsonl"):
+            with open(os.path.join(root, name)) as manifest:
+                for line in manifest:
+                    if line.strip():
+                        yield json.loads(line)
+
+def verify_export_directory(root, check_hashes=False):
+    """
+    Compare an export directory with its manifests.
+
+    Sizes are checked with a stat call; hashes are only computed when
+    check_hashes is set.
+
+    Returns:
+        Tuple of (number of files checked, list of problem descriptions)
+    """
+    checked = 0
+    problems = []
+    for entry in read_export_manifests(root):
+        full_path = os.path.join(root, entry["path"])
+        checked += 1
+        if not os.path.exists(full_path):
+            problems.append(f"{entry['uuid']}: missing {entry['path']}")
+        elif os.path.getsize(full_path) != entry["size"]:
+            problems.append(f"{entry['uuid']}: size mismatch")
+        elif check_hashes:
+            with open(full_path, "rb") as f:
+                if hashlib.sha256(f.read()).hexdigest() != entry["sha256"]:
+                    problems.append(f"{entry['uuid']}: hash mismatch")
+    return checked, problems
+
+def import_export_directory(root, max_workers=8, batch_size=500, progress=None):
+    """
+    Re-import an export directory by following its manifests, so the
+    directory tree never needs to be walked.
+
+    Returns:
+        The number of vCons written
+    """
+    def load(entry):
+        with open(os.path.join(root, entry["path"]), "rb", buffering=EXPORT_WRITE_BUFFER) as f:
+            return json.load(f)
+
+    def write(entries):
+        return bulk_upsert_vcons(list(executor.map(load, entries))) or 0
+
+    imported = 0
+    entries = []
+    with ThreadPoolExecutor(max_workers=max_workers) as executor:
+        for entry in read_export_manifests(root):
+            entries.append(entry)
+            if len(entries) >= batch_size:
+                imported += write(entries)
+                entries = []
+                if progress:
+                    progress(imported)
+        imported += write(entries)
+    return imported
+
+# Native BSON dump/restore in the mongodump layout: <collection>.bson + <collection>.metadata.json
+def get_raw_vcon_collection():
+    """Get the vCon collection with documents returned as undecoded RawBSONDocuments."""
+    return get_vcon_collection().with_options(codec_options=CodecOptions(document_class=RawBSONDocument))
+
+def dump_vcons_bson(directory, query=None, progress=None):
+    """
+    Write vCons to a mongodump-compatible .bson file without decoding them.
+
+    The raw bytes of each document are copied straight from the cursor to disk,
+    and the collection's indexes are written to a .metadata.json file next to it
+    so the dump can be loaded with either restore_vcons_bson or mongorestore.
+
+    Args:
+        directory: Directory to write the dump into
+        query: Optional MongoDB filter
+        progress: Optional callback receiving the number of documents written so far
+
+    Returns:
+        Path of the .bson file and the number of documents written
+    """
+    collection = get_raw_vcon_collection()
+    os.makedirs(directory or ".", exist_ok=True)
+    bson_path = os.path.join(directory, f"{collection.name}.bson")
+    count = 0
+    with open(bson_path, "wb", buffering=EXPORT_WRITE_BUFFER) as f:
+        for document in collection.find(query or {}, batch_size=1000):
+            f.write(document.raw)
+            count += 1
+            if progress and count % 1000 == 0:
+                progress(count)
+
+    metadata = {
+        "options": {},
+        "indexes": [dict(index) for index in collection.list_indexes()],
+        "collectionName": collection.name,
+        "type": "collection",
+    }
+    info = next(collection.database.list_collections(filter={"name": collection.name}), None)
+    if info and info.get("info", {}).get("uuid"):
+        # Binary unless the client decodes UUIDs, in which case it is a uuid.UUID
+        collection_uuid = info["info"]["uuid"]
+        metadata["uuid"] = collection_uuid.hex if isinstance(collection_uuid, UUID) else collection_uuid.hex()
+    with open(os.path.join(directory, f"{collection.name}.metadata.json"), "w") as f:
+        f.write(json_util.dumps(metadata, json_options=json_util.CANONICAL_JSON_OPTIONS))
+    return bson_path, count
+
+def iter_bson_documents(fileobj):
+    """Yield RawBSONDocuments from a stream of concatenated BSON documents."""
+    while True:
+        header = fileobj.read(4)
+        if not header:
+            return
+        if len(header) < 4:
+            raise ValueError("Truncated BSON stream")
+        length = struct.unpack("<i", header)[0]
+        body = fileobj.read(length - 4)
+        if len(body) < length - 4:
+            raise ValueError("Truncated BSON stream")
+        yield RawBSONDocument(header + body)
+
+@mongo_error_handler
+def restore_vcons_bson(fileobj, metadata=None, replace_existing=True, batch_size=1000, progress=None):
+    """
+    Load a .bson stream into the vCon collection without decoding documents.
+
+    Args:
+        fileobj: Binary file object positioned at the start of a .bson dump
+        metadata: Optional parsed .metadata.json; its indexes are recreated
+        replace_existing: Upsert by _id. When False documents are inserted
+                          directly, which is faster but fails on duplicates
+        batch_size: Documents per bulk write
+        progress: Optional callback receiving the number of documents written so far
+
+    Returns:
+        The number of documents written
+    """
+    collection = get_raw_vcon_collection()
+    written = 0
+
+    def flush(batch):
+        if not batch:
+            return 0
+        if replace_existing:
+            collection.bulk_write([ReplaceOne({'_id': doc['_id']}, doc, upsert=True) for doc in batch], ordered=False)
+        else:
+            collection.insert_many(batch, ordered=False)
+        return len(batch)
+
+    batch = []
+    for document in iter_bson_documents(fileobj):
+        batch.append(document)
+        if len(batch) >= batch_size:
+            written += flush(batch)
+            batch = []
+            if progress:
+                progress(written)
+    written += flush(batch)
+
+    for index in (metadata or {}).get("indexes", []):
+        if index.get("name") == "_id_":
+            continue
+        options = {k: v for k, v in index.items() if k not in ("key", "v", "ns")}
+        collection.create_index(list(index["key"].items()), **options)
+    return written
+
+def load_bson_metadata(path):
+    """Read a mongodump .metadata.json file."""
+    with open(path) as f:
+        return json_util.loads(f.read())
+
+# Cache of workbench completions, keyed by a hash of the prompt inputs (see lib/llm.py)
+def get_llm_cache_collection():
+    """Get the collection caching LLM completions."""
+    db = get_vcon_db()
+    collection_name = st.secrets["mongo_db"].get("llm_cache_collection", "llm_cache")
+    return db[collection_name]
+
+@mongo_error_handler
+def ensure_llm_cache_indexes(ttl_seconds):
+    """Create the TTL and LRU indexes of the completion cache, updating the TTL if it changed."""
+    collection = get_llm_cache_collection()
+    collection.create_index([("last_used_at", pymongo.ASCENDING)])
+    try:
+        collection.create_index([("created_at", pymongo.ASCENDING)], name="ttl", expireAfterSeconds=ttl_seconds)
+    except pymongo.errors.OperationFailure:
+        collection.database.command("collMod", collection.name, index={"name": "ttl", "expireAfterSeconds": ttl_seconds})
+
+@mongo_error_handler
+def get_cached_completions(keys):
+    """
+    Look up cached completions in one round trip and mark them as recently used.
+
+    Returns:
+        Dictionary of {key: cache document} for the keys that were found
+    """
+    collection = get_llm_cache_collection()
+    hits = {doc["_id"]: doc for doc in collection.find({"_id": {"$in": list(keys)}})}
+    if hits:
+        collection.update_many({"_id": {"$in": list(hits)}}, {"$set": {"last_used_at": datetime.now(timezone.utc)}})
+    return hits
+
+@mongo_error_handler
+def put_cached_completion(key, model, content, usage=None):
+    """Store a completion in the cache."""
+    collection = get_llm_cache_collection()
+    now = datetime.now(timezone.utc)
+    collection.replace_one({"_id": key}, {
+        "model": model,
+        "content": content,
+        "usage": usage,
+        "created_at": now,
+        "last_used_at": now,
+    }, upsert=True)
+
+@mongo_error_handler
+def trim_llm_cache(max_entries):
+    """Evict the least recently used completions beyond max_entries."""
+    collection = get_llm_cache_collection()
+    excess = collection.estimated_document_count() - max_entries
+    if excess > 0:
+        oldest = [doc["_id"] for doc in collection.find({}, {"_id": 1}).sort("last_used_at", pymongo.ASCENDING).limit(excess)]
+        collection.delete_many({"_id": {"$in": oldest}})
+
+# OpenAI batches submitted from the workbench
+def get_llm_batch_collection():
+    """Get the collection tracking workbench Batch API jobs."""
+    db = get_vcon_db()
+    collection_name = st.secrets["mongo_db"].get("llm_batch_collection", "llm_batches")
+    return db[collection_name]
+
+@mongo_error_handler
+def save_llm_batch(batch_id, prompt, cache_keys, status, dialogs=None):
+    """
+    Record a submitted batch.
+
+    Args:
+        batch_id: The OpenAI batch id
+        prompt: Dictionary of the prompt settings used
+        cache_keys: Dictionary of {vCon uuid: completion cache key} for the vCons in the batch
+        status: The batch status reported by OpenAI
+        dialogs: Optional dictionary of {vCon uuid: dialog indexes the input covers}
+    """
+    now = datetime.now(timezone.utc)
+    get_llm_batch_collection().replace_one({"_id": batch_id}, {
+        "prompt": prompt,
+        "cache_keys": cache_keys,
+        "dialogs": dialogs or {},
+        "status": status,
+        "results_fetched": False,
+        "created_at": now,
+        "updated_at": now,
+    }, upsert=True)
+
+@mongo_error_handler
+def update_llm_batch(batch_id, fields):
+    """Update the tracked state of a batch."""
+    get_llm_batch_collection().update_one(
+        {"_id": batch_id},
+        {"$set": dict(fields, updated_at=datetime.now(timezone.utc))},
+    )
+
+@mongo_error_handler
+def list_llm_batches(limit=20):
+    """List the most recent batches, newest first."""
+    return list(get_llm_batch_collection().find().sort("created_at", pymongo.DESCENDING).limit(limit))
+
+# Embeddings cached by model, dimensions and text hash
+def get_embedding_cache_collection():
+    """Get the collection caching embedding vectors."""
+    db = get_vcon_db()
+    collection_name = st.secrets["mongo_db"].get("embedding_cache_collection", "embedding_cache")
+    return db[collection_name]
+
+@mongo_error_handler
+def get_cached_embeddings(keys):
+    """
+    Look up cached embeddings in one round trip.
+
+    Returns:
+        Dictionary of {key: packed float32 vector bytes} for the keys that were found
+    """
+    cursor = get_embedding_cache_collection().find({"_id": {"$in": list(keys)}}, {"vector": 1})
+    return {doc["_id"]: bytes(doc["vector"]) for doc in cursor}
+
+@mongo_error_handler
+def put_cached_embeddings(entries):
+    """
+    Store embeddings in the cache.
+
+    Args:
+        entries: Iterable of (key, model, dimensions, packed float32 vector bytes) tuples
+    """
+    now = datetime.now(timezone.utc)
+    operations = [
+        UpdateOne({"_id": key}, {"$setOnInsert": {
+            "model": model,
+            "dimensions": dimensions,
+            "vector": vector,
+            "created_at": now,
+        }}, upsert=True)
+        for key, model, dimensions, vector in entries
+    ]
+    if operations:
+        get_embedding_cache_collection().bulk_write(operations, ordered=False)
+
+# Manifest of vCons synced into OpenAI vector stores
+def get_openai_sync_collection():
+    """Get the collection mapping synced vCons to their OpenAI files."""
+    db = get_vcon_db()
+    collection_name = st.secrets["mongo_db"].get("openai_sync_collection", "openai_sync")
+    return db[collection_name]
+
+@mongo_error_handler
+def get_openai_sync_manifest(vector_store_id):
+    """
+    Get what has been synced into a vector store.
+
+    Returns:
+        Dictionary of {vCon uuid: {"content_hash", "file_id"}}
+    """
+    cursor = get_openai_sync_collection().find(
+        {"vector_store_id": vector_store_id},
+        {"_id": 0, "uuid": 1, "content_hash": 1, "file_id": 1},
+    )
+    return {doc["uuid"]: doc for doc in cursor}
+
+@mongo_error_handler
+def save_openai_sync_entries(vector_store_id, entries):
+    """
+    Record synced vCons, replacing any earlier entry for the same uuid and store.
+
+    Args:
+        vector_store_id: The vector store the files were attached to
+        entries: Iterable of (uuid, content hash, file id) tuples
+    """
+    now = datetime.now(timezone.utc)
+    operations = [
+        ReplaceOne({"_id": f"{vector_store_id}:{uuid}"}, {
+            "vector_store_id": vector_store_id,
+            "uuid": uuid,
+            "content_hash": content_hash,
+            "file_id": file_id,
+            "synced_at": now,
+        }, upsert=True)
+        for uuid, content_hash, file_id in entries
+    ]
+    if operations:
+        get_openai_sync_collection().bulk_write(operations, ordered=False)
+
+@mongo_error_handler
+def remove_openai_sync_entries(vector_store_id, uuids):
+    """Forget synced vCons, e.g. after their files were deleted."""
+    get_openai_sync_collection().delete_many({"_id": {"$in": [f"{vector_store_id}:{uuid}" for uuid in uuids]}})
+
+@mongo_error_handler
+def ensure_openai_sync_indexes():
+    """Create the index used to load a vector store's manifest."""
+    get_openai_sync_collection().create_index([("vector_store_id", pymongo.ASCENDING)])
+
+# Background job queue, shared by the admin pages and the headless workers in lib/worker.py
+JOB_QUEUED = "queued"
+JOB_RUNNING = "running"
+JOB_DONE = "done"
+JOB_FAILED = "failed"
+
+def get_jobs_collection():
+    """Get the background job collection."""
+    db = get_vcon_db()
+    collection_name = st.secrets["mongo_db"].get("jobs_collection", "jobs")
+    return db[collection_name]
+
+def uuid_ranges(shards):
+    """
+    Split the uuid keyspace into contiguous ranges on the leading hex digits.
+
+    Args:
+        shards: Number of ranges to produce
+
+    Returns:
+        List of (lower, upper) tuples, where None means unbounded
+    """
+    shards = max(1, int(shards))
+    bounds = [None] + [format(i * 0x10000 // shards, "04x") for i in range(1, shards)] + [None]
+    return list(zip(bounds[:-1], bounds[1:]))
+
+def uuid_range_query(lower=None, upper=None):
+    """Build a MongoDB filter selecting vCons with lower <= uuid < upper."""
+    condition = {}
+    if lower:
+        condition['$gte'] = lower
+    if upper:
+        condition['$lt'] = upper
+    return {'uuid': condition} if condition else {}
+
+@mongo_error_handler
+def enqueue_job(job_type, params=None, max_attempts=3):
+    """
+    Add a job to the shared queue.
+
+    Args:
+        job_type: Name of a handler registered in lib/worker.py
+        params: Dictionary of handler parameters
+        max_attempts: How many times the job may be claimed before it is marked failed
+
+    Returns:
+        The id of the new job
+    """
+    collection = get_jobs_collection()
+    now = datetime.now(timezone.utc)
+    result = collection.insert_one({
+        "type": job_type,
+        "params": params or {},
+        "status": JOB_QUEUED,
+        "attempts": 0,
+        "max_attempts": max_attempts,
+        "lease_owner": None,
+        "lease_expires_at": None,
+        "created_at": now,
+        "updated_at": now,
+    })
+    return result.inserted_id
+
+def enqueue_sharded_jobs(job_type, params=None, shards=1, max_attempts=3):
+    """Enqueue one job per uuid range so several workers can split the collection."""
+    job_ids = []
+    for lower, upper in uuid_ranges(shards):
+        shard_params = dict(params or {}, uuid_lower=lower, uuid_upper=upper)
+        job_ids.append(enqueue_job(job_type, shard_params, max_attempts=max_attempts))
+    return job_ids
+
+@mongo_error_handler
+def claim_job(worker_id, job_types=None, lease_seconds=300):
+    """
+    Atomically claim the oldest runnable job.
+
+    A job is runnable when it is queued, or when it is running but its lease has
+    expired because the worker holding it stopped renewing it. Expired jobs that
+    have used up their attempts, e.g. because they crash their worker every
+    time, are marked failed instead.
+
+    Args:
+        worker_id: Identifier of the claiming worker
+        job_types: Optional list of job types this worker can handle
+        lease_seconds: How long the claim is valid without renewal
+
+    Returns:
+        The claimed job document or None if nothing is runnable
+    """
+    collection = get_jobs_collection()
+    now = datetime.now(timezone.utc)
+    attempts_left = {"$lt": ["$attempts", {"$ifNull": ["$max_attempts", 1]}]}
+    collection.update_many(
+        {"status": JOB_RUNNING, "lease_expires_at": {"$lt": now}, "$expr": {"$not": [attempts_left]}},
+        {"$set": {
+            "status": JOB_FAILED,
+            "error": "Lease expired on the last attempt",
+            "lease_owner": None,
+            "lease_expires_at": None,
+            "updated_at": now,
+        }},
+    )
+    query = {
+        "$or": [
+            {"status": JOB_QUEUED},
+            {"status": JOB_RUNNING, "lease_expires_at": {"$lt": now}, "$expr": attempts_left},
+        ]
+    }
+    if job_types:
+        query["type"] = {"$in": list(job_types)}
+    return collection.find_one_and_update(
+        query,
+        {
+            "$set": {
+                "status": JOB_RUNNING,
+                "lease_owner": worker_id,
+                "lease_expires_at": now + timedelta(seconds=lease_seconds),
+                "updated_at": now,
+            },
+            "$inc": {"attempts": 1},
+        },
+        sort=[("created_at", pymongo.ASCENDING)],
+        return_document=pymongo.ReturnDocument.AFTER,
+    )
+
+@mongo_error_handler
+def renew_job_lease(job_id, worker_id, lease_seconds=300):
+    """Extend the lease on a job. Returns False if the worker no longer holds it."""
+    collection = get_jobs_collection()
+    now = datetime.now(timezone.utc)
+    result = collection.update_one(
+        {"_id": job_id, "lease_owner": worker_id, "status": JOB_RUNNING},
+        {"$set": {"lease_expires_at": now + timedelta(seconds=lease_seconds), "updated_at": now}},
+    )
+    return result.matched_count == 1
+
+@mongo_error_handler
+def complete_job(job_id, worker_id, result=None):
+    """Mark a job as done."""
+    collection = get_jobs_collection()
+    collection.update_one(
+        {"_id": job_id, "lease_owner": worker_id},
+        {"$set": {
+            "status": JOB_DONE,
+            "result": result,
+            "lease_expires_at": None,
+            "updated_at": datetime.now(timezone.utc),
+        }},
+    )
+
+@mongo_error_handler
+def fail_job(job_id, worker_id, error):
+    """Return a job to the queue, or mark it failed once it is out of attempts."""
+    collection = get_jobs_collection()
+    job = collection.find_one({"_id": job_id, "lease_owner": worker_id})
+    if not job:
+        return
+    status = JOB_FAILED if job.get("attempts", 0) >= job.get("max_attempts", 1) else JOB_QUEUED
+    collection.update_one(
+        {"_id": job_id, "lease_owner": worker_id},
+        {"$set": {
+            "status": status,
+            "error": str(error),
+            "lease_owner": None,
+            "lease_expires_at": None,
+            "updated_at": datetime.now(timezone.utc),
+        }},
+    )
+
+@mongo_error_handler
+def list_jobs(limit=100):
+    """List the most recent jobs, newest first."""
+    collection = get_jobs_collection()
+    return list(collection.find().sort("created_at", pymongo.DESCENDING).limit(limit))
+
+@mongo_error_handler
+def ensure_job_indexes():
+    """Create the indexes the job queue relies on for claiming."""
+    collection = get_jobs_collection()
+    collection.create_index([("status", pymongo.ASCENDING), ("type", pymongo.ASCENDING), ("created_at", pymongo.ASCENDING)])
+    collection.create_index([("status", pymongo.ASCENDING), ("lease_expires_at", pymongo.ASCENDING)])
+
 # Function to initialize the Elasticsearch connection
 def get_es_client():
     url = st.secrets["elasticsearch"]["url"]
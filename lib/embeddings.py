@@ -0,0 +1,353 @@
+"""
+Batched OpenAI embeddings for the Milvus loader.
+
+The embeddings endpoint takes up to 2048 inputs per request, so texts are
+grouped into batches bounded by both input count and tokens, and the vectors
+are mapped back to their texts by index. A batch rejected because of one bad
+input is split in half until the bad input is isolated, so one vCon cannot
+fail the rest of its batch.
+
+Vectors are also kept in MongoDB, keyed by model, dimensions and the sha256
+of the text and stored as packed float32, so re-creating a collection or
+re-running a load only pays for text that was never embedded before.
+
+Bulk loads run as a pipeline of a reader, several rate-limited embedding
+workers and an inserter, connected by bounded queues, so reading, the
+embedding API and the vector store all stay busy at the same time.
+"""
+import asyncio
+import hashlib
+import logging
+import time
+from array import array
+
+import openai
+
+import lib.common as common
+import lib.llm as llm
+
+logger = logging.getLogger("vcon-admin")
+
+EMBEDDING_MODEL = "text-embedding-3-small"
+EMBEDDING_DIM = 1536
+MAX_BATCH_INPUTS = 2048
+MAX_BATCH_TOKENS = 300000
+MAX_INPUT_TOKENS = 8191
+
+
+def embedding_cache_key(text, model=EMBEDDING_MODEL, dimensions=None):
+    digest = hashlib.sha256(text.encode("utf-8")).hexdigest()
+    return f"{model}:{dimensions or 'default'}:{digest}"
+
+
+def pack_vector(vector):
+    """Encode a vector as float32 bytes, a quarter of the size of a JSON list."""
+    return array("f", vector).tobytes()
+
+
+def unpack_vector(data):
+    return array("f", data).tolist()
+
+
+def _truncate(text, max_tokens, model):
+    tokens = llm.count_tokens(text, model)
+    while tokens > max_tokens:
+        text = text[:len(text) * max_tokens // tokens - 1]
+        tokens = llm.count_tokens(text, model)
+    return text, tokens
+
+
+def truncate_text(text, max_tokens=MAX_INPUT_TOKENS, model=EMBEDDING_MODEL):
+    """Shorten text to fit in a single embedding input."""
+    return _truncate(text, max_tokens, model)[0]
+
+
+def batch_texts(texts, max_inputs=MAX_BATCH_INPUTS, max_tokens=MAX_BATCH_TOKENS, model=EMBEDDING_MODEL, token_counts=None):
+    """
+    Group texts into request-sized batches.
+
+    Args:
+        token_counts: Optional token count of each text, if already known
+
+    Returns:
+        A list of (batch, tokens in the batch) tuples, each batch a list of indexes into texts
+    """
+    batches = []
+    batch = []
+    batch_tokens = 0
+    for index, text in enumerate(texts):
+        tokens = token_counts[index] if token_counts is not None else llm.count_tokens(text, model)
+        if batch and (len(batch) >= max_inputs or batch_tokens + tokens > max_tokens):
+            batches.append((batch, batch_tokens))
+            batch, batch_tokens = [], 0
+        batch.append(index)
+        batch_tokens += tokens
+    if batch:
+        batches.append((batch, batch_tokens))
+    return batches
+
+
+def embed_batch(client, texts, model=EMBEDDING_MODEL, dimensions=None, max_retries=5):
+    """
+    Embed a list of texts in one request, retrying rate limits and transient errors.
+
+    Returns:
+        The vectors, in the order of texts
+    """
+    kwargs = {"input": texts, "model": model}
+    if dimensions:
+        kwargs["dimensions"] = dimensions
+    for attempt in range(max_retries + 1):
+        try:
+            response = client.embeddings.create(**kwargs)
+            break
+        except llm.RETRYABLE_ERRORS as e:
+            if attempt == max_retries:
+                raise
+            time.sleep(llm.backoff_delay(attempt, e))
+    # Items carry the index of their input; do not rely on response order
+    vectors = [None] * len(texts)
+    for item in response.data:
+        vectors[item.index] = item.embedding
+    return vectors
+
+
+def _embed_or_split(client, texts, model, dimensions, max_retries):
+    try:
+        return embed_batch(client, texts, model, dimensions, max_retries)
+    except openai.BadRequestError as e:
+        if len(texts) == 1:
+            logger.error(f"Embedding input rejected: {str(e)}")
+            return [None]
+        middle = len(texts) // 2
+        return (_embed_or_split(client, texts[:middle], model, dimensions, max_retries)
+                + _embed_or_split(client, texts[middle:], model, dimensions, max_retries))
+
+
+def embed_texts(client, texts, model=EMBEDDING_MODEL, dimensions=None, max_retries=5, use_cache=True, progress=None,
+                throttle=None):
+    """
+    Embed many texts with as few requests as possible.
+
+    Empty texts get a zero vector and cached texts their stored vector,
+    without a request. Texts longer than an embedding input allows are
+    truncated.
+
+    Args:
+        client: The OpenAI client
+        texts: The texts to embed
+        model: The embedding model
+        dimensions: Optional output dimensions, for models that support shortening
+        max_retries: Retries per request on rate limits and transient errors
+        use_cache: Look up and store vectors in the MongoDB embedding cache
+        progress: Optional callback receiving (texts embedded, total texts)
+        throttle: Optional callback receiving (requests, tokens) before each request,
+                  which blocks until a rate limit allows them; cached and empty texts
+                  are never charged
+
+    Returns:
+        A list parallel to texts holding each vector, or None where embedding failed
+    """
+    size = dimensions or EMBEDDING_DIM
+    vectors = [None] * len(texts)
+    pending = []
+    for index, text in enumerate(texts):
+        if text:
+            pending.append(index)
+        else:
+            vectors[index] = [0.0] * size
+    # Each text is tokenized once here; batching reuses the counts
+    inputs, token_counts = [], []
+    for index in pending:
+        text, tokens = _truncate(texts[index], MAX_INPUT_TOKENS, model)
+        inputs.append(text)
+        token_counts.append(tokens)
+
+    if use_cache and inputs:
+        keys = [embedding_cache_key(text, model, dimensions) for text in inputs]
+        cached = common.get_cached_embeddings(keys) or {}
+        missing = [i for i, key in enumerate(keys) if key not in cached]
+        for i, key in enumerate(keys):
+            if key in cached:
+                vectors[pending[i]] = unpack_vector(cached[key])
+        pending = [pending[i] for i in missing]
+        inputs = [inputs[i] for i in missing]
+        token_counts = [token_counts[i] for i in missing]
+
+    done = len(texts) - len(pending)
+    for batch, batch_tokens in batch_texts(inputs, model=model, token_counts=token_counts):
+        if throttle:
+            throttle(1, batch_tokens)
+        try:
+            results = _embed_or_split(client, [inputs[i] for i in batch], model, dimensions, max_retries)
+        except Exception as e:
+            logger.error(f"Embedding batch of {len(batch)} texts failed: {str(e)}")
+            results = [None] * len(batch)
+        for i, vector in zip(batch, results):
+            vectors[pending[i]] = vector
+        if use_cache:
+            common.put_cached_embeddings([
+                (embedding_cache_key(inputs[i], model, dimensions), model, dimensions, pack_vector(vector))
+                for i, vector in zip(batch, results) if vector is not None
+            ])
+        done += len(batch)
+        if progress:
+            progress(done, len(texts))
+    return vectors
+
+
+class StageMetrics:
+    """Items handled and time spent busy by one pipeline stage."""
+
+    def __init__(self, name):
+        self.name = name
+        self.items = 0
+        self.failed = 0
+        self.busy_seconds = 0.0
+        self.started = time.monotonic()
+
+    def record(self, items, seconds, failed=0):
+        self.items += items
+        self.failed += failed
+        self.busy_seconds += seconds
+
+    @property
+    def rate(self):
+        """Items per second of wall-clock time since the pipeline started."""
+        elapsed = time.monotonic() - self.started
+        return self.items / elapsed if elapsed else 0.0
+
+    def as_dict(self):
+        return {
+            "stage": self.name,
+            "items": self.items,
+            "failed": self.failed,
+            "per_second": round(self.rate, 1),
+            "busy_seconds": round(self.busy_seconds, 1),
+        }
+
+
+def _next_batch(iterator, size):
+    batch = []
+    for item in iterator:
+        batch.append(item)
+        if len(batch) >= size:
+            break
+    return batch
+
+
+def _prepare_batch(prepare, batch):
+    prepared = []
+    failed = 0
+    for item in batch:
+        try:
+            prepared.append(prepare(item))
+        except Exception as e:
+            logger.error(f"Could not prepare item for embedding: {str(e)}")
+            failed += 1
+    return prepared, failed
+
+
+async def _run_pipeline(client, source, prepare, insert, batch_size, workers, queue_size, model, dimensions,
+                        expected_dim, requests_per_minute, tokens_per_minute, progress):
+    metrics = {name: StageMetrics(name) for name in ("read", "embed", "insert")}
+    embed_queue = asyncio.Queue(maxsize=queue_size)
+    insert_queue = asyncio.Queue(maxsize=queue_size)
+    request_limiter = llm.RateLimiter(requests_per_minute)
+    token_limiter = llm.RateLimiter(tokens_per_minute)
+    iterator = iter(source)
+
+    async def read():
+        while True:
+            started = time.monotonic()
+            # The cursor blocks, so it is read on a worker thread
+            batch = await asyncio.to_thread(_next_batch, iterator, batch_size)
+            metrics["read"].record(len(batch), time.monotonic() - started)
+            if not batch:
+                break
+            await embed_queue.put(batch)
+        for _ in range(workers):
+            await embed_queue.put(None)
+
+    loop = asyncio.get_running_loop()
+
+    def throttle(requests, tokens):
+        # Called by embed_texts on a worker thread, for the requests it actually sends
+        asyncio.run_coroutine_threadsafe(request_limiter.acquire(requests), loop).result()
+        asyncio.run_coroutine_threadsafe(token_limiter.acquire(tokens), loop).result()
+
+    async def embed():
+        while (batch := await embed_queue.get()) is not None:
+            started = time.monotonic()
+            prepared, failed = await asyncio.to_thread(_prepare_batch, prepare, batch)
+            texts = [str(text or "") for text, _ in prepared]
+            vectors = await asyncio.to_thread(embed_texts, client, texts, model, dimensions, throttle=throttle)
+            rows = []
+            for (_, row), vector in zip(prepared, vectors):
+                if vector is None:
+                    failed += 1
+                elif expected_dim and len(vector) != expected_dim:
+                    logger.error(f"Embedding has {len(vector)} dimensions, expected {expected_dim}")
+                    failed += 1
+                else:
+                    rows.append(dict(row, embedding=vector))
+            metrics["embed"].record(len(rows), time.monotonic() - started, failed)
+            await insert_queue.put(rows)
+        await insert_queue.put(None)
+
+    async def write():
+        finished = 0
+        while finished < workers:
+            rows = await insert_queue.get()
+            if rows is None:
+                finished += 1
+                continue
+            if not rows:
+                continue
+            started = time.monotonic()
+            try:
+                await asyncio.to_thread(insert, rows)
+                metrics["insert"].record(len(rows), time.monotonic() - started)
+            except Exception as e:
+                logger.error(f"Inserting {len(rows)} rows failed: {str(e)}")
+                metrics["insert"].record(0, time.monotonic() - started, len(rows))
+            if progress:
+                progress({name: stage.as_dict() for name, stage in metrics.items()})
+
+    await asyncio.gather(read(), write(), *[embed() for _ in range(workers)])
+    return {name: stage.as_dict() for name, stage in metrics.items()}
+
+
+def run_embedding_pipeline(client, source, prepare, insert, batch_size=500, workers=4, queue_size=4,
+                           model=EMBEDDING_MODEL, dimensions=None, expected_dim=None, requests_per_minute=None,
+                           tokens_per_minute=None, progress=None):
+    """
+    Embed and insert a stream of items with every stage running concurrently.
+
+    A reader pulls batches from source, embedding workers turn each batch into
+    rows with vectors, and an inserter writes the rows. The queues between the
+    stages hold at most queue_size batches, so a slow stage holds back the
+    ones before it instead of letting batches pile up in memory.
+
+    Args:
+        client: The OpenAI client
+        source: Iterable of items, e.g. a MongoDB cursor; read on a worker thread
+        prepare: Called with an item, returns (text to embed, row without its "embedding")
+        insert: Called with a list of rows, e.g. a Milvus collection's insert
+        batch_size: Items per batch
+        workers: Number of concurrent embedding workers
+        queue_size: Batches each queue may hold
+        model: The embedding model
+        dimensions: Optional output dimensions
+        expected_dim: Optional vector length the rows must have, e.g. the collection's dim;
+                      items with other lengths count as failed
+        requests_per_minute: Optional limit on embedding requests
+        tokens_per_minute: Optional limit on embedded tokens
+        progress: Optional callback receiving the metrics after every insert
+
+    Returns:
+        Dictionary of {stage: {"stage", "items", "failed", "per_second", "busy_seconds"}}
+        for the read, embed and insert stages
+    """
+    return asyncio.run(_run_pipeline(client, source, prepare, insert, batch_size, workers, queue_size, model,
+                                     dimensions, expected_dim, requests_per_minute, tokens_per_minute, progress))
@@ -0,0 +1,125 @@
+"""
+Paginated, truncated JSON viewer for very large vCons.
+
+st.json ships the whole document to the browser, which freezes on vCons with
+hundreds of dialog entries or multi-megabyte transcripts. json_viewer only
+sends the visible page of an array, cuts long strings down to a preview and
+lets the user expand a single value on demand.
+"""
+import json
+import streamlit as st
+import pandas as pd
+
+
+def value_size(value):
+    """Size in bytes of a value serialized as JSON."""
+    return len(json.dumps(value, default=str).encode("utf-8"))
+
+
+def format_size(size):
+    for unit in ["B", "KB", "MB"]:
+        if size < 1024:
+            return f"{size:.0f} {unit}" if unit == "B" else f"{size:.1f} {unit}"
+        size /= 1024
+    return f"{size:.1f} GB"
+
+
+def truncate_value(value, max_string=500, max_items=20, path="", truncated=None):
+    """
+    Copy a JSON value, shortening long strings and long arrays.
+
+    Args:
+        value: The value to copy
+        max_string: Strings longer than this are cut to this many characters
+        max_items: Nested arrays longer than this are cut to this many items
+        path: Path of value within the document, used to name truncated strings
+        truncated: Dictionary collecting {path: full string} for every cut string
+
+    Returns:
+        The truncated copy
+    """
+    if truncated is None:
+        truncated = {}
+    if isinstance(value, str):
+        if len(value) > max_string:
+            truncated[path] = value
+            return f"{value[:max_string]}… [+{len(value) - max_string} chars]"
+        return value
+    if isinstance(value, dict):
+        return {
+            key: truncate_value(item, max_string, max_items, f"{path}.{key}" if path else str(key), truncated)
+            for key, item in value.items()
+        }
+    if isinstance(value, list):
+        items = [
+            truncate_value(item, max_string, max_items, f"{path}[{index}]", truncated)
+            for index, item in enumerate(value[:max_items])
+        ]
+        if len(value) > max_items:
+            items.append(f"… [+{len(value) - max_items} items]")
+        return items
+    if value is None or isinstance(value, (int, float, bool)):
+        return value
+    return str(value)
+
+
+def show_size_breakdown(sizes):
+    """Show a table of bytes per top-level key, largest first."""
+    total = sum(sizes.values()) or 1
+    rows = [
+        {"Key": key, "Size": format_size(size), "Share": f"{size / total:.0%}"}
+        for key, size in sorted(sizes.items(), key=lambda item: item[1], reverse=True)
+    ]
+    st.dataframe(pd.DataFrame(rows), hide_index=True, use_container_width=True)
+
+
+def json_viewer(data, key, page_size=10, max_string=500, sizes=None):
+    """
+    Render a JSON value one page at a time.
+
+    Args:
+        data: The value to display
+        key: Unique widget key prefix
+        page_size: Number of array items per page
+        max_string: Strings longer than this are truncated until expanded
+        sizes: Optional {top-level key: bytes} breakdown; computed from data for dicts if omitted
+    """
+    if isinstance(data, dict):
+        with st.expander("SIZE BREAKDOWN"):
+            show_size_breakdown(sizes or {k: value_size(v) for k, v in data.items()})
+
+        # Large arrays inside the document can be paged through on their own
+        arrays = [k for k, v in data.items() if isinstance(v, list) and len(v) > page_size]
+        if arrays:
+            browse = st.selectbox("PAGE THROUGH", ["(whole document)"] + arrays, key=f"{key}_browse")
+            if browse != "(whole document)":
+                json_viewer(data[browse], key=f"{key}_{browse}", page_size=page_size, max_string=max_string)
+                return
+        offset = 0
+        visible = data
+    elif isinstance(data, list):
+        pages = max(1, -(-len(data) // page_size))
+        page = 1
+        if pages > 1:
+            page = st.number_input(f"PAGE (OF {pages}, {len(data)} ITEMS)", min_value=1, max_value=pages, value=1, key=f"{key}_page")
+        offset = (page - 1) * page_size
+        visible = data[offset:offset + page_size]
+    else:
+        offset = 0
+        visible = data
+
+    truncated = {}
+    if isinstance(visible, list):
+        # Keep the real indexes in the paths so they match the source array
+        shown = [
+            truncate_value(item, max_string, page_size, f"[{offset + index}]", truncated)
+            for index, item in enumerate(visible)
+        ]
+    else:
+        shown = truncate_value(visible, max_string, page_size, "", truncated)
+    st.json(shown)
+
+    if truncated:
+        expand = st.selectbox("EXPAND A TRUNCATED VALUE", ["(none)"] + list(truncated), key=f"{key}_expand")
+        if expand != "(none)":
+            st.text_area(expand, truncated[expand], height=300, disabled=True, key=f"{key}_expanded_{expand}")
@@ -0,0 +1,464 @@
+"""
+OpenAI helpers for the workbench.
+
+Completions are run concurrently on an asyncio loop, limited by token buckets
+on requests and tokens per minute, and retried with jittered exponential
+backoff on rate limits and transient errors. Large runs can instead go
+through the Batch API, with results streamed back from the output file.
+
+Set base_url in the [openai] section of secrets.toml (or OPENAI_BASE_URL in the
+environment) to run against a local mock of the OpenAI API.
+"""
+import asyncio
+import functools
+import hashlib
+import json
+import random
+import time
+from datetime import datetime, timezone
+
+import openai
+import streamlit as st
+from openai import AsyncOpenAI, OpenAI
+
+try:
+    import tiktoken
+except ImportError:
+    tiktoken = None
+
+# Rough characters-per-token ratio, used when tiktoken is not installed
+CHARS_PER_TOKEN = 4
+BINARY_ENCODINGS = ("base64", "base64url")
+REDUCE_INSTRUCTION = (
+    "The conversation was too long to process at once, so it was split into parts "
+    "and the request above was answered for each part. Combine the answers below "
+    "into a single answer for the whole conversation."
+)
+RETRYABLE_ERRORS = (
+    openai.RateLimitError,
+    openai.APIConnectionError,
+    openai.APITimeoutError,
+    openai.InternalServerError,
+)
+
+
+def get_openai_settings():
+    settings = st.secrets["openai"]
+    return {
+        "api_key": settings["secret_key"],
+        "base_url": settings.get("base_url"),
+    }
+
+
+def get_openai_client():
+    """Synchronous OpenAI client for the workbench."""
+    return OpenAI(**get_openai_settings())
+
+
+# Account metadata changes rarely, but the pages read it on every rerun. The
+# leading underscore keeps Streamlit from hashing the client argument.
+OPENAI_METADATA_TTL = "5m"
+
+
+@st.cache_data(ttl=OPENAI_METADATA_TTL, show_spinner=False)
+def list_models(_client):
+    """Sorted ids of the models available to the account."""
+    return sorted(model.id for model in _client.models.list())
+
+
+@st.cache_data(ttl=OPENAI_METADATA_TTL, show_spinner=False)
+def list_vector_stores(_client):
+    return list(_client.beta.vector_stores.list().data)
+
+
+@st.cache_data(ttl=OPENAI_METADATA_TTL, show_spinner=False)
+def get_vector_store(_client, vector_store_id):
+    return _client.beta.vector_stores.retrieve(vector_store_id)
+
+
+@st.cache_data(ttl=OPENAI_METADATA_TTL, show_spinner=False)
+def list_assistants(_client):
+    return list(_client.beta.assistants.list().data)
+
+
+def clear_openai_metadata_cache():
+    """Drop the cached metadata, to be called after creating or deleting anything it lists."""
+    for cached in (list_models, list_vector_stores, get_vector_store, list_assistants):
+        cached.clear()
+
+
+def completion_cache_key(content, system_prompt, user_prompt, model, temperature):
+    """Hash of everything that determines a completion, used as the cache key."""
+    payload = json.dumps([content, system_prompt, user_prompt, model, round(float(temperature), 4)])
+    return hashlib.sha256(payload.encode("utf-8")).hexdigest()
+
+
+def build_analysis_entry(content, analysis_type, model, system_prompt, user_prompt, temperature, input_type,
+                         dialog=None, cache_key=None):
+    """
+    Turn a completion into a vCon analysis entry recording how it was produced.
+
+    dialog is the index, or list of indexes, of the dialogs the analysis is
+    about, as returned by analysis_dialog; it is left out if None. cache_key
+    is the completion cache key, kept so the same result is not saved twice.
+    """
+    entry = {
+        "type": analysis_type,
+        "vendor": "openai",
+        "product": model,
+        "encoding": "none",
+        "body": "\n\n".join(text for text in content if text),
+        "prompt": {
+            "system": system_prompt,
+            "user": user_prompt,
+            "temperature": temperature,
+            "input_type": input_type,
+            "cache_key": cache_key,
+        },
+        "created_at": datetime.now(timezone.utc).isoformat(),
+    }
+    if dialog is not None:
+        entry["dialog"] = dialog
+    return entry
+
+
+@functools.lru_cache(maxsize=None)
+def _get_encoding(model=None):
+    if tiktoken is None:
+        return None
+    try:
+        # encoding_for_model does not accept None, and raises KeyError for models it does not know
+        if model:
+            try:
+                return tiktoken.encoding_for_model(model)
+            except KeyError:
+                pass
+        return tiktoken.get_encoding("o200k_base")
+    except Exception:
+        # The encoding files are downloaded on first use, which fails offline; cached so it is only tried once
+        return None
+
+
+def count_tokens(text, model=None):
+    """Count the tokens in text with tiktoken, or estimate them if it is not installed or cannot load."""
+    encoding = _get_encoding(model)
+    if encoding is None:
+        return len(text) // CHARS_PER_TOKEN + 1
+    return len(encoding.encode(text, disallowed_special=()))
+
+
+def chunk_text(text, max_tokens, model=None):
+    """
+    Split text into pieces of at most max_tokens, breaking between lines where
+    possible so transcript turns stay whole.
+    """
+    chunks = []
+    current = []
+    current_tokens = 0
+    for line in text.splitlines(keepends=True):
+        line_tokens = count_tokens(line, model)
+        if line_tokens > max_tokens:
+            # A single line longer than a chunk is cut by characters
+            step = max(1, len(line) * max_tokens // line_tokens)
+            pieces = [line[i:i + step] for i in range(0, len(line), step)]
+        else:
+            pieces = [line]
+        for piece in pieces:
+            piece_tokens = count_tokens(piece, model) if len(pieces) > 1 else line_tokens
+            if current and current_tokens + piece_tokens > max_tokens:
+                chunks.append("".join(current))
+                current = []
+                current_tokens = 0
+            current.append(piece)
+            current_tokens += piece_tokens
+    if current:
+        chunks.append("".join(current))
+    return chunks
+
+
+def strip_binary_bodies(vcon):
+    """
+    Copy a vCon without base64 dialog and attachment bodies, leaving a note of what was removed.
+
+    Bodies the query already left on the server, see common.get_vcons_by_uuid,
+    get the same note from their body_length.
+    """
+    stripped = {k: v for k, v in vcon.items() if k != "_id"}
+    for section in ("dialog", "attachments"):
+        entries = []
+        for entry in vcon.get(section) or []:
+            mimetype = entry.get("mimetype") or entry.get("mime_type") or ""
+            body = entry.get("body")
+            if "body_length" in entry and "body" not in entry:
+                length = entry["body_length"]
+                entry = {k: v for k, v in entry.items() if k != "body_length"}
+                entry["body"] = f"[{mimetype or 'binary'} body removed, {length} characters]"
+            elif isinstance(body, str) and (entry.get("encoding") in BINARY_ENCODINGS or mimetype.startswith(("audio/", "video/"))):
+                entry = dict(entry, body=f"[{mimetype or 'binary'} body removed, {len(body)} characters]")
+            entries.append(entry)
+        if section in vcon:
+            stripped[section] = entries
+    return stripped
+
+
+def get_analysis_body(vcon, analysis_type):
+    """Body of the first analysis entry of a type, as text."""
+    for analysis in (vcon or {}).get("analysis", []):
+        if analysis.get("type") == analysis_type:
+            body = analysis.get("body")
+            return body if isinstance(body, str) or body is None else json.dumps(body, default=str)
+    return None
+
+
+def prepare_content(vcon, input_type, exclude_analysis_type=None):
+    """
+    Build the text sent to the model for a vCon.
+
+    "complete" sends the vCon as JSON without binary bodies, updated_at or
+    analysis entries of exclude_analysis_type, so saving a result does not
+    change the input it was produced from; "summary" and "transcript" send
+    the body of that analysis entry.
+    """
+    if not vcon:
+        return None
+    if input_type == "complete":
+        vcon = {key: value for key, value in vcon.items() if key != "updated_at"}
+        if exclude_analysis_type and vcon.get("analysis"):
+            vcon["analysis"] = [a for a in vcon["analysis"] if a.get("type") != exclude_analysis_type]
+        return json.dumps(strip_binary_bodies(vcon), default=str)
+    return get_analysis_body(vcon, input_type)
+
+
+def analysis_dialog(vcon, input_type):
+    """
+    The dialogs an analysis of prepare_content's input covers: every dialog
+    index for "complete", or the dialog of the summary or transcript used.
+    """
+    if not vcon:
+        return None
+    if input_type == "complete":
+        return list(range(len(vcon.get("dialog") or [])))
+    for analysis in vcon.get("analysis", []):
+        if analysis.get("type") == input_type:
+            return analysis.get("dialog")
+    return None
+
+
+def estimate_tokens(messages, max_output_tokens=500, model=None):
+    """Estimate the tokens a chat completion will consume, prompt plus output."""
+    return sum(count_tokens(message.get("content") or "", model) for message in messages) + max_output_tokens
+
+
+class RateLimiter:
+    """
+    Token bucket allowing rate_per_minute units per minute, with bursts of up
+    to capacity. A rate of None or 0 disables the limit.
+    """
+
+    def __init__(self, rate_per_minute=None, capacity=None):
+        self.rate = (rate_per_minute or 0) / 60.0
+        self.capacity = capacity or rate_per_minute or 0
+        self.tokens = self.capacity
+        self.updated = time.monotonic()
+        self._lock = None
+
+    async def acquire(self, amount=1):
+        if not self.rate:
+            return
+        if self._lock is None:
+            self._lock = asyncio.Lock()
+        # A single request larger than the bucket is allowed once the bucket is full
+        amount = min(amount, self.capacity)
+        async with self._lock:
+            while True:
+                now = time.monotonic()
+                self.tokens = min(self.capacity, self.tokens + (now - self.updated) * self.rate)
+                self.updated = now
+                if self.tokens >= amount:
+                    self.tokens -= amount
+                    return
+                await asyncio.sleep((amount - self.tokens) / self.rate)
+
+
+def backoff_delay(attempt, error=None, base=1.0, cap=60.0):
+    """Full-jitter exponential backoff, honoring a Retry-After header when the server sends one."""
+    response = getattr(error, "response", None)
+    retry_after = response.headers.get("retry-after") if response is not None else None
+    if retry_after:
+        try:
+            return float(retry_after) + random.uniform(0, 1)
+        except ValueError:
+            pass
+    return random.uniform(0, min(cap, base * 2 ** attempt))
+
+
+async def _complete(client, request, semaphore, request_limiter, token_limiter, max_retries):
+    """Run one chat completion with rate limiting and retries."""
+    kwargs = {k: v for k, v in request.items() if k != "key"}
+    async with semaphore:
+        for attempt in range(max_retries + 1):
+            await request_limiter.acquire(1)
+            await token_limiter.acquire(estimate_tokens(kwargs["messages"], model=kwargs.get("model")))
+            try:
+                response = await client.chat.completions.create(**kwargs)
+                return {
+                    "key": request["key"],
+                    "content": [choice.message.content for choice in response.choices],
+                    "usage": response.usage.total_tokens if response.usage else None,
+                    "attempts": attempt + 1,
+                }
+            except RETRYABLE_ERRORS as e:
+                if attempt == max_retries:
+                    return {"key": request["key"], "error": e, "attempts": attempt + 1}
+                await asyncio.sleep(backoff_delay(attempt, e))
+            except openai.OpenAIError as e:
+                return {"key": request["key"], "error": e, "attempts": attempt + 1}
+
+
+async def _map_reduce(complete, request, max_chunk_tokens):
+    """
+    Answer a request whose content (the last message) may be too long.
+
+    Long content is split into chunks that are answered concurrently, then a
+    reduce request combines the partial answers.
+    """
+    content = request["messages"][-1]["content"]
+    model = request.get("model")
+    if not max_chunk_tokens or count_tokens(content, model) <= max_chunk_tokens:
+        return await complete(request)
+
+    chunks = chunk_text(content, max_chunk_tokens, model)
+    parts = await asyncio.gather(*[
+        complete(dict(request, key=(request["key"], index), messages=request["messages"][:-1] + [
+            dict(request["messages"][-1], content=f"[Part {index + 1} of {len(chunks)}]\n{chunk}")
+        ]))
+        for index, chunk in enumerate(chunks)
+    ])
+    failed = [part for part in parts if "error" in part]
+    if failed:
+        return {"key": request["key"], "error": failed[0]["error"], "attempts": failed[0]["attempts"], "chunks": len(chunks)}
+
+    partials = "\n\n".join(f"Part {index + 1}:\n{' '.join(part['content'])}" for index, part in enumerate(parts))
+    result = await complete(dict(request, messages=request["messages"][:-1] + [
+        {"role": "user", "content": f"{REDUCE_INSTRUCTION}\n\n{partials}"}
+    ]))
+    result["chunks"] = len(chunks)
+    if result.get("usage") is not None:
+        result["usage"] += sum(part.get("usage") or 0 for part in parts)
+    return result
+
+
+async def _run_completions(requests, on_result, concurrency, requests_per_minute, tokens_per_minute, max_retries, max_chunk_tokens):
+    semaphore = asyncio.Semaphore(concurrency)
+    request_limiter = RateLimiter(requests_per_minute)
+    token_limiter = RateLimiter(tokens_per_minute)
+    async with AsyncOpenAI(**get_openai_settings()) as client:
+        def complete(request):
+            return _complete(client, request, semaphore, request_limiter, token_limiter, max_retries)
+
+        tasks = [asyncio.create_task(_map_reduce(complete, request, max_chunk_tokens)) for request in requests]
+        for task in asyncio.as_completed(tasks):
+            on_result(await task)
+
+
+def run_completions(requests, on_result, concurrency=8, requests_per_minute=None, tokens_per_minute=None, max_retries=5,
+                    max_chunk_tokens=None):
+    """
+    Run many chat completions concurrently, calling on_result as each one finishes.
+
+    Args:
+        requests: List of chat.completions.create keyword arguments, each with an extra "key"
+                  identifying it in the results
+        on_result: Called on the calling thread with a dictionary holding key and either
+                   content (list of choice texts), usage and attempts, or error
+        concurrency: Maximum number of requests in flight
+        requests_per_minute: Optional request rate limit
+        tokens_per_minute: Optional estimated token rate limit
+        max_retries: Retries per request on rate limits and transient errors
+        max_chunk_tokens: If set, content (the last message) longer than this is split into
+                          chunks answered concurrently and combined by a reduce request
+    """
+    asyncio.run(_run_completions(requests, on_result, concurrency, requests_per_minute, tokens_per_minute, max_retries,
+                                 max_chunk_tokens))
+
+
+# OpenAI Batch API: half price, results within the completion window
+BATCH_ENDPOINT = "/v1/chat/completions"
+BATCH_MAX_REQUESTS = 50000
+# Input files may be up to 200 MB; stay clear of the limit
+BATCH_MAX_BYTES = 190 * 1024 * 1024
+
+
+def _batch_line(request):
+    body = {k: v for k, v in request.items() if k != "key"}
+    return (json.dumps({"custom_id": request["key"], "method": "POST", "url": BATCH_ENDPOINT, "body": body}) + "\n").encode("utf-8")
+
+
+def build_batch_file(requests):
+    """Encode completion requests as a Batch API JSONL input file, using each request's key as custom_id."""
+    return b"".join(_batch_line(request) for request in requests)
+
+
+def split_batch_files(requests, max_requests=BATCH_MAX_REQUESTS, max_bytes=BATCH_MAX_BYTES):
+    """
+    Encode requests as batch input files within both the request count and file size limits.
+
+    Yields:
+        (requests in the file, file bytes) for each file
+    """
+    chunk, lines, size = [], [], 0
+    for request in requests:
+        line = _batch_line(request)
+        if chunk and (len(chunk) >= max_requests or size + len(line) > max_bytes):
+            yield chunk, b"".join(lines)
+            chunk, lines, size = [], [], 0
+        chunk.append(request)
+        lines.append(line)
+        size += len(line)
+    if chunk:
+        yield chunk, b"".join(lines)
+
+
+def submit_batches(client, requests, metadata=None):
+    """
+    Upload requests as one or more batch input files and start a batch for each.
+
+    Returns:
+        List of (batch, keys in that batch) tuples
+    """
+    submitted = []
+    for number, (chunk, data) in enumerate(split_batch_files(requests)):
+        input_file = client.files.create(
+            file=(f"workbench-batch-{number}.jsonl", data),
+            purpose="batch",
+        )
+        batch = client.batches.create(
+            input_file_id=input_file.id,
+            endpoint=BATCH_ENDPOINT,
+            completion_window="24h",
+            metadata=metadata,
+        )
+        submitted.append((batch, [request["key"] for request in chunk]))
+    return submitted
+
+
+def iter_batch_results(client, file_id):
+    """
+    Stream a batch output (or error) file, yielding one result per line in the
+    same shape as run_completions results: key plus content, or key plus error.
+    """
+    with client.files.with_streaming_response.content(file_id) as response:
+        for line in response.iter_lines():
+            if not line.strip():
+                continue
+            row = json.loads(line)
+            key = row.get("custom_id")
+            body = (row.get("response") or {}).get("body") or {}
+            if row.get("error") or "choices" not in body:
+                yield {"key": key, "error": row.get("error") or body.get("error"), "attempts": 1}
+            else:
+                yield {
+                    "key": key,
+                    "content": [choice["message"]["content"] for choice in body["choices"]],
+                    "usage": (body.get("usage") or {}).get("total_tokens"),
+                }
@@ -0,0 +1,230 @@
+"""
+Milvus rows for vCons, shared by the Milvus page and the embed_milvus worker job.
+
+Each vCon becomes one row: the text that is embedded (transcript, summary,
+parties and metadata, or an AI description when it has neither a summary nor
+a transcript), a party identifier and a few metadata fields. Bulk loads flush
+every few batches, so a long load seals segments as it goes and a failure
+loses little.
+"""
+import logging
+import time
+
+import streamlit as st
+from pymilvus import connections
+
+import lib.embeddings as embeddings
+
+logger = logging.getLogger("milvus_vcon")
+
+# Inserted batches between flushes while loading
+FLUSH_EVERY_BATCHES = 20
+
+
+def connect():
+    """Connect to the Milvus server configured in the [milvus] section of secrets.toml."""
+    settings = st.secrets.get("milvus", {})
+    connections.connect(host=settings.get("host", "localhost"), port=settings.get("port", "19530"))
+
+
+def extract_text_from_vcon(client, vcon):
+    """Text to embed for a vCon, with an AI description if it has no summary or transcript."""
+    start_time = time.time()
+    vcon_id = vcon.get("uuid", "unknown")
+    logger.info(f"Processing vCon {vcon_id}")
+    
+    text = ""
+    extracted_components = []
+    has_transcript = False
+    has_summary = False
+    
+    # Extract transcript
+    if "transcript" in vcon:
+        transcript_length = len(vcon.get("transcript", []))
+        text += " ".join([item.get("text", "") for item in vcon.get("transcript", []) if "text" in item]) + " "
+        extracted_components.append(f"transcript ({transcript_length} entries)")
+        logger.debug(f"Extracted transcript with {transcript_length} entries from vCon {vcon_id}")
+        has_transcript = transcript_length > 0
+    
+    # Extract summary
+    if "summary" in vcon and vcon["summary"]:
+        text += vcon["summary"] + " "
+        extracted_components.append("summary")
+        logger.debug(f"Extracted summary from vCon {vcon_id}")
+        has_summary = True
+    
+    # Extract party information
+    party_count = 0
+    if "parties" in vcon and vcon["parties"]:
+        for party in vcon["parties"]:
+            party_name = party.get("name", "")
+            party_id = party.get("partyId", "")
+            if party_name or party_id:
+                text += f"Party: {party_name or party_id}. "
+                party_count += 1
+        extracted_components.append(f"parties ({party_count})")
+        logger.debug(f"Extracted {party_count} parties from vCon {vcon_id}")
+    
+    # Extract metadata if available
+    metadata_fields = []
+    if "metadata" in vcon:
+        # Add any important metadata fields
+        if "title" in vcon["metadata"]:
+            text += f"Title: {vcon['metadata']['title']}. "
+            metadata_fields.append("title")
+        if "description" in vcon["metadata"]:
+            text += f"Description: {vcon['metadata']['description']}. "
+            metadata_fields.append("description")
+        if "created" in vcon["metadata"]:
+            text += f"Created: {vcon['metadata']['created']}. "
+            metadata_fields.append("created")
+        
+        if metadata_fields:
+            extracted_components.append(f"metadata ({', '.join(metadata_fields)})")
+            logger.debug(f"Extracted metadata fields: {', '.join(metadata_fields)} from vCon {vcon_id}")
+    
+    raw_text = text.strip()
+    raw_text_length = len(raw_text)
+    
+    logger.info(f"Extracted components from vCon {vcon_id}: {', '.join(extracted_components)}")
+    logger.info(f"Raw text length: {raw_text_length} characters")
+    
+    # Generate AI description ONLY if there's no summary or transcript AND there's enough content
+    if not (has_summary or has_transcript) and len(raw_text) > 10:
+        logger.info(f"No summary or transcript found for vCon {vcon_id}, generating AI description")
+        try:
+            logger.info(f"Generating AI description for vCon {vcon_id}")
+            ai_start_time = time.time()
+            
+            response = client.chat.completions.create(
+                model="gpt-3.5-turbo",
+                messages=[
+                    {"role": "system", "content": "You are an assistant that creates concise descriptions of conversation content."},
+                    {"role": "user", "content": f"Generate a brief description (max 100 words) that summarizes this conversation content: {raw_text[:4000]}"}
+                ],
+                max_tokens=150,
+                temperature=0.5
+            )
+            
+            ai_description = response.choices[0].message.content.strip()
+            ai_time_taken = time.time() - ai_start_time
+            
+            logger.info(f"AI description generated in {ai_time_taken:.2f}s for vCon {vcon_id}")
+            final_text = f"{ai_description}\n\nRaw Content: {raw_text}"
+            
+            total_time = time.time() - start_time
+            logger.info(f"Total processing time for vCon {vcon_id}: {total_time:.2f}s")
+            return final_text
+        except Exception as e:
+            logger.error(f"Failed to generate AI description for vCon {vcon_id}: {str(e)}")
+            st.warning(f"Could not generate AI description: {e}")
+            return raw_text
+    elif has_summary or has_transcript:
+        logger.info(f"vCon {vcon_id} already has summary or transcript, skipping AI description generation")
+    
+    total_time = time.time() - start_time
+    logger.info(f"Total processing time for vCon {vcon_id}: {total_time:.2f}s")
+    return raw_text
+
+
+def extract_party_id(vcon):
+    """Extract a meaningful party identifier from a vCon based on standard vCon structure"""
+    logger.debug(f"Extracting party ID from vCon {vcon.get('uuid', 'unknown')}")
+    
+    if not vcon.get("parties"):
+        logger.debug("No parties array found in vCon")
+        # Try alternative fields if parties is not available
+        if vcon.get("metadata", {}).get("creator"):
+            return vcon["metadata"]["creator"]
+        return "no_party_info"
+    
+    # Try to find a non-empty party ID from any party in the array
+    for party in vcon["parties"]:
+        # First priority: UUID as it's unique
+        if party.get("uuid"):
+            logger.debug(f"Using party UUID: {party['uuid']}")
+            return party["uuid"]
+        
+        # Second priority: Contact methods (tel, mailto)
+        if party.get("tel"):
+            logger.debug(f"Using party telephone: {party['tel']}")
+            return f"tel:{party['tel']}"
+        
+        if party.get("mailto"):
+            logger.debug(f"Using party email: {party['mailto']}")
+            return f"mailto:{party['mailto']}"
+        
+        # Third priority: Name and role combined
+        if party.get("name") and party.get("role"):
+            combined = f"{party['role']}:{party['name']}"
+            logger.debug(f"Using party role+name: {combined}")
+            return combined
+        
+        # Fourth priority: Just name or role
+        if party.get("name"):
+            logger.debug(f"Using party name: {party['name']}")
+            return party["name"]
+        
+        if party.get("role"):
+            logger.debug(f"Using party role: {party['role']}")
+            return party["role"]
+        
+        # Fifth priority: Any other unique identifier in the party object
+        for field in ["partyId", "PartyId", "party_id", "id", "userID", "userId"]:
+            if party.get(field):
+                logger.debug(f"Found non-standard ID {party[field]} using field {field}")
+                return party[field]
+    
+    # If we got here but have parties, use the first party's index as identifier
+    if vcon["parties"]:
+        logger.debug("No explicit identifiers found, using party index")
+        return f"party_index:0"
+    
+    logger.debug("No usable party identifier found")
+    return "unknown_party"
+
+
+def vcon_row(vcon, text):
+    """The text to embed for a vCon, and its Milvus row without the embedding."""
+    text = str(text or "")
+    party_id = extract_party_id(vcon)
+
+    # Extract key metadata and ensure they are strings
+    metadata = vcon.get("metadata", {})
+    created_at = str(metadata.get("created_at", "")) if metadata.get("created_at") is not None else ""
+    updated_at = str(metadata.get("updated_at", "")) if metadata.get("updated_at") is not None else ""
+    subject = str(vcon.get("subject", "")) if vcon.get("subject") is not None else ""
+    title = str(metadata.get("title", "")) if metadata.get("title") is not None else ""
+
+    return text, {
+        "vcon_uuid": vcon["uuid"],
+        "party_id": str(party_id) if party_id is not None else "",
+        "text": text,
+        "created_at": created_at,
+        "updated_at": updated_at,
+        "subject": subject,
+        "metadata_title": title,
+        "has_transcript": bool(vcon.get("transcript")),
+        "has_summary": bool(vcon.get("summary")),
+        "party_count": len(vcon.get("parties", [])),
+        "embedding_model": embeddings.EMBEDDING_MODEL,
+        "embedding_version": "1.0"
+    }
+
+
+def flushing_insert(collection, every=FLUSH_EVERY_BATCHES):
+    """
+    An insert function for run_embedding_pipeline that flushes the collection
+    after every few batches. Call collection.flush() once more when the load ends.
+    """
+    inserted_batches = 0
+
+    def insert(rows):
+        # Called from the pipeline's single inserter, one batch at a time
+        nonlocal inserted_batches
+        collection.insert(rows)
+        inserted_batches += 1
+        if inserted_batches % every == 0:
+            collection.flush()
+
+    return insert
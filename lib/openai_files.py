@@ -0,0 +1,452 @@
+"""
+Uploads of vCons to OpenAI files and vector stores.
+
+Each vCon is serialized in memory and uploaded through a bounded thread pool,
+so nothing touches the working directory and only a few documents wait for
+an upload slot at a time. Uploaded files are then attached to the vector
+store in file batches, which are indexed together and polled until done,
+instead of one attach request per file.
+
+Packed uploads put many vCons in each file instead, as JSON lines with
+binary bodies removed, which keeps the number of OpenAI file objects and
+requests small for large collections.
+
+Incremental syncs keep a manifest in MongoDB of the content hash and file id
+of every vCon in a vector store, so only new or changed vCons are uploaded,
+one file each or packed, and files no vCon points at any more are deleted.
+
+Bulk deletes and downloads use the same bounded pool, over the lazily paged
+file list, with retries on rate limits and transient errors.
+
+Set base_url in the [openai] section of secrets.toml to run against a local
+stand-in for the OpenAI API.
+"""
+import hashlib
+import json
+import os
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor, as_completed
+
+import openai
+import streamlit as st
+from openai import OpenAI
+
+import lib.common as common
+import lib.llm as llm
+
+# Most file ids a single vector store file batch accepts
+FILE_BATCH_MAX_FILES = 500
+SHARD_MAX_BYTES = 4 * 1024 * 1024
+
+
+def get_openai_client():
+    """OpenAI client for the files and assistants page."""
+    settings = st.secrets["openai"]
+    return OpenAI(
+        **llm.get_openai_settings(),
+        organization=settings.get("organization"),
+        project=settings.get("project"),
+    )
+
+
+def vcon_file(vcon):
+    """
+    The in-memory upload for a vCon, as a (file name, JSON bytes) tuple.
+
+    Base64 recordings and attachments are left out; they only add size and
+    noise to file_search.
+    """
+    vcon = llm.strip_binary_bodies(vcon)
+    return f'{vcon["uuid"]}.vcon.json', json.dumps(vcon, default=str).encode("utf-8")
+
+
+def vcon_text_record(vcon):
+    """A vCon reduced to its text: parties, text dialog, analysis and attachments, without binary bodies."""
+    record = llm.strip_binary_bodies(vcon)
+    # Lead with the uuid so it is in the same retrieval chunk as the start of the record
+    return {"vcon_uuid": vcon["uuid"], **{k: v for k, v in record.items() if k != "uuid"}}
+
+
+def pack_shards(vcons, max_bytes=SHARD_MAX_BYTES, prefix="vcons"):
+    """
+    Pack vCons into size-bounded JSON lines files.
+
+    Each shard starts with an index line listing the uuids it holds, followed
+    by one text record per vCon. Shards are named .txt because file_search
+    does not accept the .jsonl extension.
+
+    Args:
+        vcons: Iterable of vCons; consumed lazily
+        max_bytes: Upper bound on a shard's size, unless a single vCon is larger
+        prefix: File name prefix
+
+    Yields:
+        (file name, bytes, list of vCon uuids) for each shard
+    """
+    lines = []
+    uuids = []
+    size = 0
+
+    def shard():
+        index = json.dumps({"shard_index": {"shard": number, "vcon_uuids": uuids}}) + "\n"
+        return f"{prefix}-{number:05d}.txt", (index + "".join(lines)).encode("utf-8"), uuids
+
+    number = 1
+    for vcon in vcons:
+        line = json.dumps(vcon_text_record(vcon), default=str) + "\n"
+        line_size = len(line.encode("utf-8"))
+        # Each uuid also costs about 40 bytes in the index line
+        if lines and size + line_size + 40 * (len(uuids) + 1) > max_bytes:
+            yield shard()
+            number += 1
+            lines, uuids, size = [], [], 0
+        lines.append(line)
+        uuids.append(vcon["uuid"])
+        size += line_size
+    if lines:
+        yield shard()
+
+
+def _run_bounded(work, items, max_workers, progress=None):
+    """
+    Call work on every item through a thread pool, keeping at most a few items
+    per worker waiting so large or lazy iterables are never held in memory.
+
+    work returns a result dictionary; its "bytes", if any, count towards progress,
+    which receives (items done, bytes, seconds elapsed).
+    """
+    in_flight = threading.BoundedSemaphore(max_workers * 2)
+    started = time.monotonic()
+    results = []
+    total_bytes = 0
+
+    def run(item):
+        try:
+            return work(item)
+        finally:
+            in_flight.release()
+
+    def collect(future):
+        nonlocal total_bytes
+        result = future.result()
+        results.append(result)
+        total_bytes += result.get("bytes", 0)
+        if progress:
+            progress(len(results), total_bytes, time.monotonic() - started)
+
+    with ThreadPoolExecutor(max_workers=max_workers) as executor:
+        futures = set()
+        for item in items:
+            in_flight.acquire()
+            futures.add(executor.submit(run, item))
+            done = {future for future in futures if future.done()}
+            for future in done:
+                collect(future)
+            futures -= done
+        for future in as_completed(futures):
+            collect(future)
+    return results
+
+
+def _with_retry(call, max_retries):
+    """Call, retrying rate limits and transient errors with the workbench's jittered backoff."""
+    for attempt in range(max_retries + 1):
+        try:
+            return call()
+        except llm.RETRYABLE_ERRORS as e:
+            if attempt == max_retries:
+                raise
+            time.sleep(llm.backoff_delay(attempt, e))
+
+
+def upload_files(client, files, purpose, max_workers=8, max_retries=3, progress=None):
+    """
+    Upload in-memory files to OpenAI concurrently.
+
+    Args:
+        client: The OpenAI client
+        files: Iterable of (file name, bytes) tuples; consumed lazily
+        purpose: The OpenAI file purpose, e.g. "assistants"
+        max_workers: Number of concurrent uploads
+        max_retries: Retries per file on rate limits and transient errors
+        progress: Optional callback receiving (files uploaded, bytes uploaded, seconds elapsed)
+
+    Returns:
+        A list of {"name", "id", "bytes"} for uploaded files and {"name", "error"} for failures
+    """
+    def upload(item):
+        name, data = item
+        try:
+            file = _with_retry(lambda: client.files.create(file=(name, data), purpose=purpose), max_retries)
+            return {"name": name, "id": file.id, "bytes": len(data)}
+        except Exception as e:
+            return {"name": name, "error": str(e)}
+
+    return _run_bounded(upload, files, max_workers, progress)
+
+
+def delete_files(client, files, max_workers=8, max_retries=3, progress=None):
+    """
+    Delete OpenAI files concurrently.
+
+    Args:
+        client: The OpenAI client
+        files: Iterable of file objects, e.g. client.files.list(), which pages lazily
+        max_workers: Number of concurrent deletes
+        max_retries: Retries per file on rate limits and transient errors
+        progress: Optional callback receiving (files deleted, 0, seconds elapsed)
+
+    Returns:
+        A list of {"id"} for deleted files and {"id", "error"} for failures
+    """
+    def delete(file):
+        try:
+            _with_retry(lambda: client.files.delete(file.id), max_retries)
+        except openai.NotFoundError:
+            # Deleted by someone else in the meantime
+            pass
+        except Exception as e:
+            return {"id": file.id, "error": str(e)}
+        return {"id": file.id}
+
+    return _run_bounded(delete, files, max_workers, progress)
+
+
+def download_files(client, files, directory, max_workers=8, max_retries=3, progress=None):
+    """
+    Stream OpenAI files to a directory concurrently.
+
+    Files are written under their original name, prefixed with the file id
+    if that name was already used in this download, and only appear under
+    their final name once complete.
+
+    Args:
+        client: The OpenAI client
+        files: Iterable of file objects, e.g. client.files.list(), which pages lazily
+        directory: Directory to write into; created if missing
+        max_workers: Number of concurrent downloads
+        max_retries: Retries per file on rate limits and transient errors
+        progress: Optional callback receiving (files downloaded, bytes downloaded, seconds elapsed)
+
+    Returns:
+        A list of {"id", "path", "bytes"} for downloaded files and {"id", "error"} for failures
+    """
+    os.makedirs(directory, exist_ok=True)
+
+    def named(files):
+        used = set()
+        for file in files:
+            name = os.path.basename(file.filename or "") or file.id
+            if name in used:
+                name = f"{file.id}-{name}"
+            used.add(name)
+            yield file, os.path.join(directory, name)
+
+    def download(item):
+        file, path = item
+        partial = f"{path}.part"
+
+        def fetch():
+            size = 0
+            with client.files.with_streaming_response.content(file.id) as response, open(partial, "wb") as f:
+                for chunk in response.iter_bytes(chunk_size=64 * 1024):
+                    f.write(chunk)
+                    size += len(chunk)
+            os.replace(partial, path)
+            return size
+
+        try:
+            return {"id": file.id, "path": path, "bytes": _with_retry(fetch, max_retries)}
+        except Exception as e:
+            return {"id": file.id, "error": str(e)}
+        finally:
+            if os.path.exists(partial):
+                os.remove(partial)
+
+    return _run_bounded(download, named(files), max_workers, progress)
+
+
+def attach_files(client, vector_store_id, file_ids, batch_size=FILE_BATCH_MAX_FILES, poll_interval_ms=2000, progress=None):
+    """
+    Attach uploaded files to a vector store in file batches and wait for indexing.
+
+    Args:
+        client: The OpenAI client
+        vector_store_id: The vector store to add the files to
+        file_ids: The OpenAI file ids
+        batch_size: File ids per batch, at most FILE_BATCH_MAX_FILES
+        poll_interval_ms: How often to poll a batch while it is being indexed
+        progress: Optional callback receiving (files attached, total files)
+
+    Returns:
+        The finished file batches, with their file counts
+    """
+    file_ids = list(file_ids)
+    batches = []
+    for start in range(0, len(file_ids), batch_size):
+        batch = client.beta.vector_stores.file_batches.create_and_poll(
+            vector_store_id=vector_store_id,
+            file_ids=file_ids[start:start + batch_size],
+            poll_interval_ms=poll_interval_ms,
+        )
+        batches.append(batch)
+        if progress:
+            progress(min(start + batch_size, len(file_ids)), len(file_ids))
+    return batches
+
+
+def completed_file_ids(client, vector_store_id, batches):
+    """The ids of the files in the batches that were indexed successfully."""
+    completed = set()
+    for batch in batches:
+        if not batch.file_counts.completed:
+            continue
+        files = client.beta.vector_stores.file_batches.list_files(
+            batch.id, vector_store_id=vector_store_id, filter="completed", limit=100
+        )
+        completed.update(file.id for file in files)
+    return completed
+
+
+def list_vector_store_file_ids(client, vector_store_id):
+    """The ids of every file attached to a vector store, following pagination."""
+    return {file.id for file in client.beta.vector_stores.files.list(vector_store_id=vector_store_id, limit=100)}
+
+
+def delete_vector_store_files(client, vector_store_id, file_ids, max_workers=8):
+    """
+    Detach files from a vector store and delete them, concurrently.
+
+    Returns:
+        The number of files that could not be deleted
+    """
+    def delete(file_id):
+        try:
+            client.beta.vector_stores.files.delete(vector_store_id=vector_store_id, file_id=file_id)
+        except Exception:
+            # Already detached; the file itself may still exist
+            pass
+        try:
+            client.files.delete(file_id)
+            return 0
+        except Exception as e:
+            common.logger.warning(f"Could not delete OpenAI file {file_id}: {str(e)}")
+            return 1
+
+    with ThreadPoolExecutor(max_workers=max_workers) as executor:
+        return sum(executor.map(delete, file_ids))
+
+
+def sync_vector_store(client, vector_store_id, vcons, purpose="assistants", max_workers=8,
+                      remove_untracked=False, shard_bytes=None, progress=None):
+    """
+    Bring a vector store up to date with the vCons, uploading only what changed.
+
+    The manifest is first reconciled against the store's file list: entries
+    whose file is gone are uploaded again, and files the manifest does not
+    know about are reported, or deleted if remove_untracked is set. Uploads
+    that fail to index are deleted and retried on the next sync.
+
+    With shard_bytes set, changed vCons are packed into shards and each vCon's
+    manifest entry points at its shard. A file is deleted once no vCon in the
+    manifest points at it any more, so a shard holding an old copy of a changed
+    vCon stays in the store until all of its vCons have changed or are gone.
+
+    Args:
+        client: The OpenAI client
+        vector_store_id: The vector store to sync into
+        vcons: Iterable of every vCon that should be in the store; consumed lazily
+        purpose: The OpenAI file purpose
+        max_workers: Number of concurrent uploads and deletes
+        remove_untracked: Delete files in the store that are not in the manifest
+        shard_bytes: Pack changed vCons into shards of at most this size, instead of a file each
+        progress: Optional upload progress callback, as for upload_files
+
+    Returns:
+        Dictionary of vCon counts: uploaded (and indexed), unchanged, replaced, removed;
+        file counts: missing, untracked, failed; and error, the message if attaching failed
+    """
+    manifest = common.get_openai_sync_manifest(vector_store_id) or {}
+    remote = list_vector_store_file_ids(client, vector_store_id)
+
+    missing = {entry["file_id"] for entry in manifest.values() if entry["file_id"] not in remote}
+    stranded = [uuid for uuid, entry in manifest.items() if entry["file_id"] in missing]
+    for uuid in stranded:
+        del manifest[uuid]
+    common.remove_openai_sync_entries(vector_store_id, stranded)
+    untracked = remote - {entry["file_id"] for entry in manifest.values()}
+
+    seen = set()
+    hashes = {}
+    pending = {}
+    unchanged = 0
+
+    def is_unchanged(uuid, content_hash):
+        nonlocal unchanged
+        seen.add(uuid)
+        entry = manifest.get(uuid)
+        if entry and entry["content_hash"] == content_hash:
+            unchanged += 1
+            return True
+        hashes[uuid] = content_hash
+        return False
+
+    def changed_files():
+        for vcon in vcons:
+            name, data = vcon_file(vcon)
+            if not is_unchanged(vcon["uuid"], hashlib.sha256(data).hexdigest()):
+                pending[name] = [vcon["uuid"]]
+                yield name, data
+
+    def changed_shards():
+        changed = (
+            vcon for vcon in vcons
+            if not is_unchanged(vcon["uuid"], hashlib.sha256(
+                json.dumps(vcon_text_record(vcon), default=str).encode("utf-8")).hexdigest())
+        )
+        # Shard numbers restart on every sync, so the prefix tells syncs apart
+        for name, data, uuids in pack_shards(changed, shard_bytes, prefix=f"vcons-{time.strftime('%Y%m%d%H%M%S')}"):
+            pending[name] = uuids
+            yield name, data
+
+    files = changed_shards() if shard_bytes else changed_files()
+    results = upload_files(client, files, purpose, max_workers=max_workers, progress=progress)
+    uploaded = [result for result in results if "id" in result]
+    error = None
+    try:
+        batches = attach_files(client, vector_store_id, [result["id"] for result in uploaded])
+        completed = completed_file_ids(client, vector_store_id, batches)
+    except Exception as e:
+        common.logger.error(f"Attaching files to vector store {vector_store_id} failed: {str(e)}")
+        error = str(e)
+        completed = set()
+
+    # Only files that were indexed replace anything; the rest are deleted so they
+    # are not orphaned, and their vCons keep their old files until the next sync
+    indexed = [result for result in uploaded if result["id"] in completed]
+    not_indexed = [result["id"] for result in uploaded if result["id"] not in completed]
+    entries = [(uuid, hashes[uuid], result["id"]) for result in indexed for uuid in pending[result["name"]]]
+    common.save_openai_sync_entries(vector_store_id, entries)
+
+    # Files no vCon points at any more: old files of re-uploaded vCons, and files of vCons that are gone
+    removed = [uuid for uuid in manifest if uuid not in seen]
+    current = {uuid: entry["file_id"] for uuid, entry in manifest.items() if uuid in seen}
+    current.update((uuid, file_id) for uuid, _, file_id in entries)
+    superseded = {entry["file_id"] for entry in manifest.values()} - set(current.values())
+    stale = not_indexed + list(superseded)
+    if remove_untracked:
+        stale += list(untracked)
+    failed_deletes = delete_vector_store_files(client, vector_store_id, stale, max_workers=max_workers)
+    common.remove_openai_sync_entries(vector_store_id, removed)
+
+    return {
+        "uploaded": len(entries),
+        "unchanged": unchanged,
+        "replaced": sum(1 for uuid, _, _ in entries if uuid in manifest),
+        "removed": len(removed),
+        "missing": len(missing),
+        "untracked": len(untracked),
+        "failed": len(results) - len(indexed) + failed_deletes,
+        "error": error,
+    }
@@ -0,0 +1,297 @@
+"""
+Headless worker for vCon Admin bulk jobs.
+
+Workers run outside of Streamlit, read the same .streamlit/secrets.toml as the
+admin app and claim jobs from the shared queue in lib/common.py. Run as many as
+you like, on as many nodes as can reach MongoDB:
+
+    python -m lib.worker run --types export_jsonl,export_s3
+    python -m lib.worker enqueue export_jsonl --shards 8 --param path=/exports/
+    python -m lib.worker enqueue embed_milvus --shards 8 --param collection=vcons
+
+A claimed job holds a lease that is renewed while it runs. If a worker dies, its
+lease expires and another worker picks the job up again.
+"""
+import argparse
+import json
+import os
+import signal
+import socket
+import threading
+import time
+import uuid as uuid_lib
+
+import boto3
+import streamlit as st
+from pymilvus import Collection
+
+import lib.common as common
+import lib.embeddings as embeddings
+import lib.llm as llm
+import lib.milvus as milvus
+
+logger = common.logger
+
+# Registry of job handlers, keyed by job type
+HANDLERS = {}
+# Job types whose handlers honour uuid_lower and uuid_upper, and so can be split into shards
+SHARDABLE = set()
+
+
+def handler(job_type, shardable=True):
+    """Register a function as the handler for a job type."""
+    def register(func):
+        HANDLERS[job_type] = func
+        if shardable:
+            SHARDABLE.add(job_type)
+        return func
+    return register
+
+
+def get_s3_client():
+    return boto3.client(
+        's3',
+        aws_access_key_id=st.secrets['aws']["AWS_ACCESS_KEY_ID"],
+        aws_secret_access_key=st.secrets['aws']["AWS_SECRET_ACCESS_KEY"],
+        region_name=st.secrets['aws']["AWS_DEFAULT_REGION"],
+    )
+
+
+def shard_label(params):
+    """Human readable name for the uuid range a job covers."""
+    return f"{params.get('uuid_lower') or 'start'}-{params.get('uuid_upper') or 'end'}"
+
+
+@handler("export_jsonl")
+def export_jsonl(params, heartbeat):
+    """Export the job's uuid range to a JSONL file in params['path']."""
+    collection = common.get_vcon_collection()
+    query = common.uuid_range_query(params.get("uuid_lower"), params.get("uuid_upper"))
+    filename = f"{params.get('path', '')}output-{shard_label(params)}.jsonl"
+    exported = 0
+    with open(filename, "w") as file:
+        for vcon in collection.find(query).sort("uuid", 1):
+            file.write(json.dumps(vcon, default=str) + "\n")
+            exported += 1
+            if exported % 1000 == 0:
+                heartbeat()
+    return {"exported": exported, "file": filename}
+
+
+@handler("export_json")
+def export_json(params, heartbeat):
+    """Export the job's uuid range as sharded <uuid>.vcon.json files under params['path']."""
+    query = common.uuid_range_query(params.get("uuid_lower"), params.get("uuid_upper"))
+    exported = common.export_vcons_to_directory(
+        params.get("path") or ".",
+        query=query,
+        depth=int(params.get("depth", 2)),
+        max_workers=int(params.get("workers", 8)),
+        # Each shard writes its own manifest so workers never share a file
+        manifest_name=f"manifest-{shard_label(params)}.jsonl",
+        progress=lambda count: heartbeat() if count % 1000 == 0 else None,
+    )
+    return {"exported": exported}
+
+
+@handler("export_s3")
+def export_s3(params, heartbeat):
+    """Export the job's uuid range as <uuid>.vcon.json objects in an S3 bucket."""
+    s3_client = get_s3_client()
+    collection = common.get_vcon_collection()
+    query = common.uuid_range_query(params.get("uuid_lower"), params.get("uuid_upper"))
+    s3_path = params.get("s3_path", "")
+    exported = 0
+    for vcon in collection.find(query).sort("uuid", 1):
+        filename = f"{vcon['uuid']}.vcon.json"
+        key = f"{s3_path}/{filename}" if s3_path else filename
+        s3_client.put_object(Bucket=params["s3_bucket"], Key=key, Body=json.dumps(vcon, default=str))
+        exported += 1
+        if exported % 100 == 0:
+            heartbeat()
+    return {"exported": exported}
+
+
+# S3 imports are keyed by object name, not uuid
+@handler("import_s3", shardable=False)
+def import_s3(params, heartbeat):
+    """Import every .vcon / .vcon.json object under params['s3_path'] in a bucket."""
+    s3_client = get_s3_client()
+    collection = common.get_vcon_collection()
+    paginator = s3_client.get_paginator('list_objects_v2')
+    imported = 0
+    skipped = 0
+    for page in paginator.paginate(Bucket=params["s3_bucket"], Prefix=params.get("s3_path", "")):
+        for obj in page.get('Contents', []):
+            key = obj['Key']
+            if not (key.endswith(".vcon.json") or key.endswith(".vcon")):
+                skipped += 1
+                continue
+            try:
+                vcon = json.loads(s3_client.get_object(Bucket=params["s3_bucket"], Key=key)['Body'].read())
+                collection.replace_one({'_id': vcon['uuid']}, vcon, upsert=True)
+                imported += 1
+            except (ValueError, KeyError) as e:
+                logger.warning(f"Skipping {key}: {e}")
+                skipped += 1
+        heartbeat()
+    return {"imported": imported, "skipped": skipped}
+
+
+@handler("build_indexes", shardable=False)
+def build_indexes(params, heartbeat):
+    """Create the indexes behind the vCon Manager filters and sorts."""
+    common.ensure_vcon_indexes()
+    return {"built": True}
+
+
+@handler("embed_milvus")
+def embed_milvus(params, heartbeat):
+    """
+    Embed the job's uuid range into the Milvus collection params['collection'].
+
+    With params['missing_only'] set, vCons already in the collection are skipped,
+    which makes a failed or interrupted backfill cheap to run again.
+    """
+    milvus.connect()
+    collection = Collection(params["collection"])
+    collection.load()
+    lower, upper = params.get("uuid_lower"), params.get("uuid_upper")
+    batch_size = int(params.get("batch_size", 500))
+
+    existing = set()
+    # Set from the CLI as a string, or from the page as a bool
+    if str(params.get("missing_only", "")).lower() in ("1", "true", "yes"):
+        expr = " and ".join(
+            ["vcon_uuid != ''"]
+            + ([f"vcon_uuid >= '{lower}'"] if lower else [])
+            + ([f"vcon_uuid < '{upper}'"] if upper else [])
+        )
+        existing = {row["vcon_uuid"] for row in collection.query(expr=expr, output_fields=["vcon_uuid"])}
+
+    client = llm.get_openai_client()
+    cursor = common.get_vcon_collection().find(
+        common.uuid_range_query(lower, upper), {"_id": 0, "dialog.body": 0}, batch_size=batch_size
+    )
+    try:
+        metrics = embeddings.run_embedding_pipeline(
+            client,
+            (vcon for vcon in cursor if vcon["uuid"] not in existing),
+            lambda vcon: milvus.vcon_row(vcon, milvus.extract_text_from_vcon(client, vcon)),
+            milvus.flushing_insert(collection),
+            batch_size=batch_size,
+            workers=int(params.get("workers", 4)),
+            expected_dim=embeddings.EMBEDDING_DIM,
+            requests_per_minute=int(params.get("requests_per_minute", 0)) or None,
+            tokens_per_minute=int(params.get("tokens_per_minute", 0)) or None,
+            progress=lambda metrics: heartbeat(),
+        )
+    finally:
+        collection.flush()
+    return {
+        "inserted": metrics["insert"]["items"],
+        "skipped": len(existing),
+        "failed": metrics["embed"]["failed"] + metrics["insert"]["failed"],
+    }
+
+
+class LeaseKeeper:
+    """Renews a job lease in the background until the job finishes."""
+
+    def __init__(self, job_id, worker_id, lease_seconds):
+        self.job_id = job_id
+        self.worker_id = worker_id
+        self.lease_seconds = lease_seconds
+        self._stop = threading.Event()
+        self._thread = threading.Thread(target=self._run, daemon=True)
+
+    def __enter__(self):
+        self._thread.start()
+        return self
+
+    def __exit__(self, *exc):
+        self._stop.set()
+        self._thread.join()
+
+    def renew(self):
+        if not common.renew_job_lease(self.job_id, self.worker_id, self.lease_seconds):
+            logger.warning(f"Lost lease on job {self.job_id}")
+
+    def _run(self):
+        while not self._stop.wait(self.lease_seconds / 3):
+            self.renew()
+
+
+def run_worker(job_types=None, lease_seconds=300, poll_interval=5.0, once=False):
+    """Claim and run jobs until stopped."""
+    worker_id = f"{socket.gethostname()}:{os.getpid()}:{uuid_lib.uuid4().hex[:8]}"
+    job_types = job_types or list(HANDLERS)
+    stopping = threading.Event()
+
+    def request_stop(signum, frame):
+        logger.info("Stop requested, finishing the current job")
+        stopping.set()
+
+    signal.signal(signal.SIGTERM, request_stop)
+    signal.signal(signal.SIGINT, request_stop)
+
+    common.ensure_job_indexes()
+    logger.info(f"Worker {worker_id} handling {', '.join(job_types)}")
+
+    while not stopping.is_set():
+        job = common.claim_job(worker_id, job_types, lease_seconds)
+        if not job:
+            if once:
+                break
+            stopping.wait(poll_interval)
+            continue
+
+        logger.info(f"Running job {job['_id']} ({job['type']}) attempt {job['attempts']}")
+        start_time = time.time()
+        try:
+            with LeaseKeeper(job["_id"], worker_id, lease_seconds) as lease:
+                result = HANDLERS[job["type"]](job.get("params", {}), lease.renew)
+            common.complete_job(job["_id"], worker_id, result)
+            logger.info(f"Job {job['_id']} done in {time.time() - start_time:.1f}s: {result}")
+        except Exception as e:
+            logger.exception(f"Job {job['_id']} failed: {e}")
+            common.fail_job(job["_id"], worker_id, e)
+
+
+def parse_params(pairs):
+    params = {}
+    for pair in pairs or []:
+        key, _, value = pair.partition("=")
+        params[key] = value
+    return params
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(prog="python -m lib.worker", description="vCon Admin background worker")
+    subparsers = parser.add_subparsers(dest="command", required=True)
+
+    run_parser = subparsers.add_parser("run", help="Claim and run jobs from the queue")
+    run_parser.add_argument("--types", help="Comma separated job types to handle (default: all)")
+    run_parser.add_argument("--lease", type=int, default=300, help="Lease length in seconds")
+    run_parser.add_argument("--poll-interval", type=float, default=5.0, help="Seconds to wait when the queue is empty")
+    run_parser.add_argument("--once", action="store_true", help="Exit when the queue is empty")
+
+    enqueue_parser = subparsers.add_parser("enqueue", help="Add jobs to the queue")
+    enqueue_parser.add_argument("type", choices=sorted(HANDLERS))
+    enqueue_parser.add_argument("--shards", type=int, default=1, help="Split the job into this many uuid ranges")
+    enqueue_parser.add_argument("--param", action="append", help="Handler parameter as key=value")
+
+    args = parser.parse_args(argv)
+    if args.command == "run":
+        job_types = args.types.split(",") if args.types else None
+        run_worker(job_types, lease_seconds=args.lease, poll_interval=args.poll_interval, once=args.once)
+    else:
+        if args.shards > 1 and args.type not in SHARDABLE:
+            parser.error(f"{args.type} jobs cannot be split by uuid range; use --shards 1")
+        job_ids = common.enqueue_sharded_jobs(args.type, parse_params(args.param), shards=args.shards)
+        for job_id in job_ids:
+            print(job_id)
+
+
+if __name__ == "__main__":
+    main()
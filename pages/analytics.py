@@ -0,0 +1,57 @@
+import streamlit as st
+import pandas as pd
+import lib.common as common
+from datetime import datetime, timedelta, timezone
+
+common.init_session_state()
+common.sidebar()
+
+st.title("vCon Analytics")
+"Ingest volume and the mix of dialog and analysis types over time. Closed time buckets are cached in MongoDB, so only the current bucket is recomputed on refresh."
+
+col1, col2, col3 = st.columns([3, 3, 2])
+with col1:
+    unit = st.selectbox("Bucket size", common.ANALYTICS_UNITS, index=1)
+with col2:
+    default_lookback = {"hour": 48, "day": 30, "week": 26, "month": 12}[unit]
+    lookback = st.number_input(f"Number of {unit}s", min_value=1, max_value=5000, value=default_lookback)
+with col3:
+    st.write("")
+    if st.button("REBUILD CACHE", help="Recompute every bucket, e.g. after importing older vCons"):
+        common.clear_activity_cache(unit)
+
+now = datetime.now(timezone.utc).replace(tzinfo=None)
+start = now
+for _ in range(int(lookback) - 1):
+    start = common.truncate_to_bucket(start, unit) - timedelta(seconds=1)
+
+with st.spinner("Aggregating vCons..."):
+    rows = common.get_vcon_activity(unit, start) or []
+
+if not any(row["count"] for row in rows):
+    st.info("No vCons found in this time range.")
+    st.stop()
+
+volume = pd.DataFrame([{"Bucket": row["bucket"], "vCons": row["count"]} for row in rows]).set_index("Bucket")
+dialog_mix = pd.DataFrame([dict(row["dialog_types"], Bucket=row["bucket"]) for row in rows]).set_index("Bucket").fillna(0)
+analysis_mix = pd.DataFrame([dict(row["analysis_types"], Bucket=row["bucket"]) for row in rows]).set_index("Bucket").fillna(0)
+
+metric1, metric2, metric3 = st.columns(3)
+metric1.metric("vCons in range", int(volume["vCons"].sum()))
+metric2.metric(f"Current {unit}", int(volume["vCons"].iloc[-1]))
+metric3.metric(f"Average per {unit}", f"{volume['vCons'].mean():.1f}")
+
+st.subheader("Ingest volume")
+st.bar_chart(volume)
+
+st.subheader("Dialog types")
+if dialog_mix.empty or not len(dialog_mix.columns):
+    st.info("No dialog entries in this time range.")
+else:
+    st.area_chart(dialog_mix)
+
+st.subheader("Analysis types")
+if analysis_mix.empty or not len(analysis_mix.columns):
+    st.info("No analysis entries in this time range.")
+else:
+    st.area_chart(analysis_mix)
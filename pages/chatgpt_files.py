@@ -1,16 +1,12 @@
 import streamlit as st
 import lib.common as common
+import lib.openai_files as openai_files
+import lib.assistants as assistant_runs
+import lib.llm as llm
 import os
-import json
 from datetime import datetime
-from openai import OpenAI
-import time
 
-client = OpenAI(
-    organization=st.secrets["openai"]["organization"],
-    project=st.secrets["openai"]["project"],
-    api_key=st.secrets["openai"]["secret_key"],
-)
+client = openai_files.get_openai_client()
 
 default_model = st.secrets["openai"].get("model", "gpt-4o-mini")
 common.init_session_state()
@@ -38,23 +34,26 @@ with upload:
     purpose = st.selectbox("File Purpose", file_purposes)
 
     # Make a dropdown for the vector store. Use the API to get the vector stores, and then populate the dropdown
-    vector_stores = client.beta.vector_stores.list()
-    
+    # The lists are cached for a few minutes and cleared after anything is created or deleted
+    vector_stores = llm.list_vector_stores(client)
+
     # If there are no vector stores, create one
-    if not vector_stores.data:
+    if not vector_stores:
         st.write("No vector stores found. Creating one.")
         vector_store = client.beta.vector_stores.create(name="vcons")
-        vector_stores = client.beta.vector_stores.list()
-        
+        llm.clear_openai_metadata_cache()
+        vector_stores = llm.list_vector_stores(client)
 
     # Use the human readable name for the dropdown
-    vector_store_names = [vector_store.name for vector_store in vector_stores.data]
+    vector_store_names = [vector_store.name for vector_store in vector_stores]
     vector_store_id = st.selectbox("Vector Store", vector_store_names)
 
     # Convert the human readable name to the ID
-    vector_store_id = vector_stores.data[vector_store_names.index(vector_store_id)].id
+    vector_store_id = vector_stores[vector_store_names.index(vector_store_id)].id
     with st.expander("Vector Store Details"):
-        vector_store = client.beta.vector_stores.retrieve(vector_store_id)
+        if st.button("Refresh", key="refresh_vector_store"):
+            llm.clear_openai_metadata_cache()
+        vector_store = llm.get_vector_store(client, vector_store_id)
         st.write(f"**Name**: {vector_store.name}")
         st.write(f"**File Counts**:")
         st.write(f"  _In Progress_: {vector_store.file_counts.in_progress}")
@@ -63,67 +62,160 @@ with upload:
         st.write(f"  _Cancelled_: {vector_store.file_counts.cancelled}")
         st.write(f"  **Total**: {vector_store.file_counts.total}")
 
+    max_workers = st.number_input("Concurrent Uploads", min_value=1, max_value=64, value=8)
+    packed = st.radio("Upload As", ["One file per vCon", "Packed shards"], horizontal=True) == "Packed shards"
+    if packed:
+        "Many vCons per file, as JSON lines without binary bodies. Each shard starts with an index of the vCon uuids it holds."
+        shard_mb = st.number_input("Shard Size (MB)", min_value=1, max_value=100, value=4)
+    incremental = st.checkbox(
+        "Only upload new or changed vCons",
+        value=True,
+        help="Keeps a manifest of what is in the vector store, replaces changed vCons and removes deleted ones",
+    )
+    remove_untracked = st.checkbox("Remove files in the vector store that are not in the manifest", disabled=not incremental)
+
     # Upload the vCons
     upload = st.button("Upload vCons to OpenAI")
     if upload:
-        vcons = common.get_vcons()
-        files = []
+        total = common.count_vcons() or 0
         with st.status(f"Uploading vcons to vector store") as status:
-            st.write(f"Uploading {len(vcons)} vcons to OpenAI.")
-            for i, vcon in enumerate(vcons):
-                # Save the vCon as a file
-                file_name = f'{vcon["uuid"]}.vcon.json'
-                with open(file_name, "w") as f:
-                    f.write(json.dumps(vcon))
-
-                # Upload the file to OpenAI
-                file = client.files.create(file=open(file_name, "rb"), purpose=purpose)
-                files.append(file)
-                # Remove the file
-                os.remove(file_name)
-            st.write(f"Files uploaded to OpenAI.")
-            st.write(f"Adding files to vector store")
-            for file in files:
-                vector_store_file = client.beta.vector_stores.files.create(
-                    vector_store_id=vector_store_id, file_id=file.id
+            st.write(f"Uploading {total} vcons to OpenAI.")
+            upload_bar = st.progress(0.0)
+
+            def show_upload_progress(count, size, elapsed):
+                rate = size / 1024 / 1024 / elapsed if elapsed else 0
+                if packed:
+                    # The number of shards is not known until every vCon is packed
+                    upload_bar.progress(0.0, text=f"{count} shards, {size / 1024 / 1024:.1f} MB, {rate:.1f} MB/s")
+                    return
+                upload_bar.progress(
+                    min(count / total, 1.0) if total else 1.0,
+                    text=f"{count} of {total} files, {size / 1024 / 1024:.1f} MB, {rate:.1f} MB/s",
                 )
-            st.write(f"Files added to vector store {vector_store_id}")
-            st.write(f"Files uploaded to OpenAI.")
+
+            # Documents are streamed from the cursor and serialized in memory. As before,
+            # dialog bodies are left out of the query; vcon_file drops binary attachments too
+            vcons = common.get_vcon_collection().find({}, {"_id": 0, "dialog.body": 0})
+            if incremental:
+                common.ensure_openai_sync_indexes()
+                counts = openai_files.sync_vector_store(
+                    client,
+                    vector_store_id,
+                    vcons,
+                    purpose,
+                    max_workers=max_workers,
+                    remove_untracked=remove_untracked,
+                    shard_bytes=shard_mb * 1024 * 1024 if packed else None,
+                    progress=show_upload_progress,
+                )
+                st.write(
+                    f"{counts['uploaded']} uploaded ({counts['replaced']} replacing changed vCons), "
+                    f"{counts['unchanged']} unchanged, {counts['removed']} removed."
+                )
+                if counts["missing"]:
+                    st.write(f"{counts['missing']} files were missing from the vector store; their vCons were uploaded again.")
+                if counts["untracked"]:
+                    action = "removed" if remove_untracked else "left in place"
+                    st.write(f"{counts['untracked']} files in the vector store are not in the manifest and were {action}.")
+                if counts["error"]:
+                    st.error(f"Attaching files to the vector store failed: {counts['error']}")
+                if counts["failed"]:
+                    st.warning(f"{counts['failed']} uploads or deletes failed; they will be retried on the next sync.")
+                status.update(label="Sync complete", state="complete")
+                llm.clear_openai_metadata_cache()
+            else:
+                packed_uuids = []
+                if packed:
+                    def shards():
+                        for name, data, uuids in openai_files.pack_shards(vcons, shard_mb * 1024 * 1024):
+                            packed_uuids.extend(uuids)
+                            yield name, data
+                    files = shards()
+                else:
+                    files = (openai_files.vcon_file(vcon) for vcon in vcons)
+                results = openai_files.upload_files(
+                    client,
+                    files,
+                    purpose,
+                    max_workers=max_workers,
+                    progress=show_upload_progress,
+                )
+                file_ids = [result["id"] for result in results if "id" in result]
+                failures = [result for result in results if "error" in result]
+                st.write(f"{len(file_ids)} files uploaded to OpenAI.")
+                if packed:
+                    st.write(f"{len(packed_uuids)} vCons packed into {len(results)} shards.")
+                if failures:
+                    st.warning(f"{len(failures)} uploads failed, e.g. {failures[0]['name']}: {failures[0]['error']}")
+
+                st.write(f"Adding files to vector store")
+                attach_bar = st.progress(0.0)
+                batches = openai_files.attach_files(
+                    client,
+                    vector_store_id,
+                    file_ids,
+                    progress=lambda done, count: attach_bar.progress(done / count, text=f"{done} of {count} files indexed"),
+                )
+                failed = sum(batch.file_counts.failed for batch in batches)
+                st.write(f"Files added to vector store {vector_store_id}")
+                if failed:
+                    st.warning(f"{failed} files failed to index.")
+                status.update(label="Upload complete", state="complete")
+                llm.clear_openai_metadata_cache()
+
+def show_throughput(bar, verb):
+    """Progress callback for bulk file operations, for listings whose length is not known up front."""
+    def show(count, size, elapsed):
+        rate = count / elapsed if elapsed else 0
+        text = f"{count} files {verb}, {rate:.1f} files/s"
+        if size:
+            text += f", {size / 1024 / 1024:.1f} MB at {size / 1024 / 1024 / elapsed if elapsed else 0:.1f} MB/s"
+        bar.progress(0.0, text=text)
+    return show
 
 with download:
     "Download the files from OpenAI to your local machine."
 
+    destination = st.text_input("Destination", value="openai_files")
+    download_workers = st.number_input("Concurrent Downloads", min_value=1, max_value=64, value=8)
+
     # Download the vCons
     download = st.button("Download")
     if download:
-        # Pick the destination folder
-        st.write("Select the destination folder")
-        destination = st.text_input("Destination", value=".")
-        if not os.path.exists(destination):
-            os.makedirs(destination)
-        os.chdir(destination)
-
-        st.write("Downloading files from OpenAI")
-        with st.spinner("Downloading files from OpenAI"):
-            files = client.files.list(purpose=purpose)
-            for file in files:
-                file_name = file["name"]
-                with open(file_name, "wb") as f:
-                    f.write(file.get_content())
-        st.success("Files downloaded successfully")
+        st.write(f"Downloading files from OpenAI to {os.path.abspath(destination)}")
+        download_bar = st.progress(0.0)
+        results = openai_files.download_files(
+            client,
+            client.files.list(purpose=purpose),
+            destination,
+            max_workers=download_workers,
+            progress=show_throughput(download_bar, "downloaded"),
+        )
+        failures = [result for result in results if "error" in result]
+        if failures:
+            st.warning(f"{len(failures)} downloads failed, e.g. {failures[0]['id']}: {failures[0]['error']}")
+        st.success(f"{len(results) - len(failures)} files downloaded successfully")
 
 with delete:
     "This will delete all the files in the selected purpose. Be careful, as this action cannot be undone."
 
+    delete_workers = st.number_input("Concurrent Deletes", min_value=1, max_value=64, value=8)
     delete_files = st.button("Delete Files from OpenAI")
     if delete_files:
-        progress_text = "Deleting files from OpenAI."
-        with st.progress(0, text=progress_text):
-            files = client.files.list(purpose=purpose)
-            for i, file in enumerate(files):
-                client.files.delete(file_id=file.id)
-                st.progress((i + 1) / len(files))
-        st.success("Files deleted successfully")
+        delete_bar = st.progress(0.0, text="Listing files in OpenAI.")
+        # List every page first, since deleting while paging would invalidate the page cursor
+        files = list(client.files.list(purpose=purpose))
+        results = openai_files.delete_files(
+            client,
+            files,
+            max_workers=delete_workers,
+            progress=show_throughput(delete_bar, "deleted"),
+        )
+        llm.clear_openai_metadata_cache()
+        failures = [result for result in results if "error" in result]
+        if failures:
+            st.warning(f"{len(failures)} deletes failed, e.g. {failures[0]['id']}: {failures[0]['error']}")
+        st.success(f"{len(results) - len(failures)} files deleted successfully")
 
 with list_files:
     "List all of the files currently uploaded. This will show the file name and the file size."
@@ -146,20 +238,21 @@ st.divider()
 today = datetime.today().strftime("%Y-%m-%d")
 
 # Make a list of the available assistants
-assistants = client.beta.assistants.list()
+assistants = llm.list_assistants(client)
 
 # If there are no assistants, create one
-if not assistants.data:
+if not assistants:
     st.write("No assistants found. Creating one.")
     assistant = client.beta.assistants.create(name="assistant", model=default_model)
-    assistants = client.beta.assistants.list()
+    llm.clear_openai_metadata_cache()
+    assistants = llm.list_assistants(client)
 
 # Use the human readable name for the dropdown
-assistant_names = [assistant.name for assistant in assistants.data]
+assistant_names = [assistant.name for assistant in assistants]
 assistant_name = st.selectbox("Assistant", assistant_names)
 
 # Show the assistant details. Get the assistant by name
-assistant = assistants.data[assistant_names.index(assistant_name)]
+assistant = assistants[assistant_names.index(assistant_name)]
 with st.expander("Assistant Details"):
     # Make a human readable date
     created_at = datetime.fromtimestamp(assistant.created_at)
@@ -171,6 +264,8 @@ with st.expander("Assistant Details"):
     st.write(f"**Tools**: {assistant.tools}")
     st.write(f"**Created At**: {created_at}")
 
+run_timeout = st.number_input("Response Timeout (seconds)", min_value=10, max_value=600, value=120)
+
 
 with st.spinner("Connecting to OpenAI..."):
     # Create a new thread if one does not exist
@@ -187,10 +282,8 @@ with st.spinner("Connecting to OpenAI..."):
         )
 
 
-# In the sidebar, show the vConIDs that are used in this conversation,
-# and provide a link to the vCon detail page using the vConID and CONV_DETAIL_URL
-# Get the thread
-thread = client.beta.threads.retrieve(thread_id=st.session_state.thread.id)
+# The thread was created in this session, so there is no need to fetch it again
+thread = st.session_state.thread
 
 
 # Add the new messages to the chat
@@ -209,33 +302,12 @@ if prompt := st.chat_input("How can I help you?"):
         thread_id=thread.id, role="user", content=prompt
     )
 
-    run = client.beta.threads.runs.create(
-        thread_id=thread.id, assistant_id=assistant.id
-    )
-
-    # Wait for the run to complete
-    # Show a progress bar while waiting
-    status_bar = st.status("Processing...")
-    with status_bar:
-        status = client.beta.threads.runs.retrieve(thread_id=thread.id, run_id=run.id)
-        while status.status != "completed":
-            time.sleep(1)  # Add a 1-second delay between status retrievals
-            status = client.beta.threads.runs.retrieve(
-                thread_id=thread.id, run_id=run.id
-            )
-
-    # Print out the run step object
-    steps = client.beta.threads.runs.steps.list(thread_id=thread.id, run_id=run.id)
-    for step in steps:
-        step_details = step.step_details
-        if step_details.type == "message_creation":
-            message_id = step.step_details.message_creation.message_id
-            message = client.beta.threads.messages.retrieve(
-                thread_id=thread.id, message_id=message_id
-            )
-            message_content = message.content[0].text
-            with st.chat_message("assistant"):
-                st.markdown(message_content.value)
-            st.session_state.messages.append(
-                {"role": "assistant", "content": message_content.value}
-            )
+    # Stream the reply into the chat as it is generated
+    with st.chat_message("assistant"):
+        try:
+            reply = st.write_stream(assistant_runs.stream_run(client, thread.id, assistant.id, timeout=run_timeout))
+        except (TimeoutError, RuntimeError) as e:
+            st.error(str(e))
+            reply = None
+    if reply:
+        st.session_state.messages.append({"role": "assistant", "content": reply})
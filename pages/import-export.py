@@ -4,6 +4,7 @@ import redis
 import boto3
 import zipfile
 import io
+import os
 import lib.common as common
 
 common.init_session_state()
@@ -24,8 +25,8 @@ def load_and_insert_file(file):
 
 st.header('IMPORT')
 
-tab_names= ["IMPORT FILE", "IMPORT ZIP", "IMPORT JSONL", "IMPORT URL", "IMPORT TEXT", "IMPORT REDIS", "IMPORT S3"]
-upload_tab, upload_zip_tab, jsonl_tab, url_tab, text_tab, redis_tab, s3_tab = st.tabs(tab_names)
+tab_names= ["IMPORT FILE", "IMPORT ZIP", "IMPORT JSONL", "IMPORT URL", "IMPORT TEXT", "IMPORT REDIS", "IMPORT S3", "IMPORT DIRECTORY", "IMPORT BSON"]
+upload_tab, upload_zip_tab, jsonl_tab, url_tab, text_tab, redis_tab, s3_tab, directory_tab, bson_tab = st.tabs(tab_names)
 
 with upload_tab:
     "**UPLOAD A SINGLE VCON FILE**"
@@ -89,19 +90,40 @@ with jsonl_tab:
             st.success("INSERTED SUCCESSFULLY!")
 
 with url_tab:
-    # Import from a URL
+    # Import from one or more URLs
     "**IMPORT FROM URL**"
-    url = st.text_input("ENTER URL")
-    if url:
+    url_text = st.text_area("ENTER URLS, ONE PER LINE")
+    is_manifest = st.checkbox("URLS ARE MANIFESTS (LISTS OF VCON URLS)")
+    max_workers = st.number_input("CONCURRENT DOWNLOADS", min_value=1, max_value=64, value=8)
+    urls = [line.strip() for line in url_text.splitlines() if line.strip()]
+    if urls:
         if st.button("IMPORT", key="import_url"):
-            collection = common.get_vcon_collection()
-            try:
-                document = json.load(url)
-                collection.replace_one({'_id': document['uuid']}, document, upsert=True)
-                st.success("INSERTED SUCCESSFULLY!")
-            except json.JSONDecodeError as e:
-                st.warning("INVALID JSON")
-                st.error(e)
+            # Remember ETags across imports so unchanged URLs are not downloaded again
+            etag_cache = st.session_state.setdefault("url_etags", {})
+            if is_manifest:
+                session = common.get_http_session()
+                urls = [url for manifest_url in urls for url in common.resolve_manifest(session, manifest_url)]
+
+            progress_bar = st.progress(0, text=f"IMPORTING FROM {len(urls)} URLS")
+            pending = []
+            inserted = 0
+            not_modified = 0
+            failed = []
+            for index, result in enumerate(common.fetch_vcon_urls(urls, max_workers=max_workers, etag_cache=etag_cache)):
+                if result["status"] == "failed":
+                    failed.append(result)
+                elif result["status"] == "not modified":
+                    not_modified += 1
+                pending.extend(vcon for vcon in result["vcons"] if isinstance(vcon, dict) and "uuid" in vcon)
+                if len(pending) >= 500:
+                    inserted += common.bulk_upsert_vcons(pending) or 0
+                    pending = []
+                progress_bar.progress((index + 1) / len(urls), text=result["url"])
+            inserted += common.bulk_upsert_vcons(pending) or 0
+
+            st.success(f"INSERTED {inserted}, UNCHANGED URLS: {not_modified}, FAILED URLS: {len(failed)}")
+            for result in failed:
+                st.warning(f"{result['url']}: {result['error']}")
 
 with text_tab:
     # Import from a URL
@@ -205,19 +227,48 @@ with s3_tab:
                     progress_bar.progress(percentage_done, text=key)
             st.success(f"UPLOADED {uploaded_files}, SKIPPED: {skipped_files}")
 
+with directory_tab:
+    "**IMPORT A JSON EXPORT DIRECTORY**"
+    # Follows the manifest written by the JSON export instead of walking the directory tree
+    import_path = st.text_input("ENTER THE DIRECTORY PATH", key="import_directory_path")
+    if import_path:
+        if st.button("IMPORT", key="import_directory"):
+            with st.spinner("IMPORTING VCONS"):
+                imported = common.import_export_directory(import_path)
+            st.success(f"INSERTED {imported} SUCCESSFULLY!")
+
+with bson_tab:
+    "**RESTORE A BSON DUMP**"
+    # Reads a <collection>.bson file from the server, as written by the BSON export or mongodump
+    bson_path = st.text_input("ENTER THE PATH TO THE .bson FILE", key="import_bson_path")
+    replace_existing = st.checkbox("REPLACE EXISTING VCONS", value=True, help="Uncheck for a faster insert into an empty collection")
+    if bson_path:
+        if st.button("RESTORE", key="import_bson"):
+            metadata_path = bson_path[:-len(".bson")] + ".metadata.json" if bson_path.endswith(".bson") else None
+            metadata = common.load_bson_metadata(metadata_path) if metadata_path and os.path.exists(metadata_path) else None
+            with st.spinner("RESTORING VCONS"):
+                with open(bson_path, "rb", buffering=common.EXPORT_WRITE_BUFFER) as f:
+                    restored = common.restore_vcons_bson(f, metadata=metadata, replace_existing=replace_existing)
+            st.success(f"RESTORED {restored or 0} VCONS")
+
 st.divider()
 st.header('EXPORT')
-tab_names= ["EXPORT", "REDIS", "S3"]
-export_tab, export_redis_tab, export_s3_tab = st.tabs(tab_names)
+tab_names= ["EXPORT", "REDIS", "S3", "BACKGROUND JOBS"]
+export_tab, export_redis_tab, export_s3_tab, jobs_tab = st.tabs(tab_names)
 
 with export_tab:
     """
     Exports vCons from the database to either a 
-    single JSONL file or individual JSON files.
+    single JSONL file, individual JSON files, or a
+    mongodump-compatible BSON dump.
     """
-    output_format = st.radio("EXPORT FORMAT", ("JSONL", "JSON"))
+    output_format = st.radio("EXPORT FORMAT", ("JSONL", "JSON", "BSON"))
     DEFAULT_PATH = ""
     path = st.text_input("ENTER THE DIRECTORY PATH", value=DEFAULT_PATH)
+    if output_format == "JSON":
+        # Individual files are spread over uuid-prefix subdirectories, e.g. ab/cd/<uuid>.vcon.json
+        shard_depth = st.number_input("SUBDIRECTORY LEVELS", min_value=0, max_value=4, value=2)
+        export_workers = st.number_input("PARALLEL WRITERS", min_value=1, max_value=64, value=8)
     exporting = st.button("EXPORT VCONS", key="export")
 
     if exporting: 
@@ -225,7 +276,11 @@ with export_tab:
         with st.spinner("EXPORTING VCONS"):
             collection = common.get_vcon_collection()
             vcons = collection.find()
-            if output_format == "JSONL":
+            if output_format == "BSON":
+                # Raw documents go straight from the cursor to disk, no JSON round trip
+                bson_path, exported = common.dump_vcons_bson(path or ".")
+                st.write(f"WROTE {exported} VCONS TO {bson_path}")
+            elif output_format == "JSONL":
                 # Open a file for writing in JSONL format
                 with open(f"{path}output.jsonl", "w") as file:
                     # Iterate through each JSON object in the array
@@ -234,13 +289,23 @@ with export_tab:
                         json_line = json.dumps(vcon)
                         file.write(json_line + "\n")
             else:
-                for vcon in vcons:
-                    uuid = vcon['uuid']
-                    filename = path + uuid + ".vcon.json"
-                    with open(filename, "w") as f:
-                        f.write(json.dumps(vcon))
-                        f.close()
+                exported = common.export_vcons_to_directory(
+                    path or ".",
+                    depth=shard_depth,
+                    max_workers=export_workers,
+                )
+                st.write(f"EXPORTED {exported} VCONS")
         st.success("COMPLETE")
+
+    if output_format == "JSON":
+        check_hashes = st.checkbox("VERIFY HASHES (SLOWER)")
+        if st.button("VERIFY EXPORT", key="verify_export"):
+            checked, problems = common.verify_export_directory(path or ".", check_hashes=check_hashes)
+            if problems:
+                st.warning(f"{len(problems)} OF {checked} FILES FAILED VERIFICATION")
+                st.write(problems[:100])
+            else:
+                st.success(f"VERIFIED {checked} FILES")
         
 with export_redis_tab:
     
@@ -300,4 +365,45 @@ with export_s3_tab:
                 progress_bar.progress((index + 1) / count)
 
             # After the upload operation
-            st.success("COMPLETE")
\ No newline at end of file
+            st.success("COMPLETE")
+
+with jobs_tab:
+    """
+    Queues a bulk job for the headless workers instead of running it in this
+    browser session. Start workers on any node with `python -m lib.worker run`.
+    """
+    job_type = st.selectbox("JOB TYPE", ["export_jsonl", "export_json", "export_s3", "import_s3", "embed_milvus", "build_indexes"])
+    if job_type in ("export_jsonl", "export_json"):
+        job_params = {"path": st.text_input("ENTER THE DIRECTORY PATH", key="job_path")}
+    elif job_type == "embed_milvus":
+        job_params = {
+            "collection": st.text_input("ENTER MILVUS COLLECTION", key="job_milvus_collection"),
+            "missing_only": st.checkbox("ONLY VCONS NOT YET IN THE COLLECTION", value=True, key="job_missing_only"),
+        }
+    elif job_type == "build_indexes":
+        job_params = {}
+    else:
+        job_params = {
+            "s3_bucket": st.text_input("ENTER S3 BUCKET", key="job_s3_bucket"),
+            "s3_path": st.text_input("ENTER S3 PATH", key="job_s3_path"),
+        }
+    # S3 imports are keyed by object name, not uuid, and indexes cover the whole collection, so neither is sharded
+    shards = 1 if job_type in ("import_s3", "build_indexes") else st.number_input("SHARDS (UUID RANGES)", min_value=1, max_value=256, value=1)
+    if st.button("QUEUE JOB", key="queue_job"):
+        job_ids = common.enqueue_sharded_jobs(job_type, job_params, shards=shards)
+        st.success(f"QUEUED {len(job_ids)} JOBS")
+
+    jobs = common.list_jobs(limit=50) or []
+    if jobs:
+        st.dataframe([
+            {
+                "Type": job["type"],
+                "Status": job["status"],
+                "Range": f"{job['params'].get('uuid_lower') or 'start'}-{job['params'].get('uuid_upper') or 'end'}",
+                "Attempts": job.get("attempts", 0),
+                "Worker": job.get("lease_owner"),
+                "Created": job["created_at"],
+                "Result": str(job.get("result") or job.get("error") or ""),
+            }
+            for job in jobs
+        ], hide_index=True)
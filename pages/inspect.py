@@ -1,7 +1,8 @@
 import streamlit as st
 import json
 import lib.common as common
-import pickle
+import lib.audio as audio
+from lib.json_viewer import json_viewer
 
 common.init_session_state()
 common.sidebar()
@@ -9,20 +10,49 @@ common.sidebar()
 # Title and page layout
 st.title("VCON INSPECTOR")
 
-# Function to return the summary of a vCon if it's available
-def get_vcon_summary(vcon):
-    if vcon:
-        analysis = vcon.get('analysis', [])
-        for a in analysis:
-            if a.get('type') == 'summary':
-                return a.get('body')
-    return None
+# Each section is fetched on its own with a projection, and cached briefly so
+# reruns caused by other widgets do not go back to the database.
+@st.cache_data(ttl="1m", show_spinner=False)
+def load_header(uuid):
+    return common.get_vcon_header(uuid)
+
+@st.cache_data(ttl="1m", show_spinner=False)
+def load_section(uuid, section):
+    return common.get_vcon_section(uuid, section)
+
+@st.cache_data(ttl="1m", show_spinner=False)
+def load_complete(uuid):
+    return common.get_vcon(uuid, include_full_dialog=False)
+
+@st.cache_data(ttl="1m", show_spinner=False)
+def load_key_sizes(uuid):
+    return common.get_vcon_key_sizes(uuid)
+
+@st.cache_data(ttl="1m", show_spinner=False, max_entries=4)
+def load_dialog_body(uuid, index):
+    return common.get_dialog_body(uuid, index) or {}
+
+@st.cache_resource
+def get_audio_cache():
+    settings = st.secrets.get("audio", {})
+    return audio.AudioCache(
+        directory=settings.get("cache_dir"),
+        max_bytes=int(settings.get("cache_max_mb", 512)) * 1024 * 1024,
+    )
+
+def serialize_vcon(uuid):
+    """Encode the full vCon, dialog bodies included, as JSON."""
+    return json.dumps(common.get_vcon(uuid), default=str)
+
+def clear_download():
+    # The prepared copy holds every dialog body; drop it once it has been downloaded
+    st.session_state.pop("inspect_download", None)
 
 # Get the vCon ID from session state and clear it to prevent continuous redirection
 initial_vcon = st.session_state.get('selected_vcon', '')
 if 'selected_vcon' in st.session_state:
     del st.session_state.selected_vcon
-    
+
 # Check the query params for a vcon id, if it exists, use it as the initial vcon id
 if 'vcon_uuid' in st.query_params:
     initial_vcon = st.query_params['vcon_uuid']
@@ -32,69 +62,98 @@ selected_vcon = st.text_input("ENTER A VCON ID", value=initial_vcon)
 if selected_vcon:
     st.session_state.selected_vcon = selected_vcon
 
-    # Using the common module function instead of direct connection
-    vcon = common.get_vcon(selected_vcon)
-
-    # ADD A BUTTON FOR DOWNLOADING THE VCON as JSON
-        
-    serialized_data = pickle.dumps(vcon)
-    download = st.download_button(
-        label="DOWNLOAD VCON",
-        data=serialized_data,
-        file_name=f"{selected_vcon}.json",
-        mime="application/json"
+    header = load_header(selected_vcon)
+    if not header:
+        st.error(f"No vCon found with uuid: {selected_vcon}")
+        st.stop()
+    if 'created_at' not in header:
+        st.error("Invalid vCon, both created_at and uuid are required.")
+        st.stop()
+
+    col1, col2 = st.columns(2)
+    with col1:
+        # The full document is only fetched and serialized when asked for
+        if st.button("PREPARE DOWNLOAD"):
+            st.session_state.inspect_download = (selected_vcon, serialize_vcon(selected_vcon))
+        download = st.session_state.get("inspect_download")
+        if download and download[0] == selected_vcon:
+            st.download_button(
+                label="DOWNLOAD VCON",
+                data=download[1],
+                file_name=f"{selected_vcon}.json",
+                mime="application/json",
+                on_click=clear_download,
+            )
+
+    with col2:
+        # ADD A BUTTON FOR ADDING THE UUID TO THE WORKBENCH
+        if st.button("ADD TO INPUTS"):
+            if 'vcon_uuids' not in st.session_state:
+                st.session_state.vcon_uuids = []
+            vcon_uuids = st.session_state.vcon_uuids
+            vcon_uuids.append(selected_vcon)
+            st.session_state.vcon_uuids = vcon_uuids
+            st.success(f"ADDED {selected_vcon} TO WORKBENCH.")
+
+    # Display the summary of the vCon
+    summary = header.get("summary")
+    if summary:
+        st.header("Summary")
+        st.write(summary)
+
+    # Only the selected section is loaded, unlike tabs which render every section at once
+    section = st.radio(
+        "SECTION",
+        ['COMPLETE', 'ANALYSIS', 'DIALOG', 'PARTIES', 'ATTACHMENTS'],
+        horizontal=True,
+        label_visibility="collapsed",
     )
 
-    # ADD A BUTTON FOR ADDING THE UUID TO THE WORKBENCH
-    if st.button("ADD TO INPUTS"):
-        if 'vcon_uuids' not in st.session_state:
-            st.session_state.vcon_uuids = []
-        vcon_uuids = st.session_state.vcon_uuids
-        vcon_uuids.append(selected_vcon)
-        st.session_state.vcon_uuids = vcon_uuids
-        st.success(f"ADDED {selected_vcon} TO WORKBENCH.")
-
-    if vcon:
-        try:
-            created_at = vcon['created_at']
-            updated_at = vcon.get("updated_at", "vCon has not been updated")
-
-            # Make sure we don't throw errors here.
-            parties = vcon.get("parties", [])
-            dialog = vcon.get("dialog", [])
-            attachments = vcon.get("attachments", [])
-            analysis = vcon.get("analysis", [])
-
-            # Display the summary of the vCon
-            summary = get_vcon_summary(vcon)
-            if summary:
-                st.header("Summary")
-                st.write(summary)
-
-            # Create tabs for different sections
-            tabs = st.tabs(['COMPLETE', 'ANALYSIS', 'DIALOG', 'PARTIES', 'ATTACHMENTS'])
-
-            # Display content in respective tabs
-            with tabs[1]:
-                if analysis:
-                    st.json(analysis)
-
-            with tabs[2]:
-                if dialog:
-                    st.json(dialog)
-
-            with tabs[3]:
-                if parties:
-                    st.json(parties)
-
-            with tabs[4]:
-                if attachments:
-                    st.json(attachments)
-
-            with tabs[0]:
-                st.json(vcon)
-
-        except KeyError:
-            st.error("Invalid vCon, both created_at and uuid are required.")
+    if section == 'COMPLETE':
+        # Everything except the dialog bodies, which are loaded per entry on the DIALOG section.
+        # Sizes come from the server so they include the bodies.
+        json_viewer(load_complete(selected_vcon), key="complete", sizes=load_key_sizes(selected_vcon))
+
+    elif section == 'DIALOG':
+        dialog = load_section(selected_vcon, "dialog") or []
+        json_viewer(dialog, key="dialog")
+        if dialog:
+            index = st.number_input("DIALOG ENTRY", min_value=0, max_value=len(dialog) - 1, value=0)
+            entry = dialog[index]
+            mimetype = entry.get('mimetype') or entry.get('mime_type') or ''
+
+            # Remember which body was opened so expanding values in it survives reruns,
+            # and cache it so those reruns do not fetch it again
+            if st.button("LOAD BODY", key="dialog_body"):
+                st.session_state.inspect_body = (selected_vcon, index)
+            if st.session_state.get("inspect_body") == (selected_vcon, index):
+                if st.button("HIDE BODY", key="hide_dialog_body"):
+                    del st.session_state.inspect_body
+                    st.rerun()
+                body_entry = load_dialog_body(selected_vcon, index)
+                json_viewer({"body": body_entry.get("body")}, key=f"dialog_body_{index}")
+
+            if mimetype.startswith("audio/") or entry.get("type") == "recording":
+                if st.button("PLAY RECORDING", key="play_recording"):
+                    st.session_state.inspect_audio = (selected_vcon, index)
+                if st.session_state.get("inspect_audio") == (selected_vcon, index):
+                    with st.spinner("Decoding recording..."):
+                        path = audio.cache_dialog_audio(
+                            get_audio_cache(),
+                            f"{selected_vcon}:{index}",
+                            entry,
+                            lambda: common.get_dialog_body(selected_vcon, index),
+                        )
+                    if not path:
+                        st.warning("This dialog entry has no playable recording.")
+                    else:
+                        segments = audio.segment_count(path)
+                        segment = 0
+                        if segments > 1:
+                            segment = st.number_input(f"SEGMENT (OF {segments})", min_value=1, max_value=segments, value=1) - 1
+                        st.audio(audio.read_segment(path, segment), format="audio/wav" if audio.is_wav(path) else mimetype)
+
     else:
-        st.error(f"No vCon found with uuid: {selected_vcon}")
\ No newline at end of file
+        data = load_section(selected_vcon, section.lower())
+        if data:
+            json_viewer(data, key=section.lower())
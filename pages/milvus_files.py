@@ -1,5 +1,7 @@
 import streamlit as st
 import lib.common as common
+import lib.embeddings as embeddings
+import lib.milvus as milvus
 import json
 import os
 import logging
@@ -56,7 +58,7 @@ milvus_host = st.secrets.get("milvus", {}).get("host", "localhost")
 milvus_port = st.secrets.get("milvus", {}).get("port", "19530")
 
 # Default embedding dimensions for OpenAI embeddings (text-embedding-3-small is 1536 dimensions)
-EMBEDDING_DIM = 1536
+EMBEDDING_DIM = embeddings.EMBEDDING_DIM
 
 # Function to ensure Milvus connection is established
 def ensure_milvus_connection():
@@ -93,171 +95,17 @@ create_tab, load_tab, search_tab, delete_tab, list_tab, debug_tab = st.tabs(tabs
 # Function to get embedding from OpenAI
 @st.cache_data(ttl="1h", show_spinner=False)
 def get_embedding(text):
-    if not text:
-        return [0] * EMBEDDING_DIM  # Return zero vector if text is empty
-    
-    response = client.embeddings.create(
-        input=text,
-        model="text-embedding-3-small"
-    )
-    return response.data[0].embedding
+    # Also looks in the persistent embedding cache; empty text gets a zero vector
+    embedding = embeddings.embed_texts(client, [text or ""])[0]
+    if embedding is None:
+        # Raised rather than returned so the failure is not cached
+        raise ValueError("Could not generate an embedding for the text; see the log for details")
+    return embedding
 
 # Function to extract text from vCon
 @st.cache_data(ttl="1h", show_spinner=False)
-def extract_text_from_vcon(vcon):# -> str | LiteralString | Any:
-    start_time = time.time()
-    vcon_id = vcon.get("uuid", "unknown")
-    logger.info(f"Processing vCon {vcon_id}")
-    
-    text = ""
-    extracted_components = []
-    has_transcript = False
-    has_summary = False
-    
-    # Extract transcript
-    if "transcript" in vcon:
-        transcript_length = len(vcon.get("transcript", []))
-        text += " ".join([item.get("text", "") for item in vcon.get("transcript", []) if "text" in item]) + " "
-        extracted_components.append(f"transcript ({transcript_length} entries)")
-        logger.debug(f"Extracted transcript with {transcript_length} entries from vCon {vcon_id}")
-        has_transcript = transcript_length > 0
-    
-    # Extract summary
-    if "summary" in vcon and vcon["summary"]:
-        text += vcon["summary"] + " "
-        extracted_components.append("summary")
-        logger.debug(f"Extracted summary from vCon {vcon_id}")
-        has_summary = True
-    
-    # Extract party information
-    party_count = 0
-    if "parties" in vcon and vcon["parties"]:
-        for party in vcon["parties"]:
-            party_name = party.get("name", "")
-            party_id = party.get("partyId", "")
-            if party_name or party_id:
-                text += f"Party: {party_name or party_id}. "
-                party_count += 1
-        extracted_components.append(f"parties ({party_count})")
-        logger.debug(f"Extracted {party_count} parties from vCon {vcon_id}")
-    
-    # Extract metadata if available
-    metadata_fields = []
-    if "metadata" in vcon:
-        # Add any important metadata fields
-        if "title" in vcon["metadata"]:
-            text += f"Title: {vcon['metadata']['title']}. "
-            metadata_fields.append("title")
-        if "description" in vcon["metadata"]:
-            text += f"Description: {vcon['metadata']['description']}. "
-            metadata_fields.append("description")
-        if "created" in vcon["metadata"]:
-            text += f"Created: {vcon['metadata']['created']}. "
-            metadata_fields.append("created")
-        
-        if metadata_fields:
-            extracted_components.append(f"metadata ({', '.join(metadata_fields)})")
-            logger.debug(f"Extracted metadata fields: {', '.join(metadata_fields)} from vCon {vcon_id}")
-    
-    raw_text = text.strip()
-    raw_text_length = len(raw_text)
-    
-    logger.info(f"Extracted components from vCon {vcon_id}: {', '.join(extracted_components)}")
-    logger.info(f"Raw text length: {raw_text_length} characters")
-    
-    # Generate AI description ONLY if there's no summary or transcript AND there's enough content
-    if not (has_summary or has_transcript) and len(raw_text) > 10:
-        logger.info(f"No summary or transcript found for vCon {vcon_id}, generating AI description")
-        try:
-            logger.info(f"Generating AI description for vCon {vcon_id}")
-            ai_start_time = time.time()
-            
-            response = client.chat.completions.create(
-                model="gpt-3.5-turbo",
-                messages=[
-                    {"role": "system", "content": "You are an assistant that creates concise descriptions of conversation content."},
-                    {"role": "user", "content": f"Generate a brief description (max 100 words) that summarizes this conversation content: {raw_text[:4000]}"}
-                ],
-                max_tokens=150,
-                temperature=0.5
-            )
-            
-            ai_description = response.choices[0].message.content.strip()
-            ai_time_taken = time.time() - ai_start_time
-            
-            logger.info(f"AI description generated in {ai_time_taken:.2f}s for vCon {vcon_id}")
-            final_text = f"{ai_description}\n\nRaw Content: {raw_text}"
-            
-            total_time = time.time() - start_time
-            logger.info(f"Total processing time for vCon {vcon_id}: {total_time:.2f}s")
-            return final_text
-        except Exception as e:
-            logger.error(f"Failed to generate AI description for vCon {vcon_id}: {str(e)}")
-            st.warning(f"Could not generate AI description: {e}")
-            return raw_text
-    elif has_summary or has_transcript:
-        logger.info(f"vCon {vcon_id} already has summary or transcript, skipping AI description generation")
-    
-    total_time = time.time() - start_time
-    logger.info(f"Total processing time for vCon {vcon_id}: {total_time:.2f}s")
-    return raw_text
-
-# Function to extract party ID from vCon with better handling
-def extract_party_id(vcon):
-    """Extract a meaningful party identifier from a vCon based on standard vCon structure"""
-    logger.debug(f"Extracting party ID from vCon {vcon.get('uuid', 'unknown')}")
-    
-    if not vcon.get("parties"):
-        logger.debug("No parties array found in vCon")
-        # Try alternative fields if parties is not available
-        if vcon.get("metadata", {}).get("creator"):
-            return vcon["metadata"]["creator"]
-        return "no_party_info"
-    
-    # Try to find a non-empty party ID from any party in the array
-    for party in vcon["parties"]:
-        # First priority: UUID as it's unique
-        if party.get("uuid"):
-            logger.debug(f"Using party UUID: {party['uuid']}")
-            return party["uuid"]
-        
-        # Second priority: Contact methods (tel, mailto)
-        if party.get("tel"):
-            logger.debug(f"Using party telephone: {party['tel']}")
-            return f"tel:{party['tel']}"
-        
-        if party.get("mailto"):
-            logger.debug(f"Using party email: {party['mailto']}")
-            return f"mailto:{party['mailto']}"
-        
-        # Third priority: Name and role combined
-        if party.get("name") and party.get("role"):
-            combined = f"{party['role']}:{party['name']}"
-            logger.debug(f"Using party role+name: {combined}")
-            return combined
-        
-        # Fourth priority: Just name or role
-        if party.get("name"):
-            logger.debug(f"Using party name: {party['name']}")
-            return party["name"]
-        
-        if party.get("role"):
-            logger.debug(f"Using party role: {party['role']}")
-            return party["role"]
-        
-        # Fifth priority: Any other unique identifier in the party object
-        for field in ["partyId", "PartyId", "party_id", "id", "userID", "userId"]:
-            if party.get(field):
-                logger.debug(f"Found non-standard ID {party[field]} using field {field}")
-                return party[field]
-    
-    # If we got here but have parties, use the first party's index as identifier
-    if vcon["parties"]:
-        logger.debug("No explicit identifiers found, using party index")
-        return f"party_index:0"
-    
-    logger.debug("No usable party identifier found")
-    return "unknown_party"
+def extract_text_from_vcon(vcon):
+    return milvus.extract_text_from_vcon(client, vcon)
 
 # Function to handle the Milvus save operation outside the main app flow
 def save_to_milvus(collection_name, vcon, party_id, text, embedding):
@@ -418,43 +266,56 @@ with load_tab:
             st.write("Limit the number of vCons to process (0 = no limit)")
         with limit_col2:
             vcon_limit = st.number_input("Max vCons", min_value=0, value=0, step=10, help="Set a limit on how many vCons to process. Use 0 for no limit.")
-        
+        batch_size = st.number_input("Batch Size", min_value=1, max_value=embeddings.MAX_BATCH_INPUTS, value=500, step=100,
+                                     help="vCons read, embedded and inserted together. Embeddings for a batch are requested in as few calls as possible.")
+        
+        pipeline_col1, pipeline_col2, pipeline_col3 = st.columns(3)
+        with pipeline_col1:
+            embed_workers = st.number_input("Embedding Workers", min_value=1, max_value=32, value=4,
+                                            help="Batches embedded at the same time while earlier batches are inserted")
+        with pipeline_col2:
+            requests_per_minute = st.number_input("Embedding Requests/min (0 = no limit)", min_value=0, value=0, step=100)
+        with pipeline_col3:
+            tokens_per_minute = st.number_input("Embedding Tokens/min (0 = no limit)", min_value=0, value=0, step=100000)
+
+        def prepare_vcon_row(vcon):
+            """Text to embed for a vCon, and its Milvus row without the embedding."""
+            return milvus.vcon_row(vcon, extract_text_from_vcon(vcon))
+
         # Function to handle batch loading
         def load_vcons_to_milvus():
-            vcons = common.get_vcons()
-            
-            if not vcons:
+            total = common.count_vcons() or 0
+            if not total:
                 st.warning("No vCons found in the database.")
                 return
-            
-            # Apply limit if specified
-            if vcon_limit > 0 and len(vcons) > vcon_limit:
-                logger.info(f"Limiting vCon processing to {vcon_limit} out of {len(vcons)} total vCons")
-                st.info(f"Processing {vcon_limit} out of {len(vcons)} available vCons (limit applied)")
-                vcons = vcons[:vcon_limit]
-                
+
             # Ensure connection is active right before querying
             connection_status = ensure_milvus_connection()
             if not connection_status:
                 st.error("Failed to establish Milvus connection. Cannot proceed with loading operation.")
                 logger.error("Milvus connection failed during load operation")
                 return
-                
+
             # Verify collection still exists
             if not utility.has_collection(selected_collection):
                 st.error(f"Collection {selected_collection} no longer exists or is not accessible")
                 logger.error(f"Collection {selected_collection} does not exist at load time")
                 return
-                
+
+            try:
+                collection = Collection(selected_collection)
+                collection.load()
+            except Exception as e:
+                logger.exception(f"Error loading collection for insertion: {str(e)}")
+                st.error(f"Error loading collection for insertion: {str(e)}")
+                with st.expander("Exception Details", expanded=True):
+                    st.exception(e)
+                return
+
             # Get existing vCon UUIDs from Milvus if in "missing only" mode
             existing_uuids = set()
             if loading_mode == "Load Only Missing vCons":
                 try:
-                    logger.info(f"Loading collection {selected_collection} to check existing vCons")
-                    collection = Collection(selected_collection)
-                    collection.load()
-                    
-                    # Query to get all existing UUIDs
                     logger.info("Querying for existing vCon UUIDs")
                     results = collection.query(
                         expr="vcon_uuid != ''",
@@ -469,126 +330,58 @@ with load_tab:
                     with st.expander("Exception Details", expanded=True):
                         st.exception(e)
                     return
-            
-            # Filter vCons if in "missing only" mode
-            if loading_mode == "Load Only Missing vCons":
-                to_process = [vcon for vcon in vcons if vcon["uuid"] not in existing_uuids]
-                logger.info(f"Found {len(to_process)} vCons to add to Milvus")
-                st.info(f"Found {len(to_process)} vCons to add to Milvus")
-            else:
-                to_process = vcons
-            
+
+            to_process = max(total - len(existing_uuids), 0)
+            if vcon_limit > 0:
+                to_process = min(to_process, vcon_limit)
+                st.info(f"Processing at most {vcon_limit} of {total} available vCons (limit applied)")
             if not to_process:
                 st.success("No new vCons to add. All vCons already exist in Milvus!")
                 return
-                
-            # Create a fresh collection reference for insertion
-            try:
-                collection = Collection(selected_collection)
-                collection.load()
-            except Exception as e:
-                logger.exception(f"Error loading collection for insertion: {str(e)}")
-                st.error(f"Error loading collection for insertion: {str(e)}")
-                with st.expander("Exception Details", expanded=True):
-                    st.exception(e)
-                return
-                
+
+            def read_vcons():
+                """Stream vCons from MongoDB without dialog bodies, skipping those already in Milvus."""
+                cursor = common.get_vcon_collection().find({}, {"_id": 0, "dialog.body": 0}, batch_size=batch_size)
+                sent = 0
+                for vcon in cursor:
+                    if vcon["uuid"] in existing_uuids:
+                        continue
+                    yield vcon
+                    sent += 1
+                    if vcon_limit > 0 and sent >= vcon_limit:
+                        break
+
             progress_bar = st.progress(0)
             status_text = st.empty()
-            
-            # Process in batches
-            batch_size = 100
-            total_success = 0
-            total_failed = 0
-            
-            for batch_start in range(0, len(to_process), batch_size):
-                batch_end = min(batch_start + batch_size, len(to_process))
-                batch = to_process[batch_start:batch_end]
-                
-                status_text.text(f"Processing batch {batch_start//batch_size + 1}/{(len(to_process)-1)//batch_size + 1} ({batch_start+1}-{batch_end}/{len(to_process)})")
-                
-                # Prepare batch data
-                data = []
-                batch_failed = 0
-                
-                for i, vcon in enumerate(batch):
-                    try:
-                        # Extract text from vCon
-                        text = extract_text_from_vcon(vcon)
-                        
-                        # Get party identifier with better extraction
-                        party_id = extract_party_id(vcon)
-                        
-                        # Get embedding
-                        embedding = get_embedding(text)
-                        
-                        # Validate embedding
-                        if not isinstance(embedding, list) or len(embedding) != EMBEDDING_DIM:
-                            error_msg = f"Invalid embedding for vCon {vcon['uuid']}: expected list with {EMBEDDING_DIM} dimensions"
-                            logger.error(error_msg)
-                            batch_failed += 1
-                            continue
-                        
-                        # Extract key metadata and ensure they are strings
-                        metadata = vcon.get("metadata", {})
-                        created_at = str(metadata.get("created_at", "")) if metadata.get("created_at") is not None else ""
-                        updated_at = str(metadata.get("updated_at", "")) if metadata.get("updated_at") is not None else ""
-                        subject = str(vcon.get("subject", "")) if vcon.get("subject") is not None else ""
-                        title = str(metadata.get("title", "")) if metadata.get("title") is not None else ""
-                        
-                        # Content indicators
-                        has_transcript = bool(vcon.get("transcript"))
-                        has_summary = bool(vcon.get("summary"))
-                        party_count = len(vcon.get("parties", []))
-                        
-                        # Ensure party_id is a string
-                        party_id = str(party_id) if party_id is not None else ""
-                        
-                        # Ensure text is a string
-                        text = str(text) if text is not None else ""
-                        
-                        # Prepare enriched data object
-                        data.append({
-                            "vcon_uuid": vcon["uuid"],
-                            "party_id": party_id,
-                            "text": text,
-                            "embedding": embedding,
-                            "created_at": created_at,
-                            "updated_at": updated_at,
-                            "subject": subject,
-                            "metadata_title": title,
-                            "has_transcript": has_transcript,
-                            "has_summary": has_summary,
-                            "party_count": party_count,
-                            "embedding_model": "text-embedding-3-small",
-                            "embedding_version": "1.0"
-                        })
-                        
-                    except Exception as e:
-                        logger.exception(f"Error processing vCon {vcon.get('uuid', 'unknown')}: {str(e)}")
-                        batch_failed += 1
-                
-                # Insert batch if we have data
-                if data:
-                    try:
-                        logger.info(f"Inserting batch of {len(data)} vCons")
-                        insert_result = collection.insert(data)
-                        logger.info(f"Insert result: {insert_result}")
-                        collection.flush()
-                        total_success += len(data)
-                    except Exception as e:
-                        logger.exception(f"Error inserting batch: {str(e)}")
-                        st.error(f"Error inserting batch: {str(e)}")
-                        with st.expander(f"Batch {batch_start//batch_size + 1} Error Details", expanded=False):
-                            st.exception(e)
-                        total_failed += len(data)
-                
-                total_failed += batch_failed
-                
-                # Update progress
-                progress = (batch_end) / len(to_process)
-                progress_bar.progress(progress)
-            
+            metrics_table = st.empty()
+
+            def show_progress(metrics):
+                done = metrics["insert"]["items"] + metrics["insert"]["failed"] + metrics["embed"]["failed"]
+                progress_bar.progress(min(done / to_process, 1.0))
+                status_text.text(f"{metrics['insert']['items']} of about {to_process} vCons inserted, "
+                                 f"{metrics['insert']['per_second']} vCons/s")
+                metrics_table.dataframe(list(metrics.values()), hide_index=True)
+
+            try:
+                metrics = embeddings.run_embedding_pipeline(
+                    client,
+                    read_vcons(),
+                    prepare_vcon_row,
+                    milvus.flushing_insert(collection),
+                    batch_size=batch_size,
+                    workers=embed_workers,
+                    expected_dim=EMBEDDING_DIM,
+                    requests_per_minute=requests_per_minute or None,
+                    tokens_per_minute=tokens_per_minute or None,
+                    progress=show_progress,
+                )
+            finally:
+                # Whatever was inserted before a failure is still made durable
+                collection.flush()
+            metrics_table.dataframe(list(metrics.values()), hide_index=True)
+
+            total_success = metrics["insert"]["items"]
+            total_failed = metrics["embed"]["failed"] + metrics["insert"]["failed"]
             # Final update
             if total_failed > 0:
                 st.warning(f"Completed with {total_success} vCons loaded successfully and {total_failed} failures.")
@@ -596,7 +389,7 @@ with load_tab:
             else:
                 st.success(f"Successfully loaded {total_success} vCons into Milvus!")
                 logger.info(f"Successfully loaded {total_success} vCons into Milvus!")
-        
+
         if st.button("Load vCons", key="load_vcons_button"):
             with st.spinner("Processing vCons..."):
                 load_vcons_to_milvus()
@@ -612,10 +405,15 @@ with search_tab:
         search_text = st.text_input("Search Query")
         top_k = st.slider("Number of Results", min_value=1, max_value=50, value=5)
         
+        query_embedding = None
         if st.button("Search") and search_text:
             # Get embedding for search query
-            query_embedding = get_embedding(search_text)
-            
+            try:
+                query_embedding = get_embedding(search_text)
+            except ValueError as e:
+                st.error(str(e))
+
+        if query_embedding is not None:
             collection = Collection(selected_collection)
             collection.load()
             
@@ -784,13 +582,21 @@ with debug_tab:
         def generate_embedding():
             st.session_state.current_vcon = selected_vcon
             st.session_state.current_raw_text = extract_text_from_vcon(selected_vcon)
-            st.session_state.current_embedding = get_embedding(st.session_state.current_raw_text)
+            st.session_state.embedding_error = None
+            try:
+                st.session_state.current_embedding = get_embedding(st.session_state.current_raw_text)
+            except ValueError as e:
+                st.session_state.current_embedding = None
+                st.session_state.embedding_error = str(e)
+                return
             logger.info(f"Generated embedding for vCon {selected_vcon['uuid']} with dimensions {len(st.session_state.current_embedding)}")
         
         # Generate embedding on button click
         if selected_vcon and st.button("Generate Embedding", key="debug_generate_button", on_click=generate_embedding if selected_vcon else None):
             # The actual work happens in the on_click callback
             pass
+        if st.session_state.get("embedding_error"):
+            st.error(st.session_state.embedding_error)
         
         # If we have an embedding in session state, display it
         if st.session_state.current_embedding is not None and st.session_state.current_vcon is not None:
@@ -858,7 +664,7 @@ with debug_tab:
                     logger.info(f"Save button clicked for vCon {st.session_state.current_vcon['uuid']}")
                     
                     # Get party identifier with better extraction
-                    party_id = extract_party_id(st.session_state.current_vcon)
+                    party_id = milvus.extract_party_id(st.session_state.current_vcon)
                     
                     # Execute save operation via the helper function - passing the full vCon object
                     save_to_milvus(
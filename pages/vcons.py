@@ -4,7 +4,7 @@ import lib.common as common
 from vcon import Vcon
 import json
 import pandas as pd
-from datetime import datetime
+from datetime import datetime, time, timedelta
 
 common.init_session_state()
 common.sidebar()
@@ -37,6 +37,47 @@ with col3:
     # Get the selected sort option
     sort_config = sort_options[sort_selection]
 
+# Filters are compiled into a MongoDB query so only matching vCons leave the database.
+# Their indexes are built on request (or by a build_indexes worker job), never on page load.
+with st.expander("Indexes"):
+    st.caption("Filters and sorts scan the whole collection until their indexes exist. "
+               "Building them on a large collection takes a while and adds load to MongoDB.")
+    if st.button("BUILD FILTER INDEXES"):
+        with st.spinner("Building indexes..."):
+            common.ensure_vcon_indexes()
+        st.success("Indexes are built")
+
+with st.expander("Filters"):
+    filter_col1, filter_col2, filter_col3 = st.columns(3)
+    with filter_col1:
+        date_range = st.date_input("Created between", value=(), help="Pick a start and end date")
+        mime_type = st.text_input("Dialog mime type", placeholder="audio/x-wav")
+    with filter_col2:
+        party_tel = st.text_input("Party tel", placeholder="+15555550100")
+        party_mailto = st.text_input("Party mailto", placeholder="someone@example.com")
+        party_name = st.text_input("Party name starts with")
+    with filter_col3:
+        analysis_type = st.text_input("Has analysis type", placeholder="summary")
+        tags_text = st.text_input("Tags", placeholder="key:value, key:value")
+
+start = end = None
+if len(date_range) >= 1:
+    start = datetime.combine(date_range[0], time.min)
+if len(date_range) == 2:
+    # The end date is inclusive in the picker
+    end = datetime.combine(date_range[1] + timedelta(days=1), time.min)
+
+vcon_filter = common.build_vcon_filter(
+    start=start,
+    end=end,
+    party_tel=party_tel.strip() or None,
+    party_mailto=party_mailto.strip() or None,
+    party_name=party_name.strip() or None,
+    mime_type=mime_type.strip() or None,
+    analysis_type=analysis_type.strip() or None,
+    tags=[tag.strip() for tag in tags_text.split(",") if tag.strip()],
+)
+
 
 with col1:
     # Create a status container for feedback
@@ -52,11 +93,13 @@ with col1:
             limit=limit, 
             sort_by=sort_config["field"], 
             sort_order=sort_config["order"],
-            include_full_dialog=False  # Only fetch metadata, not the large dialog body content
+            include_full_dialog=False,  # Only fetch metadata, not the large dialog body content
+            query=vcon_filter
         )
+        match_count = common.count_vcons(vcon_filter)
         
         if not vcons:
-            status.update(label="No vCons found in database", state="complete")
+            status.update(label="No matching vCons found in database", state="complete")
             st.stop()
             
         # Update status for data processing
@@ -96,8 +139,8 @@ with col1:
             # Add estimated size information
             dialog_types = {}
             for dialog in vcon.get('dialog', []):
-                mime_type = dialog.get('mime_type', 'unknown')
-                dialog_types[mime_type] = dialog_types.get(mime_type, 0) + 1
+                dialog_mime = dialog.get('mimetype') or dialog.get('mime_type', 'unknown')
+                dialog_types[dialog_mime] = dialog_types.get(dialog_mime, 0) + 1
             
             # Format dialog types as a string
             dialog_types_str = ", ".join([f"{count} {mime}" for mime, count in dialog_types.items()])
@@ -128,7 +171,7 @@ with col1:
         display_df = df[display_cols]
             
         # Update status to complete
-        status.update(label=f"Successfully loaded and processed {len(vcons)} vCons", state="complete")
+        status.update(label=f"Showing {len(vcons)} of {match_count} matching vCons", state="complete")
 
 # Configure the dataframe with column settings
 column_config = {
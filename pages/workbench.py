@@ -1,16 +1,12 @@
 import streamlit as st
-import json
+import time
 import lib.common as common
+import lib.llm as llm
 
 common.init_session_state()
 common.sidebar()
 
-# This code is for v1 of the openai package: pypi.org/project/openai
-from openai import OpenAI
-OPENAI_API_KEY=st.secrets["openai"]["secret_key"]
-open_ai_client = OpenAI(
-    api_key=OPENAI_API_KEY
-)
+open_ai_client = llm.get_openai_client()
 
 # Title and page layout
 st.title("VCON WORKBENCH")
@@ -24,13 +20,9 @@ def get_vcon_summary(vcon):
                 return a.get('body')
     return None
 
-def get_vcon_transcript(vcon):
-    if vcon:
-        analysis = vcon.get('analysis', [])
-        for a in analysis:
-            if a.get('type') == 'transcript':
-                return a.get('body')
-    return None
+@st.cache_resource
+def get_random_pool():
+    return common.RandomVconPool()
 
 # We are going to keep two different arrays of state.
 # The first is a list of vCons that we are going to analyze.
@@ -44,8 +36,8 @@ vcon_uuids = st.session_state.vcon_uuids
 prompts = st.session_state.prompts
 
 # Make three tabs, one for the vCons, one for the prompts, and one for the results
-tab_names = ["ADD VCONS", "CONFIGURE PROMPTS", "RUN ANALYSIS"]
-vcon_tab, prompt_tab, results_tab = st.tabs(tab_names)
+tab_names = ["ADD VCONS", "CONFIGURE PROMPTS", "RUN ANALYSIS", "BATCH MODE"]
+vcon_tab, prompt_tab, results_tab, batch_tab = st.tabs(tab_names)
 
 with vcon_tab: 
     "**ADD INPUT BY ID**"
@@ -59,50 +51,48 @@ with vcon_tab:
     col1, col2 = st.columns(2)
     with col1:
         pick_random = st.button("FIND RANDOM VCON")
-        if pick_random:
-            st.rerun()
-
         summary_only = st.checkbox("ONLY PICK VCONS WITH SUMMARIES")
 
-        # Get a random vCon from the database using common module
-        collection = common.get_vcon_collection()
-        if summary_only:
-            vcon = collection.aggregate([{'$match': {'analysis.type': 'summary'}}, {'$sample': {'size': 1}}]) 
-        else:
-            vcon = collection.aggregate([{'$sample': {'size': 1}}])
-        vcon = list(vcon)[0]
+        # Picks come from a pre-sampled pool and stay in the session until the
+        # button is clicked or the filter changes, so reruns do no database work
+        picked = st.session_state.get("random_vcon")
+        if pick_random or picked is None or picked[0] != summary_only:
+            random_filter = {'analysis.type': 'summary'} if summary_only else None
+            picked = (summary_only, get_random_pool().take(random_filter))
+            st.session_state.random_vcon = picked
+        vcon = picked[1]
 
         # Show the summary of the vCon, if it's available.
-        summary = get_vcon_summary(vcon)
-        if summary:
-            st.markdown(f"> {summary}")
+        if vcon and vcon.get("summary"):
+            st.markdown(f"> {vcon['summary']}")
 
     with col2:
-        # Show the created_at and updated_at timestamps
-        created_at = vcon['created_at']
-        updated_at = vcon.get("updated_at", "vCon has not been updated")
-        st.markdown(f"**UUID**: {vcon['uuid']}")
-        st.markdown(f"**Created at**: {created_at}")
-        st.markdown(f"**Updated at**: {updated_at}")
-
-
-        # Show a link to the detail page
-        st.markdown(f"[VCON DETAILS](/inspect?uuid={vcon['uuid']})")
-        add_random = st.button("ADD TO INPUTS", key="random") 
-        # Also show a link to the vCon 
-        if add_random:
-            vcon_uuids.append(vcon['uuid'])
-            st.session_state.vcon_uuids = vcon_uuids
-            st.success(f"ADDED {vcon['uuid']} TO WORKBENCH")
-
+        if not vcon:
+            st.info("No vCons found.")
+        else:
+            # Show the created_at and updated_at timestamps
+            created_at = vcon['created_at']
+            updated_at = vcon.get("updated_at", "vCon has not been updated")
+            st.markdown(f"**UUID**: {vcon['uuid']}")
+            st.markdown(f"**Created at**: {created_at}")
+            st.markdown(f"**Updated at**: {updated_at}")
 
+            # Show a link to the detail page
+            st.markdown(f"[VCON DETAILS](/inspect?uuid={vcon['uuid']})")
+            add_random = st.button("ADD TO INPUTS", key="random")
+            if add_random:
+                vcon_uuids.append(vcon['uuid'])
+                st.session_state.vcon_uuids = vcon_uuids
+                st.success(f"ADDED {vcon['uuid']} TO WORKBENCH")
 
     st.divider()
     st.subheader(f"CURRENT VCON INPUTS ({len(vcon_uuids)})")
 
+    # One query for every input, carrying only the summaries shown here
+    input_vcons = common.get_vcons_by_uuid(vcon_uuids, analysis_types=["summary"]) or {}
     for vcon_uuid in vcon_uuids:
         st.markdown(f"**vCon UUID**: {vcon_uuid}")
-        vcon = common.get_vcon(vcon_uuid)
+        vcon = input_vcons.get(vcon_uuid)
         # Show the summary of the vCon, if it's available.
         summary = get_vcon_summary(vcon)
         if summary:
@@ -125,10 +115,7 @@ with prompt_tab:
     system_prompt = st.text_area("SYSTEM PROMPT", "The following is a vCon conversation between two parties, captured in a JSON. The parties array is a list of participants; the dialog array are the recordings, emails and transcripts. The analysis array contains transcripts and summaries and other analysis types. The attachments array is a list of documents describing the context of the conversation.")
     user_prompt = st.text_area("USER PROMPT", "Summarize this conversation.")
     # Fetch the model names from OpenAI
-    models = open_ai_client.models.list()    
-    model_names = [model.id for model in models]
-    # alphabetixe the model names
-    model_names.sort()
+    model_names = llm.list_models(open_ai_client)
     model_name = st.selectbox("MODEL NAME", model_names)
     temperature = st.slider("TEMPERATURE", 0.0, 1.0, 0.5, 0.01)
     input_types = ["complete", "summary", "transcript"]
@@ -144,8 +131,59 @@ with prompt_tab:
     st.session_state.prompts = prompts
 
 
+def build_prompt_requests(vcon_uuids):
+    """
+    Build a completion request per vCon from the configured prompt.
+
+    Returns:
+        Tuple of (requests, {uuid: completion cache key}, uuids with no content for the input type,
+        {uuid: dialog indexes the input covers})
+    """
+    requests = []
+    cache_keys = {}
+    missing = []
+    dialogs = {}
+    # Fetch every input at once, projected down to what the input type needs
+    input_analysis_types = {"complete": None, "summary": ["summary"], "transcript": ["transcript"]}[input_type]
+    input_vcons = common.get_vcons_by_uuid(vcon_uuids, analysis_types=input_analysis_types, strip_binary=True) or {}
+    for vcon_uuid in dict.fromkeys(vcon_uuids):
+        # Get the content, either the transcript or the summary or the vCon without binary bodies
+        # The workbench's own results are left out, so saving them does not change the cache key
+        content = llm.prepare_content(input_vcons.get(vcon_uuid), input_type, exclude_analysis_type=analysis_type)
+        if not content:
+            missing.append(vcon_uuid)
+            continue
+        cache_keys[vcon_uuid] = llm.completion_cache_key(content, system_prompt, user_prompt, model_name, temperature)
+        dialogs[vcon_uuid] = llm.analysis_dialog(input_vcons.get(vcon_uuid), input_type)
+        requests.append({
+            "key": vcon_uuid,
+            "model": model_name,
+            "temperature": temperature,
+            "messages": [
+                {"role": "system", "content": system_prompt},
+                {"role": "user", "content": user_prompt},
+                {"role": "assistant", "content": content}
+            ]
+        })
+    return requests, cache_keys, missing, dialogs
+
+
 # Show the results tab
 with results_tab:
+    with st.expander("EXECUTION SETTINGS"):
+        concurrency = st.number_input("CONCURRENT REQUESTS", min_value=1, max_value=64, value=8)
+        requests_per_minute = st.number_input("REQUESTS PER MINUTE (0 = NO LIMIT)", min_value=0, value=500)
+        tokens_per_minute = st.number_input("TOKENS PER MINUTE (0 = NO LIMIT)", min_value=0, value=200000)
+        max_retries = st.number_input("RETRIES ON RATE LIMITS", min_value=0, max_value=10, value=5)
+        max_chunk_tokens = st.number_input("MAX TOKENS PER CHUNK", min_value=500, value=16000, step=500,
+                                           help="Longer inputs are split into chunks, answered in parallel and then combined")
+        use_cache = st.checkbox("USE CACHED RESULTS", value=True)
+        force_refresh = st.checkbox("FORCE REFRESH", help="Call the model even when a cached result exists, and replace it")
+        cache_ttl_days = st.number_input("CACHE TTL (DAYS)", min_value=1, value=30)
+        cache_max_entries = st.number_input("MAX CACHE ENTRIES", min_value=100, value=100000, step=1000)
+        save_results = st.checkbox("SAVE RESULTS TO VCONS", help="Append each new result to its vCon as an analysis entry")
+        analysis_type = st.text_input("ANALYSIS TYPE", value="workbench", help="Use 'summary' or 'transcript' to feed later workbench inputs")
+
     if st.button(f"RUN ANALYSIS FOR {len(vcon_uuids)} VCONS"):
         if st.expander("Show Prompt"):
             st.code(f"""
@@ -155,37 +193,179 @@ with results_tab:
                 user_prompt = {user_prompt}
                 input_type = {input_type}
                 """)
-        for vcon_uuid in vcon_uuids:
-            # Get the content, either the transcript or the summary or the dialog
-            vcon = common.get_vcon(vcon_uuid)
-            match input_type:
-                case "complete":
-                    content = json.dumps(vcon)
-                case "summary":
-                    content = get_vcon_summary(vcon)
-                case "transcript":
-                    content = get_vcon_transcript(vcon)
-
-            # Call open AI to complete the prompt
-            st.subheader(f"RESULTS FOR VCON {vcon_uuid}")
+
+        requests, cache_keys, missing, dialogs = build_prompt_requests(vcon_uuids)
+
+        # Reserve a slot per vCon so results render in input order as they arrive
+        result_slots = {}
+        for vcon_uuid in dict.fromkeys(vcon_uuids):
+            slot = st.container()
+            slot.subheader(f"RESULTS FOR VCON {vcon_uuid}")
             # Show a button to see the vCon in detail
-            st.markdown(f"[VCON DETAILS](/inspect?uuid={vcon_uuid})")
-
-            response = open_ai_client.chat.completions.create(
-                model=model_name,
-                temperature=temperature,
-                messages=[
-                    {"role": "system", "content": system_prompt},
-                    {"role": "user", "content": user_prompt},
-                    {"role": "assistant", "content": content}
-                ]
+            slot.markdown(f"[VCON DETAILS](/inspect?uuid={vcon_uuid})")
+            if vcon_uuid in missing:
+                slot.warning(f"NO {input_type.upper()} FOUND FOR THIS VCON")
+                continue
+            result_slots[vcon_uuid] = slot.empty()
+            result_slots[vcon_uuid].info("WAITING FOR RESPONSE...")
+
+        def render_result(result, cached=False):
+            with result_slots[result["key"]].container():
+                if "error" in result:
+                    st.error(f"FAILED AFTER {result['attempts']} ATTEMPTS: {result['error']}")
+                else:
+                    # Display the response
+                    st.subheader("RESPONSE (CACHED)" if cached else "RESPONSE")
+                    if result.get("chunks"):
+                        st.caption(f"COMBINED FROM {result['chunks']} CHUNKS")
+                    for text in result["content"]:
+                        st.write(text)
+
+        # Results waiting to be written back, and the number already written
+        write_back = {"pending": [], "saved": 0}
+
+        def save_result(result):
+            write_back["pending"].append((result["key"], llm.build_analysis_entry(
+                result["content"], analysis_type, model_name, system_prompt, user_prompt, temperature, input_type,
+                dialogs.get(result["key"]), cache_keys[result["key"]]
+            )))
+            # Write back in batches rather than one update per result
+            if len(write_back["pending"]) >= 50:
+                write_back["saved"] += common.bulk_append_analysis(write_back["pending"]) or 0
+                write_back["pending"] = []
+
+        # Cached results are shown straight away and never reach the model
+        if use_cache:
+            common.ensure_llm_cache_indexes(int(cache_ttl_days * 86400))
+            if not force_refresh:
+                hits = common.get_cached_completions(cache_keys.values()) or {}
+                hit_keys = {vcon_uuid: key for vcon_uuid, key in cache_keys.items() if key in hits}
+                # Hits cached by a run that did not save them are saved now, once
+                already_saved = set()
+                if save_results:
+                    already_saved = common.get_vcons_with_analysis_keys(hit_keys) or set()
+                for vcon_uuid, key in hit_keys.items():
+                    result = {"key": vcon_uuid, "content": hits[key]["content"]}
+                    render_result(result, cached=True)
+                    if save_results and vcon_uuid not in already_saved:
+                        save_result(result)
+                requests = [request for request in requests if cache_keys[request["key"]] not in hits]
+
+        progress_bar = st.progress(0, text=f"RUNNING {len(requests)} PROMPTS")
+        completed = []
+        start_time = time.time()
+
+        def show_result(result):
+            completed.append(result)
+            render_result(result)
+            if use_cache and "error" not in result:
+                common.put_cached_completion(cache_keys[result["key"]], model_name, result["content"], result.get("usage"))
+            if save_results and "error" not in result:
+                save_result(result)
+            elapsed = max(time.time() - start_time, 0.001)
+            progress_bar.progress(
+                len(completed) / len(requests),
+                text=f"{len(completed)} OF {len(requests)} DONE, {len(completed) / elapsed:.1f} PER SECOND"
             )
-            # Display the response
-            st.subheader("RESPONSE")
-            choices = response.choices
-            for choice in choices:
-                st.write(choice.message.content)
-   
 
+        llm.run_completions(
+            requests,
+            show_result,
+            concurrency=concurrency,
+            requests_per_minute=requests_per_minute,
+            tokens_per_minute=tokens_per_minute,
+            max_retries=max_retries,
+            max_chunk_tokens=max_chunk_tokens,
+        )
+        if save_results:
+            write_back["saved"] += common.bulk_append_analysis(write_back["pending"]) or 0
+            st.success(f"SAVED {write_back['saved']} RESULTS AS '{analysis_type}' ANALYSIS")
+        if use_cache:
+            common.trim_llm_cache(cache_max_entries)
 
 
+# Batch mode submits the prompts through the OpenAI Batch API, which is cheaper
+# and suited to overnight runs, and tracks each batch in MongoDB
+with batch_tab:
+    "Submit the current inputs and prompt as an OpenAI batch. Results arrive within 24 hours at half the price of synchronous calls."
+    if st.button(f"SUBMIT BATCH FOR {len(vcon_uuids)} VCONS"):
+        requests, cache_keys, missing, dialogs = build_prompt_requests(vcon_uuids)
+        if missing:
+            st.warning(f"SKIPPING {len(missing)} VCONS WITHOUT A {input_type.upper()}")
+        if requests:
+            prompt = {
+                "system_prompt": system_prompt,
+                "user_prompt": user_prompt,
+                "model_name": model_name,
+                "temperature": temperature,
+                "input_type": input_type,
+            }
+            with st.spinner("UPLOADING BATCH"):
+                for batch, keys in llm.submit_batches(open_ai_client, requests, metadata={"source": "vcon-admin workbench"}):
+                    common.save_llm_batch(batch.id, prompt, {key: cache_keys[key] for key in keys}, batch.status,
+                                          {key: dialogs[key] for key in keys})
+                    st.success(f"SUBMITTED BATCH {batch.id} WITH {len(keys)} REQUESTS")
+
+    st.divider()
+    st.subheader("BATCHES")
+    if st.button("REFRESH BATCH STATUS"):
+        for job in common.list_llm_batches() or []:
+            if job["status"] in ("completed", "failed", "expired", "cancelled"):
+                continue
+            batch = open_ai_client.batches.retrieve(job["_id"])
+            common.update_llm_batch(job["_id"], {
+                "status": batch.status,
+                "output_file_id": batch.output_file_id,
+                "error_file_id": batch.error_file_id,
+                "request_counts": batch.request_counts.model_dump() if batch.request_counts else None,
+                "errors": [error.message for error in batch.errors.data or []] if batch.errors else None,
+            })
+
+    for job in common.list_llm_batches() or []:
+        counts = job.get("request_counts") or {}
+        with st.expander(f"{job['_id']} - {job['status'].upper()} - {len(job['cache_keys'])} VCONS - {job['created_at']:%Y-%m-%d %H:%M}"):
+            st.write(f"**Prompt**: {job['prompt']['user_prompt']}")
+            st.write(f"**Model**: {job['prompt']['model_name']}")
+            if counts:
+                st.write(f"**Completed**: {counts.get('completed', 0)} of {counts.get('total', 0)}, **Failed**: {counts.get('failed', 0)}")
+            if job["status"] == "completed" and job.get("output_file_id"):
+                save_batch_results = st.checkbox("SAVE RESULTS TO VCONS", key=f"save_{job['_id']}", disabled=job.get("results_saved", False),
+                                                 help="Already saved" if job.get("results_saved") else None)
+                batch_analysis_type = st.text_input("ANALYSIS TYPE", value="workbench", key=f"analysis_type_{job['_id']}")
+                if st.button("FETCH RESULTS", key=f"fetch_{job['_id']}"):
+                    fetched = 0
+                    batch_analysis = []
+                    for result in llm.iter_batch_results(open_ai_client, job["output_file_id"]):
+                        st.markdown(f"**vCon** [{result['key']}](/inspect?uuid={result['key']})")
+                        if "error" in result:
+                            st.error(result["error"])
+                            continue
+                        for text in result["content"]:
+                            st.write(text)
+                        # Batch results land in the same cache as synchronous runs
+                        cache_key = job["cache_keys"].get(result["key"])
+                        if cache_key:
+                            common.put_cached_completion(cache_key, job["prompt"]["model_name"], result["content"], result.get("usage"))
+                        if save_batch_results:
+                            batch_prompt = job["prompt"]
+                            batch_analysis.append((result["key"], llm.build_analysis_entry(
+                                result["content"], batch_analysis_type, batch_prompt["model_name"], batch_prompt["system_prompt"],
+                                batch_prompt["user_prompt"], batch_prompt["temperature"], batch_prompt["input_type"],
+                                job.get("dialogs", {}).get(result["key"]), cache_key
+                            )))
+                            if len(batch_analysis) >= 500:
+                                common.bulk_append_analysis(batch_analysis)
+                                batch_analysis = []
+                        fetched += 1
+                    if save_batch_results:
+                        common.bulk_append_analysis(batch_analysis)
+                    common.update_llm_batch(job["_id"], {"results_fetched": True, "results_saved": job.get("results_saved", False) or save_batch_results})
+                    st.success(f"FETCHED {fetched} RESULTS")
+            # Validation errors fail the whole batch; per-request failures go to the error file
+            for error in job.get("errors") or []:
+                st.error(error)
+            if job.get("error_file_id") and st.button("SHOW FAILED REQUESTS", key=f"errors_{job['_id']}"):
+                for result in llm.iter_batch_results(open_ai_client, job["error_file_id"]):
+                    st.markdown(f"**vCon** [{result['key']}](/inspect?uuid={result['key']})")
+                    error = result.get("error") or {}
+                    st.error(error.get("message", str(error)) if isinstance(error, dict) else str(error))
@@ -0,0 +1,71 @@
+import io
+import os
+import struct
+import wave
+
+import lib.audio as audio
+
+
+def write_pcm_wav(path, seconds, rate=8000):
+    with wave.open(str(path), "wb") as w:
+        w.setnchannels(1)
+        w.setsampwidth(2)
+        w.setframerate(rate)
+        w.writeframes(b"\x00\x00" * rate * seconds)
+
+
+def write_mulaw_wav(path, size):
+    """A μ-law WAV (format tag 7), which the wave module refuses to open."""
+    data = b"\xff" * size
+    fmt = struct.pack("<HHIIHH", 7, 1, 8000, 8000, 1, 8)
+    with open(path, "wb") as f:
+        f.write(b"RIFF" + struct.pack("<I", 4 + 8 + len(fmt) + 8 + len(data)) + b"WAVE")
+        f.write(b"fmt " + struct.pack("<I", len(fmt)) + fmt)
+        f.write(b"data" + struct.pack("<I", len(data)) + data)
+
+
+def test_put_keeps_a_recording_larger_than_the_cache(tmp_path):
+    cache = audio.AudioCache(str(tmp_path), max_bytes=10)
+    path = cache.put("big", [b"x" * 100])
+    assert os.path.exists(path)
+    assert cache.get("big") == path
+
+    # The next put evicts it
+    cache.put("next", [b"y" * 5])
+    assert cache.get("big") is None
+
+
+def test_pcm_wav_is_cut_into_standalone_segments(tmp_path):
+    path = tmp_path / "call.wav"
+    write_pcm_wav(path, seconds=25)
+    assert audio.segment_count(str(path), segment_seconds=10) == 3
+    segment = audio.read_segment(str(path), 2, segment_seconds=10)
+    with wave.open(io.BytesIO(segment)) as w:
+        assert w.getnframes() == 5 * 8000
+
+
+def test_mulaw_wav_is_cut_into_standalone_segments(tmp_path):
+    path = tmp_path / "call.wav"
+    write_mulaw_wav(path, 8000 * 25)
+    assert audio.segment_count(str(path), segment_seconds=10) == 3
+
+    segment = audio.read_segment(str(path), 1, segment_seconds=10)
+    segment_path = tmp_path / "segment.wav"
+    segment_path.write_bytes(segment)
+    fmt, offset, size, block_align, byte_rate = audio.read_wav_layout(str(segment_path))
+    assert struct.unpack("<H", fmt[:2])[0] == 7
+    assert size == 10 * byte_rate
+    assert struct.unpack("<I", segment[4:8])[0] == len(segment) - 8
+    original = open(path, "rb").read()
+    data_offset = len(original) - 8000 * 25
+    assert segment[offset:offset + size] == original[data_offset + size:data_offset + 2 * size]
+
+    last = audio.read_segment(str(path), 2, segment_seconds=10)
+    assert struct.unpack("<I", last[40:44])[0] == 5 * 8000
+
+
+def test_other_formats_fall_back_to_byte_segments(tmp_path):
+    path = tmp_path / "call.mp3"
+    path.write_bytes(b"ID3" + b"\xff" * 2497)
+    assert audio.segment_count(str(path), segment_bytes=1000) == 3
+    assert audio.read_segment(str(path), 1, segment_bytes=1000) == open(path, "rb").read()[1000:2000]
@@ -0,0 +1,85 @@
+import io
+import os
+import uuid
+
+import bson
+from bson import json_util
+from bson.binary import Binary, UUID_SUBTYPE
+from bson.raw_bson import RawBSONDocument
+
+import lib.common as common
+
+
+class FakeDatabase:
+    def __init__(self, collection_uuid):
+        self.collection_uuid = collection_uuid
+
+    def list_collections(self, filter=None):
+        return iter([{"name": filter["name"], "info": {"uuid": self.collection_uuid}}])
+
+
+class FakeRawCollection:
+    """Just enough of a raw-BSON pymongo collection for dump and restore."""
+
+    name = "vcons"
+
+    def __init__(self, documents=(), collection_uuid=None):
+        self.documents = [RawBSONDocument(bson.encode(doc)) for doc in documents]
+        self.database = FakeDatabase(collection_uuid)
+        self.written = []
+        self.indexes = []
+
+    def find(self, query, batch_size=None):
+        return iter(self.documents)
+
+    def list_indexes(self):
+        return iter([
+            {"v": 2, "key": {"_id": 1}, "name": "_id_"},
+            {"v": 2, "key": {"uuid": 1}, "name": "uuid_1"},
+        ])
+
+    def bulk_write(self, operations, ordered=True):
+        self.written.extend(operation._doc for operation in operations)
+
+    def insert_many(self, documents, ordered=True):
+        self.written.extend(documents)
+
+    def create_index(self, keys, **options):
+        self.indexes.append((keys, options))
+
+
+def test_bson_dump_and_restore_round_trip(tmp_path, monkeypatch):
+    vcons = [
+        {"_id": bson.ObjectId(), "uuid": f"vcon-{i}", "dialog": [{"body": "x" * i}], "analysis": []}
+        for i in range(5)
+    ]
+    collection_uuid = uuid.uuid4()
+    source = FakeRawCollection(vcons, Binary(collection_uuid.bytes, UUID_SUBTYPE))
+    monkeypatch.setattr(common, "get_raw_vcon_collection", lambda: source)
+
+    bson_path, count = common.dump_vcons_bson(str(tmp_path))
+    assert count == len(vcons)
+
+    metadata_path = os.path.join(str(tmp_path), "vcons.metadata.json")
+    with open(metadata_path) as f:
+        metadata = json_util.loads(f.read())
+    assert metadata["uuid"] == collection_uuid.hex
+    assert metadata["collectionName"] == "vcons"
+
+    target = FakeRawCollection()
+    monkeypatch.setattr(common, "get_raw_vcon_collection", lambda: target)
+    with open(bson_path, "rb") as f:
+        written = common.restore_vcons_bson(f, metadata=common.load_bson_metadata(metadata_path), batch_size=2)
+
+    assert written == len(vcons)
+    assert [bson.decode(doc.raw) for doc in target.written] == vcons
+    assert target.indexes == [([("uuid", 1)], {"name": "uuid_1"})]
+
+
+def test_iter_bson_documents_rejects_truncated_stream():
+    data = bson.encode({"uuid": "vcon-1"})
+    try:
+        list(common.iter_bson_documents(io.BytesIO(data[:-3])))
+    except ValueError:
+        return
+    raise AssertionError("truncated stream was accepted")
@@ -0,0 +1,69 @@
+from types import SimpleNamespace
+
+import httpx
+import openai
+import pytest
+
+import lib.common as common
+import lib.embeddings as embeddings
+import lib.llm as llm
+
+
+class FakeEmbeddings:
+    """Embeds each text as [len(text)], rejecting any batch with a text containing "bad"."""
+
+    def __init__(self):
+        self.requests = []
+
+    def create(self, input, model, dimensions=None):
+        self.requests.append(list(input))
+        if any("bad" in text for text in input):
+            request = httpx.Request("POST", "https://api.openai.com/v1/embeddings")
+            raise openai.BadRequestError("Invalid input", response=httpx.Response(400, request=request), body=None)
+        # Out of order, as the API does not promise any order
+        data = [SimpleNamespace(index=index, embedding=[float(len(text))]) for index, text in enumerate(input)]
+        return SimpleNamespace(data=list(reversed(data)))
+
+
+@pytest.fixture(autouse=True)
+def estimated_tokens(monkeypatch):
+    # Count tokens as len // 4 + 1 instead of loading a tiktoken encoding
+    monkeypatch.setattr(llm, "_get_encoding", lambda model=None: None)
+
+
+def test_a_bad_input_does_not_fail_its_batch():
+    client = SimpleNamespace(embeddings=FakeEmbeddings())
+    texts = ["one", "two", "bad", "four", "five"]
+
+    vectors = embeddings._embed_or_split(client, texts, embeddings.EMBEDDING_MODEL, None, max_retries=0)
+
+    assert vectors == [[3.0], [3.0], None, [4.0], [4.0]]
+    assert ["bad"] in client.embeddings.requests
+
+
+def test_batches_are_bounded_by_inputs_and_tokens():
+    texts = ["x" * 40] * 10  # 11 tokens each
+
+    assert [batch for batch, _ in embeddings.batch_texts(texts, max_inputs=4, max_tokens=1000)] == [
+        [0, 1, 2, 3], [4, 5, 6, 7], [8, 9]]
+    assert embeddings.batch_texts(texts, max_inputs=100, max_tokens=33) == [
+        ([0, 1, 2], 33), ([3, 4, 5], 33), ([6, 7, 8], 33), ([9], 11)]
+
+
+def test_only_uncached_texts_are_requested_and_charged(monkeypatch):
+    cached_text = "cached text"
+    cache = {embeddings.embedding_cache_key(cached_text): embeddings.pack_vector([0.5])}
+    stored = []
+    monkeypatch.setattr(common, "get_cached_embeddings", lambda keys: {k: cache[k] for k in keys if k in cache})
+    monkeypatch.setattr(common, "put_cached_embeddings", stored.extend)
+    client = SimpleNamespace(embeddings=FakeEmbeddings())
+    charged = []
+
+    vectors = embeddings.embed_texts(client, ["new text", "", cached_text, "bad text"],
+                                     throttle=lambda requests, tokens: charged.append((requests, tokens)))
+
+    assert vectors == [[8.0], [0.0] * embeddings.EMBEDDING_DIM, [0.5], None]
+    assert client.embeddings.requests[0] == ["new text", "bad text"]
+    assert charged == [(1, llm.count_tokens("new text") + llm.count_tokens("bad text"))]
+    # Failed inputs are not cached
+    assert [key for key, *_ in stored] == [embeddings.embedding_cache_key("new text")]
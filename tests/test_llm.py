@@ -0,0 +1,112 @@
+import asyncio
+import json
+import time
+
+import pytest
+
+import lib.llm as llm
+
+
+@pytest.fixture(autouse=True)
+def estimated_tokens(monkeypatch):
+    # Count tokens as len // 4 + 1 instead of loading a tiktoken encoding
+    monkeypatch.setattr(llm, "_get_encoding", lambda model=None: None)
+
+
+def test_chunk_text_keeps_lines_whole():
+    lines = [f"Speaker {i}: {'word ' * 5}\n" for i in range(10)]  # 9 tokens each
+
+    chunks = llm.chunk_text("".join(lines), max_tokens=20)
+
+    assert "".join(chunks) == "".join(lines)
+    assert all(llm.count_tokens(chunk) <= 20 for chunk in chunks)
+    assert all(chunk.endswith("\n") for chunk in chunks)
+
+
+def test_chunk_text_cuts_a_line_longer_than_a_chunk():
+    text = "x" * 400  # 101 tokens on one line
+
+    chunks = llm.chunk_text(text, max_tokens=30)
+
+    assert len(chunks) > 1
+    assert "".join(chunks) == text
+
+
+def completion_request(content):
+    return {"key": "vcon-1", "model": "gpt-4o-mini", "messages": [
+        {"role": "system", "content": "Summarize"},
+        {"role": "user", "content": content},
+    ]}
+
+
+def test_long_content_is_answered_in_parts_and_combined():
+    seen = []
+
+    async def complete(request):
+        seen.append(request)
+        return {"key": request["key"], "content": [f"answer {len(seen)}"], "usage": 10, "attempts": 1}
+
+    content = "".join(f"line {i} {'y' * 30}\n" for i in range(6))
+    result = asyncio.run(llm._map_reduce(complete, completion_request(content), max_chunk_tokens=20))
+
+    parts = seen[:-1]
+    assert result["chunks"] == len(parts) > 1
+    assert [part["key"] for part in parts] == [("vcon-1", index) for index in range(len(parts))]
+    assert all(part["messages"][0]["content"] == "Summarize" for part in seen)
+    reduce_content = seen[-1]["messages"][-1]["content"]
+    assert seen[-1]["key"] == "vcon-1"
+    assert reduce_content.startswith(llm.REDUCE_INSTRUCTION)
+    assert "Part 1:\nanswer" in reduce_content
+    assert result["usage"] == 10 * len(seen)
+
+
+def test_short_content_is_sent_as_is():
+    async def complete(request):
+        return {"key": request["key"], "content": ["answer"], "usage": 5, "attempts": 1}
+
+    result = asyncio.run(llm._map_reduce(complete, completion_request("short"), max_chunk_tokens=20))
+
+    assert result == {"key": "vcon-1", "content": ["answer"], "usage": 5, "attempts": 1}
+
+
+def test_a_failed_part_fails_the_request():
+    async def complete(request):
+        if request["key"] == ("vcon-1", 1):
+            return {"key": request["key"], "error": "rate limited", "attempts": 3}
+        return {"key": request["key"], "content": ["answer"], "usage": 5, "attempts": 1}
+
+    content = "".join(f"line {i} {'y' * 30}\n" for i in range(6))
+    result = asyncio.run(llm._map_reduce(complete, completion_request(content), max_chunk_tokens=20))
+
+    assert result["key"] == "vcon-1"
+    assert result["error"] == "rate limited"
+    assert "content" not in result
+
+
+def test_rate_limiter_waits_once_the_burst_is_spent():
+    async def acquire_all(limiter, times):
+        started = time.monotonic()
+        for _ in range(times):
+            await limiter.acquire()
+        return time.monotonic() - started
+
+    # 1200 per minute is one every 50 ms, after a burst of 2
+    assert asyncio.run(acquire_all(llm.RateLimiter(1200, capacity=2), 2)) < 0.04
+    assert asyncio.run(acquire_all(llm.RateLimiter(1200, capacity=2), 4)) >= 0.09
+    assert asyncio.run(acquire_all(llm.RateLimiter(None), 1000)) < 0.04
+
+
+def test_batch_files_respect_request_and_size_limits():
+    requests = [completion_request(f"vCon {i}") for i in range(10)]
+    line_size = len(llm.build_batch_file(requests[:1]))
+
+    files = list(llm.split_batch_files(requests, max_requests=4, max_bytes=line_size * 3))
+
+    assert [len(chunk) for chunk, _ in files] == [3, 3, 3, 1]
+    for chunk, data in files:
+        assert len(data) <= line_size * 3
+        lines = [json.loads(line) for line in data.decode("utf-8").splitlines()]
+        assert [line["body"]["messages"] for line in lines] == [request["messages"] for request in chunk]
+        assert all("key" not in line["body"] for line in lines)
+
+    assert [len(chunk) for chunk, _ in llm.split_batch_files(requests, max_requests=4)] == [4, 4, 2]
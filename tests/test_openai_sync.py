@@ -0,0 +1,205 @@
+import json
+from types import SimpleNamespace
+
+import lib.common as common
+import lib.openai_files as openai_files
+
+
+class FakeFiles:
+    def __init__(self, store):
+        self.store = store
+
+    def create(self, file, purpose):
+        name, data = file
+        file_id = f"file-{len(self.store.created) + 1}"
+        self.store.created[file_id] = (name, data)
+        return SimpleNamespace(id=file_id)
+
+    def delete(self, file_id):
+        self.store.deleted.append(file_id)
+
+
+class FakeVectorStoreFiles:
+    def __init__(self, store):
+        self.store = store
+
+    def list(self, vector_store_id, limit=100):
+        return [SimpleNamespace(id=file_id) for file_id in sorted(self.store.attached)]
+
+    def delete(self, vector_store_id, file_id):
+        self.store.attached.discard(file_id)
+
+
+class FakeFileBatches:
+    def __init__(self, store):
+        self.store = store
+
+    def create_and_poll(self, vector_store_id, file_ids, poll_interval_ms=None):
+        batch_id = f"batch-{len(self.store.batches) + 1}"
+        completed = [file_id for file_id in file_ids if self.store.created[file_id][0] not in self.store.rejected]
+        self.store.attached.update(completed)
+        self.store.batches[batch_id] = completed
+        return SimpleNamespace(id=batch_id, file_counts=SimpleNamespace(completed=len(completed)))
+
+    def list_files(self, batch_id, vector_store_id, filter=None, limit=100):
+        return [SimpleNamespace(id=file_id) for file_id in self.store.batches[batch_id]]
+
+
+class FakeOpenAI:
+    """Just enough of the OpenAI files and vector store APIs for a sync."""
+
+    def __init__(self):
+        self.created = {}
+        self.attached = set()
+        self.deleted = []
+        self.batches = {}
+        self.rejected = set()
+        self.files = FakeFiles(self)
+        self.beta = SimpleNamespace(vector_stores=SimpleNamespace(
+            files=FakeVectorStoreFiles(self),
+            file_batches=FakeFileBatches(self),
+        ))
+
+
+class FakeManifest:
+    def __init__(self, monkeypatch):
+        self.entries = {}
+        monkeypatch.setattr(common, "get_openai_sync_manifest", self.get)
+        monkeypatch.setattr(common, "save_openai_sync_entries", self.save)
+        monkeypatch.setattr(common, "remove_openai_sync_entries", self.remove)
+
+    def get(self, vector_store_id):
+        return {uuid: dict(entry) for uuid, entry in self.entries.items()}
+
+    def save(self, vector_store_id, entries):
+        for uuid, content_hash, file_id in entries:
+            self.entries[uuid] = {"uuid": uuid, "content_hash": content_hash, "file_id": file_id}
+
+    def remove(self, vector_store_id, uuids):
+        for uuid in uuids:
+            self.entries.pop(uuid, None)
+
+
+def make_vcon(uuid, text="hello"):
+    return {"uuid": uuid, "parties": [], "dialog": [{"type": "text", "body": text}], "analysis": []}
+
+
+def sync(client, vcons, **kwargs):
+    return openai_files.sync_vector_store(client, "vs-1", iter(vcons), max_workers=2, **kwargs)
+
+
+def test_only_new_and_changed_vcons_are_uploaded(monkeypatch):
+    manifest = FakeManifest(monkeypatch)
+    client = FakeOpenAI()
+
+    result = sync(client, [make_vcon("a"), make_vcon("b")])
+    assert result["uploaded"] == 2
+    assert result["failed"] == 0
+    assert set(manifest.entries) == {"a", "b"}
+
+    result = sync(client, [make_vcon("a"), make_vcon("b")])
+    assert result["uploaded"] == 0
+    assert result["unchanged"] == 2
+    assert len(client.created) == 2
+
+    old_file = manifest.entries["b"]["file_id"]
+    result = sync(client, [make_vcon("a"), make_vcon("b", "changed")])
+    assert result["uploaded"] == 1
+    assert result["replaced"] == 1
+    assert manifest.entries["b"]["file_id"] != old_file
+    assert client.deleted == [old_file]
+
+
+def test_removed_vcons_have_their_files_deleted(monkeypatch):
+    manifest = FakeManifest(monkeypatch)
+    client = FakeOpenAI()
+    sync(client, [make_vcon("a"), make_vcon("b")])
+    gone = manifest.entries["b"]["file_id"]
+
+    result = sync(client, [make_vcon("a")])
+    assert result["removed"] == 1
+    assert set(manifest.entries) == {"a"}
+    assert client.deleted == [gone]
+    assert gone not in client.attached
+
+
+def test_missing_files_are_uploaded_again(monkeypatch):
+    manifest = FakeManifest(monkeypatch)
+    client = FakeOpenAI()
+    sync(client, [make_vcon("a"), make_vcon("b")])
+    lost = manifest.entries["a"]["file_id"]
+    client.attached.discard(lost)
+
+    result = sync(client, [make_vcon("a"), make_vcon("b")])
+    assert result["missing"] == 1
+    assert result["uploaded"] == 1
+    assert result["unchanged"] == 1
+    assert manifest.entries["a"]["file_id"] not in (lost, manifest.entries["b"]["file_id"])
+
+
+def test_untracked_files_are_only_deleted_when_asked(monkeypatch):
+    FakeManifest(monkeypatch)
+    client = FakeOpenAI()
+    client.attached.add("file-untracked")
+
+    result = sync(client, [make_vcon("a")])
+    assert result["untracked"] == 1
+    assert "file-untracked" in client.attached
+
+    result = sync(client, [make_vcon("a")], remove_untracked=True)
+    assert result["untracked"] == 1
+    assert "file-untracked" not in client.attached
+    assert "file-untracked" in client.deleted
+
+
+def test_files_that_fail_to_index_are_deleted_and_retried(monkeypatch):
+    manifest = FakeManifest(monkeypatch)
+    client = FakeOpenAI()
+    sync(client, [make_vcon("a")])
+    indexed = manifest.entries["a"]["file_id"]
+
+    client.rejected.add("a.vcon.json")
+    result = sync(client, [make_vcon("a", "changed")])
+    assert result["uploaded"] == 0
+    assert result["failed"] == 1
+    # The vCon keeps its old file, and the rejected upload is not orphaned
+    assert manifest.entries["a"]["file_id"] == indexed
+    rejected = [file_id for file_id in client.created if file_id != indexed]
+    assert client.deleted == rejected
+
+    client.rejected.clear()
+    result = sync(client, [make_vcon("a", "changed")])
+    assert result["uploaded"] == 1
+    assert manifest.entries["a"]["file_id"] != indexed
+
+
+def test_shards_are_deleted_once_no_vcon_points_at_them(monkeypatch):
+    manifest = FakeManifest(monkeypatch)
+    client = FakeOpenAI()
+    sync(client, [make_vcon("a"), make_vcon("b")], shard_bytes=1024 * 1024)
+    shard = manifest.entries["a"]["file_id"]
+    assert manifest.entries["b"]["file_id"] == shard
+
+    # b still points at the first shard, so it stays
+    sync(client, [make_vcon("a", "changed"), make_vcon("b")], shard_bytes=1024 * 1024)
+    assert manifest.entries["a"]["file_id"] != shard
+    assert shard in client.attached
+    assert client.deleted == []
+
+    sync(client, [make_vcon("a", "changed"), make_vcon("b", "changed")], shard_bytes=1024 * 1024)
+    assert shard not in client.attached
+    assert client.deleted == [shard]
+
+
+def test_pack_shards_stays_within_max_bytes():
+    vcons = [make_vcon(f"vcon-{i}", "x" * 200) for i in range(20)]
+    shards = list(openai_files.pack_shards(iter(vcons), max_bytes=1024, prefix="test"))
+
+    assert len(shards) > 1
+    assert [uuid for _, _, uuids in shards for uuid in uuids] == [vcon["uuid"] for vcon in vcons]
+    for number, (name, data, uuids) in enumerate(shards, start=1):
+        assert name == f"test-{number:05d}.txt"
+        assert len(data) <= 1024
+        lines = data.decode("utf-8").splitlines()
+        assert json.loads(lines[0]) == {"shard_index": {"shard": number, "vcon_uuids": uuids}}
+        assert [json.loads(line)["vcon_uuid"] for line in lines[1:]] == uuids